@@ -15,6 +15,7 @@ import logging
 import sys
 import inspect
 import os
+import signal
 import socket
 import time
 from datetime import timedelta
@@ -44,6 +45,13 @@ COMMAND_CRASHED = 2
 COMMAND_FAILED = 3
 COMMAND_ENDED = 4
 
+# delay in seconds given to the processes of a stopped command to terminate before they are killed
+KILL_DELAY = 5
+# maximum size of an update sent on the socket of the worker (see octopus.worker.ipc), larger ones go over HTTP
+UPDATE_DATAGRAM_SIZE = 65536
+# timeout in seconds of the updates sent on the socket of the worker
+UPDATE_SOCKET_TIMEOUT = 5
+
 
 logger = logging.getLogger('puli.commandwatcher')
 logger.setLevel(logging.INFO)
@@ -60,6 +68,36 @@ logger.addHandler(handler)
 class ThreadInterruption(Exception):
     pass
 
+
+def signalCommandProcesses(sig):
+    '''
+    Sends the signal to the processes started by the runner: the processes of the session of the command watcher (it is
+    the session leader, see the worker), except the command watcher itself. Returns the number of processes signaled.
+    '''
+    sessionId = os.getpid()
+    if os.getsid(0) != sessionId:
+        logger.warning("The command watcher is not a session leader, the processes of the command cannot be found.")
+        return 0
+    count = 0
+    for name in os.listdir("/proc"):
+        if not name.isdigit() or int(name) == sessionId:
+            continue
+        try:
+            with open(os.path.join("/proc", name, "stat")) as f:
+                data = f.read()
+        except IOError:
+            continue
+        fields = data[data.rfind(')') + 2:].split()
+        # fields: state, ppid, pgrp, session...
+        if fields[0] == 'Z' or int(fields[3]) != sessionId:
+            continue
+        try:
+            os.kill(int(name), sig)
+            count += 1
+        except OSError:
+            pass
+    return count
+
 runnerlog = logging.getLogger('puli.runner')
 runnerlog.setLevel(logging.INFO)
 runnerhandler = logging.StreamHandler(sys.stdout)
@@ -133,10 +171,16 @@ class CmdThreader(Thread):
         self.stopped = COMMAND_STOPPED
         self.logger.warning("Abrupt termination for thread \"%s.%s\"" % (self.cmd, self.methodName))
 
-        # threading.Thread class does not provde an internal way to stop itself.
-        # It only ends when execution end is reached or on an unhandled exception.
-        # Therefore we raise a specific exception, unhandled in thread but known in CommandWatcher class
-        raise ThreadInterruption()
+        # threading.Thread class does not provde an internal way to stop itself, the processes started by the runner
+        # are terminated instead (SIGTERM, then SIGKILL after KILL_DELAY). The thread is a daemon: a runner running
+        # python code does not prevent the command watcher from exiting.
+        if signalCommandProcesses(signal.SIGTERM):
+            deadline = time.time() + KILL_DELAY
+            while time.time() < deadline and signalCommandProcesses(0):
+                time.sleep(0.2)
+            killed = signalCommandProcesses(signal.SIGKILL)
+            if killed:
+                self.logger.warning("%d processes of the command killed with SIGKILL" % killed)
 
 
 ## This class is used to ensure the good execution of the CmdThreader's process.
@@ -171,6 +215,9 @@ class CommandWatcher(object):
         self.id = id
         self.requestManager = RequestManager("127.0.0.1", workerPort)
         self.workerPort = workerPort
+        # local socket of the worker, the updates are sent over HTTP when it is not available
+        self.workerSocket = os.environ.get("PULI_WORKER_SOCKET")
+        self.updateSocket = None
         self.workerFullName = socket.gethostname()+":"+self.workerPort
         self.serverFullName = serverFullName
         self.arguments = arguments
@@ -271,6 +318,7 @@ class CommandWatcher(object):
     def threadAction(self, action):
         tmpThread = CmdThreader(self.job, action, self.arguments, self.updateCompletionCallback, self.updateMessageCallback, self.updateCustomStatsCallback, self.updateLicenseCallback)
         tmpThread.setName('jobMain')
+        tmpThread.setDaemon(True)
         # add this thread to the list
         self.threadList[action] = tmpThread
         # launch it
@@ -293,6 +341,28 @@ class CommandWatcher(object):
         except http.BadStatusLine:
             logger.debug('Updating status has failed with a BadStatusLine error')
 
+    def sendUpdate(self, dct):
+        """
+        Sends an update of the command (JSON) on the local socket of the worker, see octopus.worker.ipc.
+
+        :return: False if the update has to be sent over HTTP (no socket, worker not listening, update too large)
+        """
+        if not self.workerSocket or len(dct) > UPDATE_DATAGRAM_SIZE:
+            return False
+        try:
+            if self.updateSocket is None:
+                self.updateSocket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                # the socket only blocks while the receive buffer of the worker is full
+                self.updateSocket.settimeout(UPDATE_SOCKET_TIMEOUT)
+            self.updateSocket.sendto(dct, self.workerSocket)
+            return True
+        except socket.error, e:
+            logger.debug('Update on the socket of the worker failed (%r), using its webservice' % e)
+            if self.updateSocket is not None:
+                self.updateSocket.close()
+                self.updateSocket = None
+            return False
+
     def updateValidatorResult(self, msg, errorInfos):
         """
         FIXME: function never called
@@ -303,6 +373,8 @@ class CommandWatcher(object):
 
         # logger.debug('Updating msg and errorInfos : %s,%s' % (msg, str(errorInfos)))
         dct = json.dumps({"id": self.id, "validatorMessage": msg, "errorInfos": errorInfos})
+        if self.sendUpdate(dct):
+            return
         headers = {}
         headers['Content-Length'] = len(dct)
         try:
@@ -316,6 +388,8 @@ class CommandWatcher(object):
             return
 
         body = json.dumps({"id": self.id, "status": status, "completion": self.completion, "message": self.message, "stats": self.stats})
+        if self.sendUpdate(body):
+            return
 
         headers = {}
         headers['Content-Length'] = len(body)
@@ -343,7 +417,7 @@ class CommandWatcher(object):
             request.call(conn, onResponse, onError)
             conn.close()
             time.sleep(delay)
-            delay = max(2.0 * delay, 30.0)
+            delay = min(2.0 * delay, 30.0)
 
     ## Updates the completion of the command.
     #
@@ -376,13 +450,15 @@ class CommandWatcher(object):
         if self.statsHasChanged and self.stats is not {}:
             data["stats"] = self.stats
 
+        data["id"] = self.id
         dct = json.dumps(data)
-        headers = {}
-        headers['Content-Length'] = len(dct)
-        try:
-            self.requestManager.put("/commands/%d/" % self.id, dct, headers)
-        except http.BadStatusLine:
-            logger.debug('Updating completion has failed with a BadStatusLine error')
+        if not self.sendUpdate(dct):
+            headers = {}
+            headers['Content-Length'] = len(dct)
+            try:
+                self.requestManager.put("/commands/%d/" % self.id, dct, headers)
+            except http.BadStatusLine:
+                logger.debug('Updating completion has failed with a BadStatusLine error')
 
         # Reset update flags
         self.messageHasChanged = False
@@ -495,7 +571,6 @@ class CommandWatcher(object):
     ## Kills all processes launched by the command.
     #
     def killCommand(self):
-        # FIXME: maybe we ought to provide a way to ask the command to stop itself
         self.threadList[EXEC].stop()
 
     def updateCompletionCallback(self, completion):
@@ -580,17 +655,17 @@ def closeFileDescriptors():
         pass
 
 
-if __name__ == "__main__":
-
+def main(argv):
+    '''Runs a command watcher with the command line arguments `argv` (also called by the fork server, see forkserver.py).'''
     try:
-        logFile = sys.argv[1]
-        serverFullName = sys.argv[2]
-        workerPort = sys.argv[3]
-        id = int(sys.argv[4])
-        runner = sys.argv[5]
-        validationExpression = sys.argv[6]
-        runnerPackages = sys.argv[7]
-        rawArguments = sys.argv[8:]
+        # argv[1] is the log file, the output is redirected by the worker
+        serverFullName = argv[2]
+        workerPort = argv[3]
+        id = int(argv[4])
+        runner = argv[5]
+        validationExpression = argv[6]
+        runnerPackages = argv[7]
+        rawArguments = argv[8:]
 
         # Properly deserialize command arguments
         argumentsDict = {}
@@ -619,3 +694,7 @@ if __name__ == "__main__":
     except Exception, e:
         logger.warning("Exception raised during commandwatcher init: %r" % e)
         sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
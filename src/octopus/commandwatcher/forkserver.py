@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Fork server of command watchers.
+
+Starting a command watcher costs the startup of a python interpreter and the import of the commandwatcher module,
+of puliclient and of the runner. For short commands, it is a sizable part of the work. The fork server is started
+once by the worker with these modules imported: each command watcher is forked from it and only runs
+commandwatcher.main(). The runner modules are imported by the server the first time they are used (and the ones
+given on its command line at startup), the next command watchers of a runner start with its module loaded.
+
+Each command watcher is still isolated in its own session, with its own environment, log file and open files limit.
+The interpreter of the server is shared though (module search path, imported runners): the worker starts the
+commands whose environment changes it (e.g. their own PYTHONPATH) with a new interpreter, see
+CommandWatcherForkServer.canSpawn.
+
+Protocol (one JSON object per line):
+    - the worker sends on the stdin of the server:
+        { id, argv: [commandwatcher arguments], env: {...}, log: path, maxOpenFiles, cpus: [cpu indexes] }
+    - the server answers on its stdout:
+        { id, pid } or { id, error }
+    - and notifies the end of a command watcher it has started:
+        { exited: pid, status }
+
+The server exits when its stdin is closed (the worker has stopped), the running command watchers go on.
+Usage: forkserver.py [runner ...]
+"""
+__author__ = "Jerome Samson"
+__copyright__ = "Copyright 2014, Mikros Image"
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import resource
+import select
+import signal
+import sys
+import traceback
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from puliclient.jobs import loadCommandRunner
+from octopus.commandwatcher import commandwatcher
+
+# resolved once by the server, the forked command watchers only call sched_setaffinity
+try:
+    LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    LIBC = None
+
+
+def setCpuAffinity(cpus):
+    '''
+    Restricts the calling process to the given cpus, the command started by the command watcher inherits them.
+    '''
+    if LIBC is None or not hasattr(LIBC, 'sched_setaffinity'):
+        raise OSError(errno.ENOSYS, "sched_setaffinity is not available")
+    mask = (ctypes.c_uint64 * (max(cpus) // 64 + 1))()
+    for cpu in cpus:
+        mask[cpu // 64] |= 1 << (cpu % 64)
+    if LIBC.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+
+
+class ForkServer(object):
+
+    def __init__(self, preloadedRunners):
+        self.loadedRunners = set()
+        # the protocol uses the original stdout, anything printed by the server goes to stderr
+        self.output = os.fdopen(os.dup(1), 'w')
+        os.dup2(2, 1)
+        self.buffer = ''
+        # the handler of SIGCHLD only writes on this pipe to wake the select up (see signal.set_wakeup_fd)
+        self.wakeupRead, self.wakeupWrite = os.pipe()
+        for fd in (self.wakeupRead, self.wakeupWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(self.wakeupWrite)
+
+        for runner in preloadedRunners:
+            self.loadRunner(runner)
+
+    def loadRunner(self, runner):
+        if runner in self.loadedRunners:
+            return
+        self.loadedRunners.add(runner)
+        try:
+            loadCommandRunner(runner)
+        except Exception, e:
+            # the command watcher reports the error of its own import
+            sys.stderr.write("Impossible to preload runner %s: %r\n" % (runner, e))
+
+    def send(self, message):
+        self.output.write(json.dumps(message) + '\n')
+        self.output.flush()
+
+    def serve(self):
+        while True:
+            try:
+                readable = select.select([0, self.wakeupRead], [], [])[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+
+            if self.wakeupRead in readable:
+                try:
+                    os.read(self.wakeupRead, 4096)
+                except OSError:
+                    pass
+            self.reapChildren()
+
+            if 0 in readable:
+                data = os.read(0, 65536)
+                if not data:
+                    # the worker has stopped
+                    return
+                self.buffer += data
+                while '\n' in self.buffer:
+                    line, self.buffer = self.buffer.split('\n', 1)
+                    self.handleRequest(json.loads(line))
+
+    def reapChildren(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if not pid:
+                return
+            self.send({'exited': pid, 'status': status})
+
+    def handleRequest(self, request):
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+        except OSError, e:
+            self.send({'id': request['id'], 'error': str(e)})
+            return
+        if pid == 0:
+            self.runCommandWatcher(request)
+        self.send({'id': request['id'], 'pid': pid})
+        # the next command watchers of this runner will find its module loaded
+        self.loadRunner(request['argv'][4])
+
+    def runCommandWatcher(self, request):
+        '''
+        Runs in the forked process, never returns.
+        '''
+        code = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            # the worker must see the end of the server even if its command watchers are still running
+            for fd in (self.output.fileno(), self.wakeupRead, self.wakeupWrite):
+                os.close(fd)
+            os.setsid()
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if request.get('maxOpenFiles') and request['maxOpenFiles'] < hard:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (request['maxOpenFiles'], hard))
+
+            devnull = os.open(os.devnull, os.O_RDONLY)
+            log = os.open(request['log'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+            os.dup2(devnull, 0)
+            os.dup2(log, 1)
+            os.dup2(log, 2)
+            # same as "python -u": the log is written as the command goes
+            sys.stdout = os.fdopen(1, 'w', 0)
+            sys.stderr = os.fdopen(2, 'w', 0)
+            commandwatcher.handler.stream = sys.stderr
+            commandwatcher.runnerhandler.stream = sys.stdout
+
+            if request.get('cpus'):
+                try:
+                    setCpuAffinity(request['cpus'])
+                except OSError, e:
+                    sys.stderr.write("Impossible to set the cpu affinity %r: %s\n" % (request['cpus'], e))
+
+            os.environ.clear()
+            os.environ.update((key.encode('utf-8'), value.encode('utf-8')) for key, value in request['env'].items())
+            argv = [commandwatcher.__file__] + [arg.encode('utf-8') for arg in request['argv']]
+            sys.argv = argv
+            commandwatcher.main(argv)
+            code = 0
+        except SystemExit, e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(code)
+
+
+if __name__ == '__main__':
+    ForkServer(sys.argv[1:]).serve()
@@ -35,5 +35,10 @@ class MainLoopApplication(object):
     def prepare(self):
         raise NotImplementedError
 
+    ## Called when an order is added, from any thread: an application waiting for events in its main loop can wake up.
+    #
+    def wakeUp(self):
+        pass
+
     def stop(self):
         pass
@@ -104,6 +104,7 @@ class WSAppFramework(object):
     def addAction(self, action, *args, **kwargs):
         with self.lock:
             self.orders.append([action, args, kwargs])
+        self.application.wakeUp()
 
     def executeOrders(self):
         with self.lock:
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Cancellation of commands running on the render nodes.
+
+Canceling a job is done in 2 steps:
+    - the commands are canceled in the dispatch tree (server side), in time slices of the webservice handler
+    - the kill requests are sent to the render nodes running the canceled commands, the kills collected during a
+      time slice are sent at its end: a render node freed by a cancellation is not left running its command while
+      the rest of the operation is processed
+
+The kill requests of an operation are grouped by render node: the commands of a render node are killed one after the
+other, several render nodes are contacted in parallel. The number of requests in progress is bounded for the whole
+dispatcher, the other requests wait in the IOLoop until a request is finished: a mass cancellation does not flood
+the IOLoop (and the scheduling) with thousands of callbacks.
+
+Each operation is registered with an id, its progress can be polled on /cancellations/<id> until it is done.
+
+Configuration (section COMMUNICATION of config.ini):
+    CANCEL_MAX_PARALLEL_REQUESTS: maximum number of kill requests in progress
+    CANCEL_REQUEST_TIMEOUT: timeout in seconds of a kill request
+    CANCEL_HISTORY_SIZE: number of finished operations kept for polling
+"""
+__author__ = "Jerome Samson"
+__copyright__ = "Copyright 2014, Mikros Image"
+
+import logging
+import time
+from collections import OrderedDict, deque
+from functools import partial
+
+from octopus.core import singletonconfig
+
+LOGGER = logging.getLogger('main.dispatcher.cancellation')
+
+# Maximum number of failed requests detailed in an operation
+MAX_REPORTED_FAILURES = 100
+
+
+class CancelOperation(object):
+    '''
+    Progress of a cancellation: commands canceled in the tree and kill requests sent to the render nodes.
+    '''
+
+    def __init__(self, id, description):
+        self.id = id
+        self.description = description
+        self.startTime = time.time()
+        self.endTime = None
+        # set once every command of the operation has been canceled in the tree
+        self.complete = False
+        self.canceledCommands = 0
+        # commands to kill on each render node, the requests not sent yet
+        self.pendingKills = OrderedDict()
+        # render nodes of the operation waiting in the manager to send their kills
+        self.scheduledRenderNodes = set()
+        self.totalKills = 0
+        self.sentKills = 0
+        self.succeededKills = 0
+        self.failedKills = 0
+        self.failures = []
+
+    def addKill(self, renderNode, commandId):
+        self.pendingKills.setdefault(renderNode, deque()).append(commandId)
+        self.totalKills += 1
+
+    @property
+    def done(self):
+        return self.complete and self.succeededKills + self.failedKills == self.totalKills
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'description': self.description,
+            'startTime': self.startTime,
+            'endTime': self.endTime,
+            'done': self.done,
+            'canceledCommands': self.canceledCommands,
+            'renderNodes': len(self.pendingKills),
+            'kills': {
+                'total': self.totalKills,
+                'sent': self.sentKills,
+                'succeeded': self.succeededKills,
+                'failed': self.failedKills,
+            },
+            'failures': self.failures,
+        }
+
+
+class CancellationManager(object):
+    '''
+    Sends the kill requests of the cancel operations, each render node has at most one request in progress.
+    All methods are called from the IOLoop thread.
+    '''
+
+    def __init__(self):
+        self.operations = OrderedDict()
+        self.nextId = 1
+        # (operation, renderNode) having kill requests waiting to be sent
+        self.waiting = deque()
+        self.busyRenderNodes = set()
+        self.requestsInProgress = 0
+
+    def createOperation(self, description):
+        '''
+        Returns a new operation, kills are added while canceling the commands (see Command.cancel) and sent with
+        send().
+        '''
+        operation = CancelOperation(self.nextId, description)
+        self.nextId += 1
+        self.operations[operation.id] = operation
+
+        finished = [op for op in self.operations.values() if op.done]
+        for op in finished[:max(0, len(finished) - singletonconfig.get('COMMUNICATION', 'CANCEL_HISTORY_SIZE', 100))]:
+            del self.operations[op.id]
+        return operation
+
+    def send(self, operation):
+        '''
+        Sends the kill requests added to the operation since the last call, e.g. at the end of each time slice.
+        '''
+        for renderNode, commandIds in operation.pendingKills.items():
+            if commandIds and renderNode not in operation.scheduledRenderNodes:
+                operation.scheduledRenderNodes.add(renderNode)
+                self.waiting.append((operation, renderNode))
+        self.sendRequests()
+
+    def complete(self, operation):
+        '''
+        Called once the commands of the operation have been canceled in the tree, or when the cancellation has been
+        interrupted by an error: sends the last kill requests, the operation is done once they are answered.
+        '''
+        operation.complete = True
+        self.send(operation)
+        self.checkDone(operation)
+
+    def sendRequests(self):
+        maxRequests = singletonconfig.get('COMMUNICATION', 'CANCEL_MAX_PARALLEL_REQUESTS', 50)
+        skipped = deque()
+        while self.waiting and self.requestsInProgress < maxRequests:
+            operation, renderNode = self.waiting.popleft()
+            if renderNode in self.busyRenderNodes:
+                # the render node is killing a command of another operation
+                skipped.append((operation, renderNode))
+                continue
+            self.sendKill(operation, renderNode)
+        self.waiting.extendleft(reversed(skipped))
+
+    def sendKill(self, operation, renderNode):
+        commandIds = operation.pendingKills[renderNode]
+        commandId = commandIds.popleft()
+        if commandIds:
+            # the next command of this render node is killed after this one
+            self.waiting.append((operation, renderNode))
+        else:
+            operation.scheduledRenderNodes.discard(renderNode)
+
+        operation.sentKills += 1
+        if renderNode.pullMode:
+            # the worker receives the kill order when it polls for its assignments
+            renderNode.queueKill(commandId)
+            operation.succeededKills += 1
+            self.checkDone(operation)
+            return
+
+        self.busyRenderNodes.add(renderNode)
+        self.requestsInProgress += 1
+        timeout = singletonconfig.get('COMMUNICATION', 'CANCEL_REQUEST_TIMEOUT', 5)
+        renderNode.requestAsync("DELETE", "/commands/%d/" % commandId, timeout=timeout,
+                                callback=partial(self.onKillResponse, operation, renderNode, commandId))
+
+    def onKillResponse(self, operation, renderNode, commandId, response):
+        self.busyRenderNodes.discard(renderNode)
+        self.requestsInProgress -= 1
+        if response.error:
+            LOGGER.warning("Impossible to kill command %d on %s (however command has already been canceled on the server): %s" % (commandId, renderNode.name, response.error))
+            operation.failedKills += 1
+            if len(operation.failures) < MAX_REPORTED_FAILURES:
+                operation.failures.append({'command': commandId, 'rendernode': renderNode.name, 'error': str(response.error)})
+        else:
+            operation.succeededKills += 1
+        self.checkDone(operation)
+        self.sendRequests()
+
+    def checkDone(self, operation):
+        if operation.done and operation.endTime is None:
+            operation.endTime = time.time()
+            LOGGER.info("Cancellation %d (%s) done in %.2f s: %d commands canceled, %d/%d kill requests failed" % (
+                operation.id, operation.description, operation.endTime - operation.startTime,
+                operation.canceledCommands, operation.failedKills, operation.totalKills))
@@ -12,9 +12,10 @@
 
 from sqlobject import (SQLObject, UnicodeCol, IntCol, FloatCol, DateTimeCol,
                        BoolCol, MultipleJoin, RelatedJoin, connectionForURI,
-                       ForeignKey, sqlhub)
+                       ForeignKey, DatabaseIndex, sqlhub)
 # from sqlobject.sqlbuilder import *
-from sqlobject.sqlbuilder import Insert, Update, IN, Select, Table, AND, INNERJOINOn, Delete
+from sqlobject.sqlbuilder import (Insert, Update, IN, Select, Table, AND, OR, LIKE, INNERJOINOn, LEFTJOINOn,
+                                  Delete, func)
 
 from collections import defaultdict
 import datetime
@@ -38,6 +39,13 @@ from octopus.core import singletonconfig
 LOGGER = logging.getLogger('main.dispatcher')
 
 
+def escapeLike(value):
+    '''
+    Escapes the wildcards of a value matched literally in a LIKE pattern (backslash is the default escape of mysql).
+    '''
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
 class FolderNodes(SQLObject):
     class sqlmeta:
         lazyUpdate = True
@@ -55,6 +63,9 @@ class FolderNodes(SQLObject):
     endTime = DateTimeCol()
     archived = BoolCol()
     dependencies = MultipleJoin('Dependencies')
+    # Indexes used by the queries on archived jobs
+    archivedJobsIndex = DatabaseIndex('archived', 'parentId')
+    userIndex = DatabaseIndex('user')
 
 
 class TaskNodes(SQLObject):
@@ -75,6 +86,9 @@ class TaskNodes(SQLObject):
     dependencies = MultipleJoin('Dependencies')
     # Adding autoretry capability on task
     maxAttempt = IntCol()
+    # Indexes used by the queries on archived jobs
+    archivedJobsIndex = DatabaseIndex('archived', 'parentId')
+    userIndex = DatabaseIndex('user')
 
 
 class Dependencies(SQLObject):
@@ -198,8 +212,15 @@ class RenderNodes(SQLObject):
 
 
 def createTables():
-    FolderNodes.createTable(ifNotExists=True)
-    TaskNodes.createTable(ifNotExists=True)
+    for table in (FolderNodes, TaskNodes):
+        tableExists = table.tableExists()
+        table.createTable(ifNotExists=True)
+        if tableExists:
+            # tables created by a previous version do not have the indexes yet
+            try:
+                table.createIndexes()
+            except Exception, e:
+                LOGGER.debug("Indexes of table %s not created: %r" % (table.sqlmeta.table, e))
     Dependencies.createTable(ifNotExists=True)
     TaskGroups.createTable(ifNotExists=True)
     Rules.createTable(ifNotExists=True)
@@ -628,6 +649,84 @@ class PuliDB(object):
     def getTimeStampFromDate(self, date):
         return time.mktime(date.timetuple()) if date else None
 
+    ## Returns a page of archived jobs (first level nodes, most recent first) and the number of matching jobs.
+    # Only reads the database: it can be called from another thread than the dispatcher loop.
+    # @param filters the constraints of the query, as given to /query (constraint_id, constraint_user,
+    #        constraint_name as a SQL "LIKE" pattern, constraint_prod, constraint_creationtime,
+    #        constraint_starttime, constraint_endtime)
+    # @param offset the number of jobs to skip
+    # @param limit the maximum number of jobs to return
+    #
+    def queryArchivedJobs(self, filters, offset, limit):
+        selects = []
+        total = 0
+        for nodeTable, taskTable, taskColumn in ((FolderNodes, TaskGroups, FolderNodes.q.taskGroupId),
+                                                 (TaskNodes, Tasks, TaskNodes.q.taskId)):
+            conn = nodeTable._connection
+            join = LEFTJOINOn(None, taskTable, taskColumn == taskTable.q.id)
+            where = self.getArchivedJobsClause(nodeTable, taskTable, filters)
+            total += conn.queryOne(conn.sqlrepr(Select([func.COUNT(nodeTable.q.id)], join=join, where=where)))[0]
+
+            fields = [nodeTable.q.id,
+                      nodeTable.q.name,
+                      nodeTable.q.user,
+                      nodeTable.q.priority,
+                      nodeTable.q.dispatchKey,
+                      nodeTable.q.maxRN,
+                      nodeTable.q.creationTime,
+                      nodeTable.q.startTime,
+                      nodeTable.q.updateTime,
+                      nodeTable.q.endTime,
+                      taskTable.q.tags]
+            selects.append(conn.sqlrepr(Select(fields, join=join, where=where)))
+
+        # the ids of folder and task nodes are unique among both tables: the page is read from their union, only the
+        # requested rows are sent by the database
+        conn = FolderNodes._connection
+        rows = conn.queryAll("%s ORDER BY id DESC LIMIT %d OFFSET %d" % (" UNION ALL ".join(selects), limit, offset))
+        jobs = []
+        for id, name, user, priority, dispatchKey, maxRN, creationTime, startTime, updateTime, endTime, tags in rows:
+            jobs.append({'id': id,
+                         'name': name,
+                         'user': user,
+                         'priority': priority,
+                         'dispatchKey': dispatchKey,
+                         'maxRN': maxRN,
+                         'creationTime': self.getTimeStampFromDate(creationTime),
+                         'startTime': self.getTimeStampFromDate(startTime),
+                         'updateTime': self.getTimeStampFromDate(updateTime),
+                         'endTime': self.getTimeStampFromDate(endTime),
+                         'tags': json.loads(tags) if tags else {},
+                         'archived': True})
+        return jobs, total
+
+    ## Returns the sql clause selecting the archived jobs of a node table matching the given filters.
+    # Raises a ValueError for invalid or unsupported constraints.
+    #
+    def getArchivedJobsClause(self, nodeTable, taskTable, filters):
+        clauses = [nodeTable.q.archived == True, nodeTable.q.parentId == 1]
+
+        if 'constraint_status' in filters:
+            raise ValueError("The status of archived jobs is not stored, constraint_status is not supported")
+        if 'constraint_id' in filters:
+            clauses.append(IN(nodeTable.q.id, [int(id) for id in filters['constraint_id']]))
+        if 'constraint_user' in filters:
+            clauses.append(IN(nodeTable.q.user, filters['constraint_user']))
+        if 'constraint_name' in filters:
+            clauses.append(OR(*[LIKE(nodeTable.q.name, name) for name in filters['constraint_name']]))
+        if 'constraint_prod' in filters:
+            # tags are stored as json dicts, the prod is matched literally
+            clauses.append(OR(*[LIKE(taskTable.q.tags, '%%%s%%' % escapeLike(json.dumps({'prod': prod})[1:-1])) for prod in filters['constraint_prod']]))
+
+        for constraint, column in (('constraint_creationtime', nodeTable.q.creationTime),
+                                   ('constraint_starttime', nodeTable.q.startTime),
+                                   ('constraint_endtime', nodeTable.q.endTime)):
+            if constraint in filters:
+                date = datetime.datetime.strptime(filters[constraint][0], "%Y-%m-%d %H:%M:%S")
+                clauses.append(column >= date)
+
+        return AND(*clauses)
+
     ## Restores the state of the dispatcher from the database.
     # @var tree the DispatchTree instance.
     #
@@ -12,6 +12,7 @@ import time
 from Queue import Queue
 from itertools import groupby, ifilter, chain
 import collections
+from functools import partial
 try:
     import simplejson as json
 except ImportError:
@@ -20,12 +21,12 @@ except ImportError:
 # from octopus.core import tools
 from octopus.core import singletonconfig, singletonstats
 
-from octopus.core.threadpool import ThreadPool, makeRequests, NoResultsPending
 from octopus.core.framework import MainLoopApplication
 from octopus.core.tools import elapsedTimeToString
 
 from octopus.dispatcher.model import (DispatchTree, FolderNode, RenderNode,
                                       Pool, PoolShare, enums)
+from octopus.dispatcher.model.rendernodeconnection import configureHttpClient
 from octopus.dispatcher.strategies import FifoStrategy
 
 from octopus.dispatcher import settings
@@ -34,6 +35,8 @@ from octopus.dispatcher.model.enums import *
 from octopus.dispatcher.poolman.filepoolman import FilePoolManager
 from octopus.dispatcher.poolman.wspoolman import WebServicePoolManager
 from octopus.dispatcher.licenses.licensemanager import LicenseManager
+from octopus.dispatcher.replica import SnapshotPublisher
+from octopus.dispatcher.cancellation import CancellationManager
 
 
 class Dispatcher(MainLoopApplication):
@@ -63,7 +66,8 @@ class Dispatcher(MainLoopApplication):
 
         MainLoopApplication.__init__(self, framework)
 
-        self.threadPool = ThreadPool(16, 0, 0, None)
+        # Requests to the render nodes are sent asynchronously from the IOLoop on keep-alive connections
+        configureHttpClient()
 
         #
         # Class holding custom infos on the dispatcher.
@@ -93,6 +97,9 @@ class Dispatcher(MainLoopApplication):
             LOGGER.warning("Total time elapsed %s" % elapsedTimeToString(prevTimer))
             LOGGER.warning("")
 
+        # rendernodes are linked to their pools in place when loaded, index them once everything is loaded
+        self.dispatchTree.renderNodeIndex.rebuild(self.dispatchTree.renderNodes.values())
+
         LOGGER.warning("--- Checking dispatcher state (3 steps) ---")
         startTimer = time.time()
         LOGGER.warning("1/3 Update completion and status")
@@ -130,6 +137,15 @@ class Dispatcher(MainLoopApplication):
         # it should be better to have a maxsize
         self.queue = Queue(maxsize=10000)
 
+        # periodic snapshots of the tree for the read-only query replicas (if any configured)
+        self.snapshotPublisher = SnapshotPublisher(self)
+
+        # kill requests sent to the render nodes when jobs are canceled
+        self.cancellationManager = CancellationManager()
+
+        # updates received from the workers, applied at the beginning of the next cycle (latest update wins)
+        self.pendingCommandUpdates = collections.OrderedDict()
+
     def initPoolsDataFromBackend(self):
         '''
         Loads pools and workers from appropriate backend.
@@ -262,16 +278,13 @@ class Dispatcher(MainLoopApplication):
         log.info("-----------------------------------------------------")
         log.info(" Start dispatcher process cycle (old version).")
 
-        try:
-            self.threadPool.poll()
-        except NoResultsPending:
-            pass
-        else:
-            log.info("finished some network requests")
-            pass
-
         self.cycle += 1
 
+        # Apply the command updates received from the workers since the previous cycle
+        self.applyPendingCommandUpdates()
+        log.info("%8.2f ms --> apply command updates" % ((time.time() - prevTimer) * 1000))
+        prevTimer = time.time()
+
         # Update of allocation is done when parsing the tree for completion and status update (done partially for invalidated node only i.e. when needed)
         self.dispatchTree.updateCompletionAndStatus()
         if singletonconfig.get('CORE', 'GET_STATS'):
@@ -322,6 +335,11 @@ class Dispatcher(MainLoopApplication):
         log.info("%8.2f ms --> releaseFinishingStatus" % ((time.time() - prevTimer) * 1000))
         prevTimer = time.time()
 
+        # feed the query replicas
+        self.snapshotPublisher.publish()
+        log.info("%8.2f ms --> publish snapshot" % ((time.time() - prevTimer) * 1000))
+        prevTimer = time.time()
+
         loopDuration = (time.time() - loopStartTime)*1000
         log.info("%8.2f ms --> cycle ended. " % loopDuration)
 
@@ -359,7 +377,7 @@ class Dispatcher(MainLoopApplication):
         # don't proceed to the calculation if no rns availables in the requested pools
         rnsBool = False
         for pool, nodesiterator in groupby(entryPoints, lambda x: x.poolShares.values()[0].pool):
-            rnsAvailables = set([rn for rn in pool.renderNodes if rn.status not in [RN_UNKNOWN, RN_PAUSED, RN_WORKING]])
+            rnsAvailables = set([rn for rn in pool.renderNodes if rn.status not in [RN_UNKNOWN, RN_PAUSED, RN_WORKING] or rn.isAvailable()])
             if len(rnsAvailables):
                 rnsBool = True
 
@@ -466,10 +484,8 @@ class Dispatcher(MainLoopApplication):
 
                     for (rn, com) in entryPoint.dispatchIterator(lambda: self.queue.qsize() > 0):
                         assignments.append((rn, com))
-                        # increment the allocatedRN for the poolshare
-                        poolShare.allocatedRN += 1
-                        # save the active poolshare of the rendernode
-                        rn.currentpoolshare = poolShare
+                        # increment the allocatedRN for the poolshare and save the active poolshare of the command
+                        rn.setCommandPoolShare(com, poolShare)
 
                 except NoRenderNodeAvailable:
                     pass
@@ -504,70 +520,129 @@ class Dispatcher(MainLoopApplication):
     def updateRenderNodes(self):
         for rendernode in self.dispatchTree.renderNodes.values():
             rendernode.updateStatus()
+            if not rendernode.pullMode and rendernode.health.needsProbe():
+                rendernode.probe()
 
     def sendAssignments(self, assignmentList):
-        '''Processes a list of (rendernode, command) assignments.'''
-
-        def sendAssignment(args):
-            rendernode, commands = args
-            failures = []
+        '''Processes a list of (rendernode, commands) assignments.
+        All the commands assigned to a rendernode are sent in a single request (/commands/batch/ on the worker), the
+        part of the payload shared by the commands of a task is computed once per task (see Task.getAssignmentPayload).
+        The requests are sent asynchronously, their results are handled in the IOLoop between two cycles.
+        '''
+        log = logging.getLogger('assign')
+        for rendernode, commands in assignmentList:
             for command in commands:
-                headers = {}
-                if not rendernode.idInformed:
-                    headers["rnId"] = rendernode.id
-                root = command.task
-                ancestors = [root]
-                while root.parent:
-                    root = root.parent
-                    ancestors.append(root)
-                arguments = {}
-                environment = {
-                    'PULI_USER': command.task.user,
-                    'PULI_ALLOCATED_MEMORY': unicode(rendernode.usedRam[command.id]),
-                    'PULI_ALLOCATED_CORES': unicode(rendernode.usedCoresNumber[command.id]),
-                }
-                for ancestor in ancestors:
-                    arguments.update(ancestor.arguments)
-                    environment.update(ancestor.environment)
-                arguments.update(command.arguments)
-
-                log = logging.getLogger('assign')
                 log.info("Sending command: %d from task %s to %s" % (command.id, command.task.name, rendernode))
 
-                commandDict = {
-                    "id": command.id,
-                    "runner": str(command.task.runner),
-                    "arguments": arguments,
-                    "validationExpression": command.task.validationExpression,
-                    "taskName": command.task.name,
-                    "relativePathToLogDir": "%d" % command.task.id,
-                    "environment": environment,
-                    "runnerPackages": command.runnerPackages,
-                    "watcherPackages": command.watcherPackages
-                }
-                body = json.dumps(commandDict)
-                headers["Content-Length"] = len(body)
-                headers["Content-Type"] = "application/json"
+            if rendernode.pullMode:
+                # the worker polls for its assignments (see RenderNodeAssignmentsResource)
+                rendernode.queuePulledAssignments(commands)
+            elif len(commands) > 1 and rendernode.acceptsBatchAssignments:
+                self.sendBatchAssignment(rendernode, commands)
+            else:
+                for command in commands:
+                    self.sendAssignment(rendernode, command)
+
+    def getAssignmentHeaders(self, rendernode):
+        headers = {"Content-Type": "application/json"}
+        if not rendernode.idInformed:
+            headers["rnId"] = rendernode.id
+        return headers
+
+    def getCommandPayload(self, rendernode, command):
+        '''Returns the part of an assignment specific to the command, the task part is given by Task.getAssignmentPayload'''
+        return {
+            "id": command.id,
+            "arguments": command.arguments,
+            "environment": {
+                'PULI_ALLOCATED_MEMORY': unicode(rendernode.usedRam[command.id]),
+                'PULI_ALLOCATED_CORES': unicode(rendernode.usedCoresNumber[command.id]),
+            },
+            "runnerPackages": command.runnerPackages,
+            "watcherPackages": command.watcherPackages
+        }
+
+    def sendAssignment(self, rendernode, command):
+        taskPayload = command.task.getAssignmentPayload()
+        commandPayload = self.getCommandPayload(rendernode, command)
+
+        commandDict = dict(taskPayload)
+        commandDict.update(commandPayload)
+        commandDict["arguments"] = dict(taskPayload["arguments"])
+        commandDict["arguments"].update(commandPayload["arguments"])
+        commandDict["environment"] = dict(commandPayload["environment"])
+        commandDict["environment"].update(taskPayload["environment"])
+
+        body = json.dumps(commandDict)
+        rendernode.requestAsync("POST", "/commands/", body, self.getAssignmentHeaders(rendernode), partial(self._assignmentSent, rendernode, command))
+
+    def sendBatchAssignment(self, rendernode, commands):
+        body = json.dumps(self.getBatchAssignmentPayload(rendernode, commands))
+        rendernode.requestAsync("POST", "/commands/batch/", body, self.getAssignmentHeaders(rendernode), partial(self._batchAssignmentSent, rendernode, commands))
+
+    def getBatchAssignmentPayload(self, rendernode, commands):
+        '''Returns the assignment of several commands, the task part is given once per task'''
+        tasks = {}
+        commandDicts = []
+        for command in commands:
+            taskKey = str(command.task.id)
+            if taskKey not in tasks:
+                tasks[taskKey] = command.task.getAssignmentPayload()
+            commandDict = self.getCommandPayload(rendernode, command)
+            commandDict["task"] = taskKey
+            commandDicts.append(commandDict)
+        return {"tasks": tasks, "commands": commandDicts}
+
+    def _assignmentSent(self, rendernode, command, response):
+        if response.code == 202:
+            logging.getLogger('main.dispatcher').info("Sent assignment of command %d to worker %s", command.id, rendernode.name)
+            return
 
-                try:
-                    resp, data = rendernode.request("POST", "/commands/", body, headers)
-                    if not resp.status == 202:
-                        logging.getLogger('main.dispatcher').error("Assignment request failed: command %d on worker %s", command.id, rendernode.name)
-                        failures.append((rendernode, command))
-                    else:
-                        logging.getLogger('main.dispatcher').info("Sent assignment of command %d to worker %s", command.id, rendernode.name)
-                except rendernode.RequestFailed, e:
-                    logging.getLogger('main.dispatcher').error("Assignment of command %d to worker %s failed. Worker is likely dead (%r)", command.id, rendernode.name, e)
-                    failures.append((rendernode, command))
-            return failures
+        if response.code == 599:
+            logging.getLogger('main.dispatcher').error("Assignment of command %d to worker %s failed. Worker is likely dead (%r)", command.id, rendernode.name, response.error)
+        else:
+            logging.getLogger('main.dispatcher').error("Assignment request failed: command %d on worker %s", command.id, rendernode.name)
+        self._assignmentFailed([(rendernode, command)])
+
+    def _batchAssignmentSent(self, rendernode, commands, response):
+        if response.code == 404:
+            # worker of a previous version, send the commands one by one
+            logging.getLogger('main.dispatcher').warning("Worker %s does not accept batch assignments", rendernode.name)
+            rendernode.acceptsBatchAssignments = False
+            for command in commands:
+                if command.renderNode is rendernode and command.status == CMD_ASSIGNED:
+                    self.sendAssignment(rendernode, command)
+            return
+
+        if response.code == 200:
+            refused = set(json.loads(response.body).get('refused', []))
+            for command in commands:
+                if command.id in refused:
+                    logging.getLogger('main.dispatcher').error("Assignment request failed: command %d on worker %s", command.id, rendernode.name)
+                else:
+                    logging.getLogger('main.dispatcher').info("Sent assignment of command %d to worker %s", command.id, rendernode.name)
+            self._assignmentFailed([(rendernode, command) for command in commands if command.id in refused])
+            return
+
+        if response.code == 599:
+            logging.getLogger('main.dispatcher').error("Assignment of %d commands to worker %s failed. Worker is likely dead (%r)", len(commands), rendernode.name, response.error)
+        else:
+            logging.getLogger('main.dispatcher').error("Assignment request failed: %d commands on worker %s", len(commands), rendernode.name)
+        self._assignmentFailed([(rendernode, command) for command in commands])
 
-        requests = makeRequests(sendAssignment, [[a, b] for (a, b) in assignmentList], self._assignmentFailed)
-        for request in requests:
-            self.threadPool.putRequest(request)
+    def pulledAssignmentsRefused(self, rendernode, commandIds):
+        '''Called when a worker in pull mode reports the commands it could not start'''
+        commands = self.dispatchTree.commands
+        for commandId in commandIds:
+            logging.getLogger('main.dispatcher').error("Assignment request failed: command %r on worker %s", commandId, rendernode.name)
+        self._assignmentFailed([(rendernode, commands[commandId]) for commandId in commandIds if commandId in commands])
 
-    def _assignmentFailed(self, request, failures):
+    def _assignmentFailed(self, failures):
         for assignment in failures:
             rendernode, command = assignment
+            if command.renderNode is not rendernode or command.status != CMD_ASSIGNED:
+                # the command has been cancelled or reassigned in the meantime
+                continue
             rendernode.clearAssignment(command)
             command.clearAssignment()
 
@@ -597,10 +672,10 @@ class Dispatcher(MainLoopApplication):
         logging.getLogger('main.dispatcher').info('Added graph "%s" to the model.' % graph['name'])
         return nodes
 
-    def updateCommandApply(self, dct):
+    def getUpdatedCommand(self, dct):
         '''
-        Called from a RN with a json desc of a command (ie rendernode info, command info etc).
-        Raise an execption to tell caller to send a HTTP404 response to RN, if not error a HTTP200 will be send instead
+        Returns the command targeted by an update sent by a RN.
+        Raises a KeyError if the command is unknown or not assigned to this RN anymore.
         '''
         log = logging.getLogger('main.dispatcher')
         commandId = dct['id']
@@ -622,6 +697,65 @@ class Dispatcher(MainLoopApplication):
             log.warning("The emitting RN %s is different from the RN assigned to the command in pulimodel: %s." % (renderNodeName, command.renderNode.name))
             raise KeyError("Command %d is running on a different rendernode (%s) than the one in puli's model (%s)." % (commandId, renderNodeName, command.renderNode.name))
 
+        return command
+
+    def queueCommandUpdate(self, dct):
+        '''
+        Called from a RN with a json desc of a command update, see updateCommandApply.
+        The update is checked at once (a KeyError is raised to tell the caller to send a HTTP404 response to the RN) but
+        only applied at the beginning of the next cycle: several updates of the same command received between two
+        cycles are merged, the latest values win.
+        Terminal updates (DONE or ERROR) are applied immediately, as well as every update when the coalescing is
+        disabled (CORE.COALESCE_COMMAND_UPDATES).
+        '''
+        command = self.getUpdatedCommand(dct)
+
+        pending = self.pendingCommandUpdates.pop(command.id, None)
+        if pending is not None:
+            # stats are only sent when they have changed on the worker
+            if dct.get('stats') is None and pending.get('stats') is not None:
+                dct['stats'] = pending['stats']
+            pending.update(dct)
+            dct = pending
+
+        if not singletonconfig.get('CORE', 'COALESCE_COMMAND_UPDATES', True) or self.isTerminalUpdate(dct):
+            self.updateCommandApply(dct)
+        else:
+            self.pendingCommandUpdates[command.id] = dct
+
+    def isTerminalUpdate(self, dct):
+        if dct.get('validatorMessage'):
+            return True
+        return 'status' in dct and int(dct['status']) in (enums.CMD_DONE, enums.CMD_ERROR)
+
+    def applyPendingCommandUpdates(self):
+        '''
+        Applies the command updates queued since the previous cycle. An update is ignored if the command has been
+        canceled, removed or reassigned in the meantime.
+        '''
+        log = logging.getLogger('main.dispatcher')
+        pendingCommandUpdates = self.pendingCommandUpdates
+        self.pendingCommandUpdates = collections.OrderedDict()
+        for commandId, dct in pendingCommandUpdates.iteritems():
+            command = self.dispatchTree.commands.get(commandId)
+            if command is not None and command.status == enums.CMD_CANCELED:
+                continue
+            try:
+                self.updateCommandApply(dct)
+            except KeyError, e:
+                log.warning("Pending update of command %d ignored: %s" % (dct['id'], e))
+            except Exception:
+                log.exception("Exception during update of command %d" % dct['id'])
+
+    def updateCommandApply(self, dct):
+        '''
+        Called from a RN with a json desc of a command (ie rendernode info, command info etc).
+        Raise an execption to tell caller to send a HTTP404 response to RN, if not error a HTTP200 will be send instead
+        '''
+        log = logging.getLogger('main.dispatcher')
+        commandId = dct['id']
+
+        command = self.getUpdatedCommand(dct)
         rn = command.renderNode
         rn.lastAliveTime = max(time.time(), rn.lastAliveTime)
 
@@ -630,6 +764,7 @@ class Dispatcher(MainLoopApplication):
             if len(rn.commands) == 0 and command.status is not enums.CMD_CANCELED:
                 # in this case, re-add the command to the list of the rendernode
                 rn.commands[commandId] = command
+                rn.invalidateRepr()
                 # we should re-reserve the lic
                 rn.reserveLicense(command, self.licenseManager)
                 log.warning("re-assigning command %d on %s. (TIMEOUT?)" % (commandId, rn.name))
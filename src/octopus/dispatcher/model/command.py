@@ -132,27 +132,36 @@ class Command(models.Model):
         self.startTime = time.time()
         self.status = CMD_ASSIGNED
 
-    def cancel(self):
+    def cancel(self, operation=None):
         """
         | Method called when changing node status via "nodes/id/status" webservice.
-        | The calling webservice is made asynchronous to avoid blocking when RN node request encounter a timeout error
+        | The kill request is sent asynchronously to the RN, the command is canceled without waiting for the answer.
         | If a RN can not be reached, its command assignement is reseted and RN is marked as "quarantine"
+
+        :param operation: a CancelOperation, when given the kill request is added to the operation instead of being sent
         """
         if self.status in (CMD_FINISHING, CMD_DONE, CMD_CANCELED):
             return
         elif self.status == CMD_RUNNING:
-            try:
-                self.renderNode.clearAssignment(self)
-                (response, data) = self.renderNode.request("DELETE", "/commands/" + str(self.id) + "/")
-
-            except Exception:
-                # if request has failed, it means the rendernode is unreachable
-                LOGGER.error("Impossible to reach RN %s to cancel command %d." % (self.renderNode, self.id))
-                self.status = CMD_CANCELED
+            renderNode = self.renderNode
+            renderNode.clearAssignment(self)
+
+            if operation is not None:
+                operation.addKill(renderNode, self.id)
+            elif renderNode.pullMode:
+                renderNode.queueKill(self.id)
+            else:
+                def onResponse(response):
+                    if response.error:
+                        # if request has failed, it means the rendernode is unreachable
+                        LOGGER.error("Impossible to reach RN %s to cancel command %d." % (renderNode, self.id))
+                renderNode.requestAsync("DELETE", "/commands/" + str(self.id) + "/", callback=onResponse)
 
         elif self.renderNode is not None:
             self.renderNode.clearAssignment(self)
         self.status = CMD_CANCELED
+        if operation is not None:
+            operation.canceledCommands += 1
 
     def setDoneStatus(self):
         """
@@ -165,15 +174,18 @@ class Command(models.Model):
         if self.status in (CMD_FINISHING, CMD_DONE, CMD_CANCELED):
             return
         elif self.status == CMD_RUNNING:
-            pass
-            try:
-                self.renderNode.clearAssignment(self)
-                (response, data) = self.renderNode.request("POST", "/commands/" + str(self.id) + "/done")
-                LOGGER.debug("data: %r" % data)
-            except Exception:
-                # if request has failed, it means the rendernode is unreachable
-                LOGGER.warning("Impossible to cancel command %d on the RN: %s" % (self.id, self.renderNode.name))
-                self.status = CMD_CANCELED
+            renderNode = self.renderNode
+            renderNode.clearAssignment(self)
+
+            if renderNode.pullMode:
+                # the worker is not reachable, it stops the command when it receives the kill order with its next poll
+                renderNode.queueKill(self.id)
+            else:
+                def onResponse(response):
+                    if response.error:
+                        # if request has failed, it means the rendernode is unreachable
+                        LOGGER.warning("Impossible to cancel command %d on the RN: %s" % (self.id, renderNode.name))
+                renderNode.requestAsync("POST", "/commands/" + str(self.id) + "/done", body="", callback=onResponse)
 
         elif self.renderNode is not None:
             self.renderNode.clearAssignment(self)
@@ -181,8 +193,10 @@ class Command(models.Model):
 
     def setReadyAndKill(self):
         if self.renderNode is not None:
-            self.renderNode.request("DELETE", "/commands/" + str(self.id) + "/")
-            # FIXME test the return value of this request ?
+            if self.renderNode.pullMode:
+                self.renderNode.queueKill(self.id)
+            else:
+                self.renderNode.requestAsync("DELETE", "/commands/" + str(self.id) + "/")
             self.renderNode.reset()
         self.setReadyStatusAndClear()
 
@@ -267,6 +281,8 @@ class CommandDatesUpdater(object):
         cmd.updateTime = time.time()
         # append the command's status to the rendernode's history
         if isFinalStatus(cmd.status):
+            if cmd.renderNode is not None and hasattr(cmd.renderNode, 'health'):
+                cmd.renderNode.health.commandFinished(cmd.status == CMD_ERROR)
             # only if we don't already have a command for this task
             if hasattr(cmd.renderNode, 'tasksHistory') and cmd.task.id not in cmd.renderNode.tasksHistory:
                 cmd.renderNode.tasksHistory.append(cmd.task.id)
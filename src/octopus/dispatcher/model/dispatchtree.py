@@ -7,12 +7,16 @@ from weakref import WeakValueDictionary
 
 from octopus.dispatcher.model import FolderNode, TaskNode, Pool, RenderNode, Task, TaskGroup, Command, PoolShare
 from octopus.dispatcher.model.node import BaseNode
+from octopus.dispatcher.model.rendernodeindex import RenderNodeIndex
 from octopus.dispatcher.strategies import FifoStrategy, loadStrategyClass
 from octopus.core.enums.command import *
 from octopus.dispatcher.rules import RuleError
 
 logger = logging.getLogger('main.dispatcher.dispatchtree')
 
+# Fields of tasks and taskgroups merged in the payload sent to the workers (see Task.getAssignmentPayload)
+ASSIGNMENT_PAYLOAD_FIELDS = ('name', 'parent', 'user', 'runner', 'arguments', 'environment', 'validationExpression')
+
 
 def splitpath(path):
     import urllib
@@ -55,6 +59,7 @@ class DispatchTree(object):
         self.rules = []
         self.poolShares = {}
         self.commands = {}
+        self.renderNodeIndex = RenderNodeIndex()
         # deduced properties
         self.nodeMaxId = 0
         self.poolMaxId = 0
@@ -75,6 +80,9 @@ class DispatchTree(object):
         self.commandListener = ObjectListener(onCreationEvent=self.onCommandCreation, onChangeEvent=self.onCommandChange)
         self.poolShareListener = ObjectListener(self.onPoolShareCreation)
         self.modifiedNodes = []
+        # commands and tasks modified during a bulk update (None outside of a bulk update)
+        self.bulkModifiedCommands = None
+        self.bulkModifiedTasks = None
 
     def registerModelListeners(self):
         BaseNode.changeListeners.append(self.nodeListener)
@@ -334,6 +342,25 @@ class DispatchTree(object):
         self.toModifyElements = []
         self.toArchiveElements = []
 
+    def beginBulkUpdate(self):
+        '''
+        Starts coalescing command changes: until endBulkUpdate() is called, a modified command is recorded once for
+        the DB and the nodes of its task are invalidated once, whatever the number of changes.
+        '''
+        self.bulkModifiedCommands = set()
+        self.bulkModifiedTasks = set()
+
+    def endBulkUpdate(self):
+        if self.bulkModifiedCommands is None:
+            return
+        commands, tasks = self.bulkModifiedCommands, self.bulkModifiedTasks
+        self.bulkModifiedCommands = None
+        self.bulkModifiedTasks = None
+        self.toModifyElements.extend(commands)
+        for task in tasks:
+            for node in task.nodes.values():
+                node.invalidate()
+
     ## Recalculates the max ids of all elements. Generally called after a reload from db.
     #
     def recomputeMaxIds(self):
@@ -436,6 +463,8 @@ class DispatchTree(object):
         """
         if field == "tags":
             self.toModifyElements.append(task)
+        elif field in ASSIGNMENT_PAYLOAD_FIELDS:
+            task.invalidateAssignmentPayload()
 
     ### methods called after interaction with a BaseNode
 
@@ -472,8 +501,10 @@ class DispatchTree(object):
         else:
             self.renderNodeMaxId = max(self.renderNodeMaxId, renderNode.id)
         self.renderNodes[renderNode.name] = renderNode
+        self.renderNodeIndex.add(renderNode)
 
     def onRenderNodeDestruction(self, rendernode):
+        self.renderNodeIndex.remove(rendernode)
         try:
             del self.renderNodes[rendernode.name]
             self.toArchiveElements.append(rendernode)
@@ -482,6 +513,7 @@ class DispatchTree(object):
             logger.warning("RN %s seems to have been deleted already." % rendernode.name)
 
     def onRenderNodeChange(self, rendernode, field, oldvalue, newvalue):
+        self.renderNodeIndex.update(rendernode, field)
         if field == "performance":
             self.toModifyElements.append(rendernode)
 
@@ -516,6 +548,11 @@ class DispatchTree(object):
         self.commands[command.id] = command
 
     def onCommandChange(self, command, field, oldvalue, newvalue):
+        if self.bulkModifiedCommands is not None:
+            self.bulkModifiedCommands.add(command)
+            if command.task is not None:
+                self.bulkModifiedTasks.add(command.task)
+            return
         self.toModifyElements.append(command)
         if command.task is not None:
             for node in command.task.nodes.values():
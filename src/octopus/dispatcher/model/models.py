@@ -76,11 +76,36 @@ class Model(object):
             except Exception:
                 import logging
                 logging.getLogger("main.model").exception("error while running event listener")
+        elif not name.startswith('_'):
+            # non-field attributes (counters, flags...) are also exposed by the webservice
+            self.invalidateRepr()
+
+    def getCachedRepr(self, key, builder):
+        '''
+        Returns the serialized representation identified by `key`, building it with `builder(self)` if
+        it is not cached yet. The cache is dropped each time an attribute of the instance is set or a change
+        event is fired. Code modifying a field in place must call invalidateRepr() itself.
+        '''
+        cache = self.__dict__.get('_reprCache')
+        if cache is None:
+            cache = self.__dict__['_reprCache'] = {}
+        try:
+            return cache[key]
+        except KeyError:
+            value = cache[key] = builder(self)
+            return value
 
-    def to_json(self):
+    def invalidateRepr(self):
+        self.__dict__['_reprCache'] = None
+
+    def _buildJson(self):
         self.validate()
         return dict((field.name, field.to_json(self)) for field in self.FIELDS.values())
 
+    def to_json(self):
+        # shallow copy: subclasses add their own keys to the returned dict
+        return dict(self.getCachedRepr('json', Model._buildJson))
+
     def validate(self):
         for field in self.FIELDS.values():
             field.validate_instance(self)
@@ -104,6 +129,7 @@ class Model(object):
 
     @classmethod
     def fireChangeEvent(cls, obj, field, oldvalue, newvalue):
+        obj.invalidateRepr()
         if not hasattr(obj, "_changeReady") or not obj._changeReady:
             return
         for base in obj.__class__.__mro__:
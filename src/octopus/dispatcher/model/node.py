@@ -146,6 +146,7 @@ class BaseNode(models.Model):
         val = [node, acceptedStatus]
         if not val in self.dependencies:
             self.dependencies.append(val)
+            self.invalidateRepr()
             if self not in node.reverseDependencies:
                 node.reverseDependencies.append(self)
 
@@ -188,6 +189,7 @@ class BaseNode(models.Model):
         if parent:
                 parent.addChild(self, False)
         self.__dict__['parent'] = parent
+        self.invalidateRepr()
 
     def dispatchIterator(self):
         raise NotImplementedError
@@ -283,6 +285,7 @@ class FolderNode(BaseNode):
 
     def fireChildAddedEvent(self, child):
         self.invalidate()
+        self.invalidateRepr()
         for l in self.changeListeners:
             try:
                 l.onChildAddedEvent(self, child)
@@ -291,6 +294,7 @@ class FolderNode(BaseNode):
 
     def fireChildRemovedEvent(self, child):
         self.invalidate()
+        self.invalidateRepr()
         for l in self.changeListeners:
             try:
                 l.onChildRemovedEvent(self, child)
@@ -559,10 +563,10 @@ class TaskNode(BaseNode):
             ep = self
 
         for poolshare in [poolShare for poolShare in ep.poolShares.values() if poolShare.hasRenderNodesAvailable()]:
-            # first, sort the rendernodes according their performance value
-            rnList = sorted(poolshare.pool.renderNodes, key=lambda rn: rn.performance, reverse=True)
+            # first, sort the rendernodes according their performance value, then their health
+            rnList = sorted(poolshare.pool.renderNodes, key=lambda rn: (rn.performance, rn.health.score()), reverse=True)
             for rendernode in rnList:
-                if rendernode.isAvailable() and rendernode.canRun(command):
+                if rendernode.isAvailable() and rendernode.canFit(command) and rendernode.canRun(command):
                     if rendernode.reserveLicense(command, self.dispatcher.licenseManager):
                         rendernode.addAssignment(command)
                         return rendernode
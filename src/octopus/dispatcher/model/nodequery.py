@@ -10,6 +10,8 @@ import re
 from datetime import datetime
 from tornado.web import HTTPError
 
+from octopus.dispatcher.model.rendernodeindex import RenderNodeQueryPlan
+
 __all__ = []
 
 logger = logging.getLogger('main.dispatcher.webservice')
@@ -164,70 +166,14 @@ class IQueryNode:
 
           The resulting list will contain all rn from user 'jsa' or 'render', having the status '1' or '2'
           i.e.: (user == jsa OR user == render) AND (status == 1 OR status == 2)
-        """
-
-        # if 'constraint_id' in pFilterArgs:
-        #     filteredIds = [int(id) for id in pFilterArgs['constraint_id']]
-        #     pNodes = [child for child in pNodes if child.id in filteredIds]
-        #     logger.info( "-- Filtering on id list %s, nb remaining nodes: %d", pFilterArgs['constraint_id'], len(pNodes) )
 
-        if 'constraint_status' in pFilterArgs:
-            statusList = [int(status) for status in pFilterArgs['constraint_status']]
-            pNodes = [child for child in pNodes if child.status in statusList]
-            logger.info("-- Filtering on status %s, nb remaining render nodes: %d", pFilterArgs['constraint_status'], len(pNodes))
-
-        # if 'constraint_user' in pFilterArgs:
-        #     pNodes = [child for child in pNodes if child.user in pFilterArgs['constraint_user']]
-        #     logger.info( "-- Filtering on user %s, nb remaining nodes: %d", pFilterArgs['constraint_user'], len(pNodes) )
-
-        # WARNING: regexp matching constraint can take some time
-        # TO IMPROVE
-        if 'constraint_name' in pFilterArgs:
-            nameRegex = '|'.join(pFilterArgs['constraint_name'])
-            pNodes = [child for child in pNodes if re.match(nameRegex, child.name)]
-            logger.info("-- Filtering on name %s, nb remaining render nodes: %d", pFilterArgs['constraint_name'], len(pNodes))
-
-        if 'constraint_speed' in pFilterArgs:
-            cpuspeedFilters = pFilterArgs['constraint_speed']
-            for cpuspeed in cpuspeedFilters:
-                if cpuspeed[0] == '+':
-                    cpuspeed = float(cpuspeed[1:])
-                    pNodes = [child for child in pNodes if cpuspeed < child.speed]
-                elif cpuspeed[0] == '-':
-                    cpuspeed = float(cpuspeed[1:])
-                    pNodes = [child for child in pNodes if child.speed < cpuspeed]
-                else:
-                    pNodes = [child for child in pNodes if child.speed == float(cpuspeed)]
-            logger.info("-- Filtering on cpu speed %s, nb remaining render nodes: %d", pFilterArgs['constraint_speed'], len(pNodes))
-
-        if 'constraint_ramsize' in pFilterArgs:
-            ramFilters = pFilterArgs['constraint_ramsize']
-
-            for ram in ramFilters:
-                if ram[0] == '+':
-                    ram = int(ram[1:])
-                    pNodes = [child for child in pNodes if ram < child.ramSize]
-                elif ram[0] == '-':
-                    ram = int(ram[1:])
-                    pNodes = [child for child in pNodes if child.ramSize < ram]
-                else:
-                    pNodes = [child for child in pNodes if child.ramSize == int(ram)]
-            logger.info("-- Filtering on ramsize %s, nb remaining render nodes: %d", pFilterArgs['constraint_ramsize'], len(pNodes))
-
-        if 'constraint_coresnumber' in pFilterArgs:
-            coreFilters = pFilterArgs['constraint_coresnumber']
-
-            for core in coreFilters:
-                if core[0] == '+':
-                    core = int(core[1:])
-                    pNodes = [child for child in pNodes if core < child.coresNumber]
-                elif core[0] == '-':
-                    core = int(core[1:])
-                    pNodes = [child for child in pNodes if child.coresNumber < core]
-                else:
-                    pNodes = [child for child in pNodes if child.coresNumber == int(core)]
-            logger.info("-- Filtering on coresNumber %s, nb remaining render nodes: %d", pFilterArgs['constraint_coresnumber'], len(pNodes))
+        The filter is compiled into predicates (see rendernodeindex module). To query all the render nodes of the
+        dispatcher, prefer DispatchTree.renderNodeIndex.select() which uses the indexes.
+        """
 
+        plan = RenderNodeQueryPlan(pFilterArgs)
+        pNodes = plan.filter(pNodes)
+        logger.info("-- Filtering on %s, nb remaining render nodes: %d", [name for name in pFilterArgs if name.startswith('constraint_')], len(pNodes))
         return pNodes
 
     def compareTS(self, operator, date1, date2):
@@ -66,6 +66,7 @@ class PoolShare(models.Model):
         # remove any previous poolshare on this node
         self.node.poolShares = WeakKeyDictionary()
         self.node.poolShares[self.pool] = self
+        self.node.invalidateRepr()
 
         # the default maxRN at the creation is -1, if it is a different value, it means it's user defined
         if self.maxRN != -1:
@@ -73,6 +74,12 @@ class PoolShare(models.Model):
         else:
             self.userDefinedMaxRN = False
 
+    def __setattr__(self, name, value):
+        models.Model.__setattr__(self, name, value)
+        if name in ('maxRN', 'userDefinedMaxRN') and self.__dict__.get('node') is not None:
+            # the node exposes the maxRN of its poolshare in its own representations
+            self.node.invalidateRepr()
+
     def hasRenderNodesAvailable(self):
         if 0 < self.maxRN and self.maxRN <= self.allocatedRN:
             return False
@@ -109,6 +116,7 @@ class Pool(models.Model):
     def addRenderNode(self, rendernode):
         if self not in rendernode.pools:
             rendernode.pools.append(self)
+            rendernode.fireChangeEvent(rendernode, "pools", [], rendernode.pools)
         if rendernode not in self.renderNodes:
             self.renderNodes.append(rendernode)
         self.fireChangeEvent(self, "renderNodes", [], self.renderNodes)
@@ -119,6 +127,7 @@ class Pool(models.Model):
     def removeRenderNode(self, rendernode):
         if self in rendernode.pools:
             rendernode.pools.remove(self)
+            rendernode.fireChangeEvent(rendernode, "pools", [], rendernode.pools)
         if rendernode in self.renderNodes:
             self.renderNodes.remove(rendernode)
         self.fireChangeEvent(self, "renderNodes", [], self.renderNodes)
@@ -9,20 +9,24 @@
 #
 ####################################################################################################
 
-import httplib as http
 import time
 import datetime
 import logging
-import errno
 import requests
 from collections import deque
+from functools import partial
 import simplejson as json
 
+from tornado.ioloop import IOLoop
+from tornado.httpclient import HTTPRequest, HTTPResponse
+
 from octopus.dispatcher.model.enums import *
 from octopus.dispatcher import settings
 from octopus.core import singletonconfig
 
 from . import models
+from .rendernodeconnection import RenderNodeConnectionPool, RenderNodeRequestQueue, isClientQueueTimeout
+from .rendernodehealth import RenderNodeHealth
 
 LOGGER = logging.getLogger('main.dispatcher.webservice')
 logging.getLogger('requests.packages.urllib3.connectionpool').setLevel(logging.WARNING)
@@ -93,9 +97,19 @@ class RenderNode(models.Model):
         self.idInformed = False
         self.isRegistered = False
         self.lastAliveTime = 0
-        self.httpConnection = None
+        self.connections = RenderNodeConnectionPool(self.host, self.port)
+        self.requestQueue = RenderNodeRequestQueue(self.connections)
+        self.health = RenderNodeHealth()
+        # cleared when the worker does not know the batch assignment protocol
+        self.acceptsBatchAssignments = True
+        # set when the worker polls for its assignments instead of receiving them (it might not be reachable)
+        self.pullMode = False
+        self.pendingAssignments = []
+        self.pendingKills = []
+        self.assignmentWaiter = None
         self.caracteristics = caracteristics if caracteristics else {}
-        self.currentpoolshare = None
+        # poolshare of each assigned command, see setCommandPoolShare
+        self.commandPoolShares = {}
         self.performance = float(performance)
         self.history = deque(maxlen=singletonconfig.get('CORE', 'RN_NB_ERRORS_TOLERANCE'))
         self.tasksHistory = deque(maxlen=15)
@@ -119,9 +133,29 @@ class RenderNode(models.Model):
 
     ## Returns True if this render node is available for command assignment.
     #
+    # A node running commands is still available while it has free cores, canFit tells if a given command can
+    # run beside them.
+    #
     def isAvailable(self):
+        if not (self.isRegistered and not self.excluded and (self.pullMode or self.health.isReady())):
+            return False
         # Need to avoid nodes that have flag isPaused set (i.e. nodes paused by user but still running a command)
-        return (self.isRegistered and self.status == RN_IDLE and not self.commands and not self.excluded)
+        if not self.commands:
+            return self.status == RN_IDLE
+        return self.status in (RN_ASSIGNED, RN_WORKING) and self.freeCoresNumber > 0 and singletonconfig.get('CORE', 'MULTI_SLOT_RENDERNODES', False)
+
+    ## Returns True if the command can run on this node beside the commands already assigned.
+    #
+    # A task declaring no maximum number of cores uses the whole node. Other tasks need at least their minimum
+    # number of cores and their declared RAM to be free.
+    #
+    def canFit(self, command):
+        if not self.commands:
+            return True
+        task = command.task
+        if not task.maxNbCores:
+            return False
+        return self.freeCoresNumber >= max(1, task.minNbCores) and self.freeRam >= task.ramUse
 
     def reset(self, paused=False):
         # if paused, set the status to RN_PAUSED, else set it to Finishing, it will be set to IDLE in the next iteration of the dispatcher main loop
@@ -136,10 +170,8 @@ class RenderNode(models.Model):
             cmd.renderNode = None
             self.clearAssignment(cmd)
         self.commands = {}
-        # reset the associated poolshare, if any
-        if self.currentpoolshare:
-            self.currentpoolshare.allocatedRN -= 1
-            self.currentpoolshare = None
+        # reset the associated poolshares, if any
+        self.releasePoolShares()
         # reset the values for cores and ram
         self.freeCoresNumber = int(self.coresNumber)
         self.usedCoresNumber = {}
@@ -156,15 +188,14 @@ class RenderNode(models.Model):
     def clearAssignment(self, command):
         '''Removes command from the list of commands assigned to this rendernode.'''
         # in case of failed assignment, decrement the allocatedRN value
-        if self.currentpoolshare:
-            self.currentpoolshare.allocatedRN -= 1
-            self.currentpoolshare = None
+        self.releaseCommandPoolShare(command.id)
         try:
             del self.commands[command.id]
         except KeyError:
             pass
             #LOGGER.debug('attempt to clear assignment of not assigned command %d on worker %s', command.id, self.name)
         else:
+            self.invalidateRepr()
             self.releaseRessources(command)
             self.releaseLicense(command)
 
@@ -173,11 +204,31 @@ class RenderNode(models.Model):
     def addAssignment(self, command):
         if not command.id in self.commands:
             self.commands[command.id] = command
+            self.invalidateRepr()
             self.reserveRessources(command)
             # FIXME the assignment of the cmd should be done here and not in the dispatchIterator func
             command.assign(self)
             self.updateStatus()
 
+    ## Records the poolshare which has assigned a command to this node.
+    #
+    # The allocatedRN of a poolshare counts the render nodes running its commands, a node running several commands
+    # of the same poolshare is counted once.
+    #
+    def setCommandPoolShare(self, command, poolShare):
+        if poolShare not in self.commandPoolShares.values():
+            poolShare.allocatedRN += 1
+        self.commandPoolShares[command.id] = poolShare
+
+    def releaseCommandPoolShare(self, commandId):
+        poolShare = self.commandPoolShares.pop(commandId, None)
+        if poolShare is not None and poolShare not in self.commandPoolShares.values():
+            poolShare.allocatedRN -= 1
+
+    def releasePoolShares(self):
+        for commandId in self.commandPoolShares.keys():
+            self.releaseCommandPoolShare(commandId)
+
     ## Reserve license
     #
     def reserveLicense(self, command, licenseManager):
@@ -196,28 +247,30 @@ class RenderNode(models.Model):
 
     ## Reserve ressource
     #
+    # A task declaring no maximum number of cores reserves all the free cores and RAM of the node, other tasks
+    # reserve up to their maximum number of cores and their declared RAM (see canFit).
+    #
     def reserveRessources(self, command):
-        res = min(self.freeCoresNumber, command.task.maxNbCores) or self.freeCoresNumber
-        self.usedCoresNumber[command.id] = res
-        self.freeCoresNumber -= res
-
-        res = min(self.freeRam, command.task.ramUse) or self.freeRam
+        task = command.task
+        if task.maxNbCores:
+            cores = min(self.freeCoresNumber, task.maxNbCores)
+            ram = min(max(self.freeRam, 0), task.ramUse)
+        else:
+            cores = self.freeCoresNumber
+            ram = self.freeRam
 
-        self.usedRam[command.id] = res
-        self.freeRam -= res
+        self.usedCoresNumber[command.id] = cores
+        self.freeCoresNumber -= cores
+        self.usedRam[command.id] = ram
+        self.freeRam -= ram
+        self.invalidateRepr()
 
     ## Release ressource
     #
     def releaseRessources(self, command):
-        #res = self.usedCoresNumber[command.id]
-        self.freeCoresNumber = self.coresNumber
-        if command.id in self.usedCoresNumber:
-            del self.usedCoresNumber[command.id]
-
-        #res = self.usedRam[command.id]
-        self.freeRam = self.ramSize
-        if command.id in self.usedRam:
-            del self.usedRam[command.id]
+        self.freeCoresNumber += self.usedCoresNumber.pop(command.id, 0)
+        self.freeRam += self.usedRam.pop(command.id, 0)
+        self.invalidateRepr()
 
     ## Unassign a finished command
     #
@@ -256,9 +309,7 @@ class RenderNode(models.Model):
             if self.status not in (RN_IDLE, RN_PAUSED, RN_BOOTING):
                 #LOGGER.warning("rendernode %s was %d and is now IDLE." % (self.name, self.status))
                 self.status = RN_IDLE
-                if self.currentpoolshare:
-                    self.currentpoolshare.allocatedRN -= 1
-                    self.currentpoolshare = None
+                self.releasePoolShares()
             return
         commandStatus = [command.status for command in self.commands.values()]
         if CMD_RUNNING in commandStatus:
@@ -286,93 +337,122 @@ class RenderNode(models.Model):
     ## releases the finishing status of the rendernodes
     #
     def releaseFinishingStatus(self):
-        if self.status is RN_FINISHING:
+        # the commands of a node run concurrently: the finished ones are released even if others are still running
+        finishedCommands = [cmd for cmd in self.commands.values() if isFinalStatus(cmd.status)]
+        if self.status is RN_FINISHING or finishedCommands:
             # remove the commands that are in a final status
-            for cmd in self.commands.values():
-                if isFinalStatus(cmd.status):
-                    self.unassign(cmd)
-                    if CMD_DONE == cmd.status:
-                        cmd.completion = 1.0
-                    cmd.finish()
-            self.status = RN_IDLE
-
-    ##
-    #
-    # @warning The returned HTTPConnection is not safe to use from multiple threads
-    #
-    def getHTTPConnection(self):
-        timeout = singletonconfig.get('COMMUNICATION', 'RENDERNODE_REQUEST_TIMEOUT', 5)
-        return http.HTTPConnection(self.host, self.port, timeout=timeout)
+            for cmd in finishedCommands:
+                self.unassign(cmd)
+                if CMD_DONE == cmd.status:
+                    cmd.completion = 1.0
+                cmd.finish()
+            if self.status is RN_FINISHING:
+                self.status = RN_IDLE
+            if self.commands:
+                self.updateStatus()
 
     ## An exception class to report a render node http request failure.
     #
     class RequestFailed(Exception):
         pass
 
-    ## Sends a HTTP request to the render node and returns a (HTTPResponse, data) tuple on success.
+    ## Sends a HTTP request to the render node without blocking the calling thread (which must be the IOLoop thread).
     #
-    # This method tries to send the request at most RENDERNODE_REQUEST_MAX_RETRY_COUNT times,
-    # waiting RENDERNODE_REQUEST_DELAY_AFTER_REQUEST_FAILURE seconds between each try. It
-    # then raises a RenderNode.RequestFailed exception.
+    # `callback` is called in the IOLoop with the tornado HTTPResponse. When the render node can not be reached,
+    # the response code is 599 and its error is a RenderNode.RequestFailed. A failed request is not retried here:
+    # the node refuses the requests during RENDERNODE_REQUEST_DELAY_AFTER_REQUEST_FAILURE seconds and the caller
+    # retries later. After RENDERNODE_REQUEST_MAX_RETRY_COUNT consecutive failures, the node is reset and put in
+    # quarantine. At most RENDERNODE_MAX_CONNECTIONS requests are sent at a time to the node, on its keep-alive
+    # connections (see RenderNodeRequestQueue).
     #
-    # @param method the HTTP method for this request
-    # @param url the requested URL
-    # @param headers a dictionary with string-keys and string-values (empty by default)
-    # @param body the string body for this request (None by default)
-    # @raise RenderNode.RequestFailed if the request fails.
-    # @note it is a good idea to specify a Content-Length header when giving a non-empty body.
-    # @see  the RENDERNODE_REQUEST_MAX_RETRY_COUNT and
-    #       RENDERNODE_REQUEST_DELAY_AFTER_REQUEST_FAILURE params affect the execution of this method.
+    # @param callback the function called with the response, by default failures are only logged
     #
-    def request(self, method, url, body=None, headers={}):
-        """
-        """
+    def requestAsync(self, method, url, body=None, headers={}, callback=None, timeout=None):
+        if callback is None:
+            callback = partial(self.logResponse, method, url)
+
+        if timeout is None:
+            timeout = singletonconfig.get('COMMUNICATION', 'RENDERNODE_REQUEST_TIMEOUT', 5)
+        request = HTTPRequest("http://%s:%d%s" % (self.host, self.port, url),
+                              method=method,
+                              body=body,
+                              headers=dict((key, str(value)) for key, value in headers.items()),
+                              connect_timeout=timeout,
+                              request_timeout=timeout)
+
+        if not self.health.isReady():
+            error = self.RequestFailed("%s is unreachable, waiting before retrying" % self.name)
+            IOLoop.instance().add_callback(partial(callback, HTTPResponse(request, 599, error=error)))
+            return
 
-        # from octopus.dispatcher import settings
-        # LOGGER.debug("Send request to RN: http://%s:%s%s %s (%s)" % (self.host, self.port, url, method, headers))
+        self.fetch(request, callback)
 
-        err = None
-        conn = self.getHTTPConnection()
+    def fetch(self, request, callback):
+        def onResponse(response):
+            if isClientQueueTimeout(response):
+                # never sent: the dispatcher is overloaded, not the render node
+                LOGGER.warning("request to %s not sent, reason: %s" % (self.name, response.error))
+                response.error = self.RequestFailed(response.error)
+            elif response.code == 599:
+                response.error = self.recordRequestFailure(response.error)
+            else:
+                self.recordRequestSuccess(response.request_time)
+            callback(response)
 
-        # try to process the request at most RENDERNODE_REQUEST_MAX_RETRY_COUNT times.
-        for i in xrange(singletonconfig.get('COMMUNICATION', 'RENDERNODE_REQUEST_MAX_RETRY_COUNT')):
-            try:
-                conn.request(method, url, body, headers)
-                response = conn.getresponse()
-                if response.length:
-                    data = response.read(response.length)
-                else:
-                    data = None
-                # request succeeded
-                conn.close()
-                return (response, data)
-            except http.socket.error, e:
-                err = e
-                # LOGGER.debug("socket error %r" % e)
-                try:
-                    conn.close()
-                except:
-                    pass
-                if e in (errno.ECONNREFUSED, errno.ENETUNREACH):
-                    raise self.RequestFailed(cause=e)
-            except http.HTTPException, e:
-                err = e
-                # LOGGER.debug("HTTPException %r" % e)
-                try:
-                    conn.close()
-                except:
-                    pass
-                LOGGER.exception("rendernode.request failed")
-
-            LOGGER.warning("request failed (%d/%d), reason: %s" % (i + 1, singletonconfig.get('COMMUNICATION', 'RENDERNODE_REQUEST_MAX_RETRY_COUNT'), err))
-            # request failed so let's sleep for a while
-            time.sleep(singletonconfig.get('COMMUNICATION', 'RENDERNODE_REQUEST_DELAY_AFTER_REQUEST_FAILURE'))
-
-        # request failed too many times so reset the RN (without pausing) and set quarantine
-        self.reset(paused=False)
-        self.excluded = True
-        LOGGER.warning("A network call to the node %s can not be completed --> put in quarantine" % (self.name))
-        raise self.RequestFailed()
+        self.requestQueue.fetch(request, onResponse)
+
+    ## Sends a single request to a render node whose circuit is open, once the retry delay is elapsed.
+    # The circuit is closed if the render node answers, else the delay before the next probe is doubled.
+    # Called by the dispatcher loop, see RenderNodeHealth.needsProbe()
+    #
+    def probe(self):
+        self.health.startProbe()
+        timeout = singletonconfig.get('COMMUNICATION', 'RENDERNODE_REQUEST_TIMEOUT', 5)
+        request = HTTPRequest("http://%s:%d/commands/" % (self.host, self.port),
+                              method="GET",
+                              connect_timeout=timeout,
+                              request_timeout=timeout)
+        self.fetch(request, partial(self.logResponse, "GET", "/commands/"))
+
+    ## Pull mode: keeps the assignments until the worker polls for them, answers the waiting poll if any.
+    #
+    def queuePulledAssignments(self, commands):
+        self.pendingAssignments.extend(commands)
+        self.notifyAssignmentWaiter()
+
+    ## Pull mode: the kill order is sent in the response to the next poll of the worker.
+    #
+    def queueKill(self, commandId):
+        self.pendingKills.append(commandId)
+        self.notifyAssignmentWaiter()
+
+    def notifyAssignmentWaiter(self):
+        waiter = self.assignmentWaiter
+        if waiter is not None:
+            self.assignmentWaiter = None
+            waiter()
+
+    def logResponse(self, method, url, response):
+        if response.error:
+            LOGGER.warning("Request %s %s on %s failed: %s" % (method, url, self.name, response.error))
+
+    ## Records a failed request and opens the circuit of the render node after too many consecutive failures.
+    # @return the RequestFailed exception to raise or to report
+    #
+    def recordRequestFailure(self, error):
+        self.connections.close()
+        opened = self.health.requestFailed()
+        maxRetry = singletonconfig.get('COMMUNICATION', 'RENDERNODE_REQUEST_MAX_RETRY_COUNT')
+        LOGGER.warning("request to %s failed (%d/%d), reason: %s" % (self.name, self.health.consecutiveFailures, maxRetry, error))
+        if opened:
+            # request failed too many times so reset the RN (without pausing), it is not available until a probe succeeds
+            self.reset(paused=False)
+            LOGGER.warning("A network call to the node %s can not be completed --> circuit opened, next probe in %.2f s" % (self.name, self.health.retryDelay))
+        return self.RequestFailed(error)
+
+    def recordRequestSuccess(self, latency):
+        if self.health.requestSucceeded(latency):
+            LOGGER.warning("The node %s is reachable again --> circuit closed" % self.name)
 
     def canRun(self, command):
         # check if this rendernode has made too much errors in its last commands
@@ -415,7 +495,11 @@ class RenderNode(models.Model):
                         if isinstance(caracteristic, int) and caracteristic < value:
                             return False
 
-        if command.task.minNbCores:
+        if command.task.maxNbCores:
+            # the task can share the node with other commands, same rule as canFit
+            if self.freeCoresNumber < max(1, command.task.minNbCores):
+                return False
+        elif command.task.minNbCores:
             if self.freeCoresNumber < command.task.minNbCores:
                 return False
         else:
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Persistent HTTP connections from the dispatcher to a render node.
+
+Each render node owns a small pool of keep-alive connections: consecutive requests to a worker (assignments, cancel,
+status...) reuse an open socket instead of paying a TCP handshake each time. The number of requests sent concurrently
+to a single worker is bounded, additional callers wait for a free connection.
+
+The asynchronous requests sent from the IOLoop thread (see RenderNode.requestAsync) are bounded the same way: a
+RenderNodeRequestQueue sends at most RENDERNODE_MAX_CONNECTIONS requests at a time to a worker, the next ones wait in
+order until a request ends. With pycurl, they are sent by the curl client of tornado which keeps the connections alive.
+Without it, the simple client of tornado opens a connection per request: the requests are sent on the pooled
+connections instead, by a few shared threads, and their responses are handed back to the IOLoop.
+
+Failures are not retried by sleeping in the calling thread: they are recorded by the health of the render node (see
+rendernodehealth.py) which refuses the requests while its circuit is open, the caller retries later (e.g. the
+assignment is computed again in a next cycle).
+
+Configuration (section COMMUNICATION of config.ini):
+    RENDERNODE_MAX_CONNECTIONS: maximum number of concurrent requests (and open connections) to a render node
+    RENDERNODE_CONNECTION_IDLE_TIMEOUT: idle connections older than this delay in seconds are closed
+    RENDERNODE_REQUEST_TIMEOUT: socket timeout in seconds
+    RENDERNODE_ASYNC_MAX_CLIENTS: maximum number of requests in progress in the curl client (read at startup)
+    RENDERNODE_REQUEST_THREADS: number of threads sending the requests without pycurl (read at startup)
+"""
+__author__ = "Jerome Samson"
+__copyright__ = "Copyright 2014, Mikros Image"
+
+import httplib as http
+import logging
+import threading
+import time
+import urlparse
+from collections import deque
+from functools import partial
+from cStringIO import StringIO
+from Queue import Queue
+
+from tornado.ioloop import IOLoop
+from tornado.httpclient import AsyncHTTPClient, HTTPResponse
+from tornado.httputil import HTTPHeaders
+
+from octopus.core import singletonconfig
+
+LOGGER = logging.getLogger('main.dispatcher.webservice')
+
+# the requests are sent by the curl client, else on the pooled connections by the request threads
+curlClient = False
+requestThreads = None
+
+
+def configureHttpClient():
+    '''
+    Uses the curl client of tornado (keep-alive connections) when pycurl is available, else starts the threads sending
+    the requests on the connection pools of the render nodes.
+    '''
+    global curlClient, requestThreads
+    maxClients = singletonconfig.get('COMMUNICATION', 'RENDERNODE_ASYNC_MAX_CLIENTS', 100)
+    try:
+        from tornado.curl_httpclient import CurlAsyncHTTPClient
+        AsyncHTTPClient.configure(CurlAsyncHTTPClient, max_clients=maxClients)
+        curlClient = True
+    except ImportError:
+        LOGGER.warning("pycurl is not available, requests to the render nodes are sent by threads")
+        AsyncHTTPClient.configure(None, max_clients=maxClients)
+        curlClient = False
+        if requestThreads is None:
+            requestThreads = RequestThreads(singletonconfig.get('COMMUNICATION', 'RENDERNODE_REQUEST_THREADS', 16))
+
+
+def isClientQueueTimeout(response):
+    '''
+    Returns True when the request timed out in the queue of the http client of the dispatcher (too many requests in
+    progress to all the render nodes): it has never been sent, the render node is not responsible for the failure.
+    '''
+    return response.code == 599 and "in request queue" in str(response.error)
+
+
+class RenderNodeConnectionPool(object):
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.lock = threading.Lock()
+        self.idleConnections = []
+        self.slots = threading.BoundedSemaphore(singletonconfig.get('COMMUNICATION', 'RENDERNODE_MAX_CONNECTIONS', 4))
+
+    def newConnection(self):
+        return http.HTTPConnection(self.host, self.port)
+
+    def getIdleConnection(self):
+        '''
+        Returns the most recently used idle connection or None, closes the connections idle for too long.
+        '''
+        deadline = time.time() - singletonconfig.get('COMMUNICATION', 'RENDERNODE_CONNECTION_IDLE_TIMEOUT', 30)
+        with self.lock:
+            while self.idleConnections:
+                conn, releaseTime = self.idleConnections.pop()
+                if releaseTime >= deadline:
+                    return conn
+                conn.close()
+        return None
+
+    def close(self):
+        with self.lock:
+            for conn, releaseTime in self.idleConnections:
+                conn.close()
+            self.idleConnections = []
+
+    def send(self, conn, method, url, body, headers, timeout):
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        conn.request(method, url, body, headers)
+        response = conn.getresponse()
+        # the response must be entirely read before reusing the connection
+        data = response.read() or None
+        return (response, data)
+
+    def request(self, method, url, body=None, headers={}, timeout=None):
+        '''
+        Sends a request on a pooled connection and returns a (HTTPResponse, data) tuple.
+        A request failing on a reused connection (closed by the worker in the meantime) is sent again at once on a new
+        connection. Raises socket.error or HTTPException on failure.
+        '''
+        if timeout is None:
+            timeout = singletonconfig.get('COMMUNICATION', 'RENDERNODE_REQUEST_TIMEOUT', 5)
+        self.slots.acquire()
+        try:
+            conn = self.getIdleConnection()
+            try:
+                if conn is not None:
+                    try:
+                        response, data = self.send(conn, method, url, body, headers, timeout)
+                    except (http.socket.error, http.HTTPException):
+                        conn.close()
+                        conn = None
+                if conn is None:
+                    conn = self.newConnection()
+                    response, data = self.send(conn, method, url, body, headers, timeout)
+            except:
+                if conn is not None:
+                    conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                with self.lock:
+                    self.idleConnections.append((conn, time.time()))
+            return (response, data)
+        finally:
+            self.slots.release()
+
+
+class RequestThreads(object):
+    '''
+    Daemon threads running the blocking requests to the render nodes, shared by all the nodes.
+    '''
+
+    def __init__(self, count):
+        self.tasks = Queue()
+        for i in xrange(count):
+            thread = threading.Thread(target=self.run, name="RenderNodeRequest-%d" % i)
+            thread.setDaemon(True)
+            thread.start()
+
+    def submit(self, task):
+        self.tasks.put(task)
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            try:
+                task()
+            except Exception:
+                LOGGER.exception("request to a render node failed")
+
+
+class RenderNodeRequestQueue(object):
+    '''
+    Sends the asynchronous requests to a render node, at most RENDERNODE_MAX_CONNECTIONS at a time.
+    Only used from the IOLoop thread, the callbacks are called in the IOLoop.
+    '''
+
+    def __init__(self, connections):
+        self.connections = connections
+        self.active = 0
+        self.waiting = deque()
+
+    def fetch(self, request, callback):
+        self.waiting.append((request, callback))
+        self.sendNext()
+
+    def sendNext(self):
+        maxRequests = singletonconfig.get('COMMUNICATION', 'RENDERNODE_MAX_CONNECTIONS', 4)
+        while self.waiting and self.active < maxRequests:
+            request, callback = self.waiting.popleft()
+            self.active += 1
+            if curlClient or requestThreads is None:
+                AsyncHTTPClient().fetch(request, partial(self.onResponse, callback))
+            else:
+                requestThreads.submit(partial(self.send, request, IOLoop.instance(), partial(self.onResponse, callback)))
+
+    def send(self, request, ioloop, callback):
+        '''
+        Runs in a request thread: sends the request on a pooled connection and hands the response to the IOLoop.
+        '''
+        url = urlparse.urlsplit(request.url)
+        path = url.path + ("?" + url.query if url.query else "")
+        startTime = time.time()
+        try:
+            response, data = self.connections.request(request.method, path, request.body, dict(request.headers),
+                                                       request.request_timeout)
+            result = HTTPResponse(request, response.status, headers=HTTPHeaders(response.getheaders()),
+                                  buffer=StringIO(data or ""), request_time=time.time() - startTime)
+        except Exception, e:
+            result = HTTPResponse(request, 599, error=e, request_time=time.time() - startTime)
+        ioloop.add_callback(partial(callback, result))
+
+    def onResponse(self, callback, response):
+        self.active -= 1
+        try:
+            callback(response)
+        finally:
+            self.sendNext()
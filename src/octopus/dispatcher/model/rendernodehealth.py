@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Health of the render nodes as seen by the dispatcher.
+
+Each render node tracks the latency and the failure rate of the requests sent to it, and the error rate of the
+commands it has run. The rates are exponential moving averages which decay over time: old failures are
+progressively forgotten. They give a score used to prefer the healthy nodes when assigning commands.
+
+The requests go through a circuit breaker:
+    - closed: requests are sent normally
+    - open: after too many consecutive failures, the requests fail at once without contacting the node, the
+      node is not available for assignments
+    - half-open: once the retry delay is elapsed, the dispatcher loop probes the node with a single request.
+      If it succeeds the circuit is closed, else it is opened again with a doubled delay
+
+Configuration (section COMMUNICATION of config.ini):
+    RENDERNODE_REQUEST_MAX_RETRY_COUNT: nb of consecutive failed requests opening the circuit
+    RENDERNODE_REQUEST_DELAY_AFTER_REQUEST_FAILURE: delay in seconds before the first probe
+    RENDERNODE_CIRCUIT_MAX_DELAY: maximum delay in seconds between two probes
+    RENDERNODE_HEALTH_SMOOTHING: weight of a new sample in the averages
+    RENDERNODE_HEALTH_HALF_LIFE: delay in seconds after which the failure and error rates are halved
+"""
+__author__ = "Jerome Samson"
+__copyright__ = "Copyright 2014, Mikros Image"
+
+import threading
+import time
+
+from octopus.core import singletonconfig
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half-open"
+
+
+class RenderNodeHealth(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = CIRCUIT_CLOSED
+        self.consecutiveFailures = 0
+        self.retryTime = 0
+        self.retryDelay = 0
+        self.latency = None
+        self.failureRate = 0.0
+        self.commandErrorRate = 0.0
+        self.lastRequestTime = 0
+        self.lastCommandTime = 0
+
+    def decayed(self, value, since):
+        '''
+        Returns the value of a rate last updated at `since`, halved every RENDERNODE_HEALTH_HALF_LIFE seconds.
+        '''
+        halfLife = singletonconfig.get('COMMUNICATION', 'RENDERNODE_HEALTH_HALF_LIFE', 300)
+        return value * 0.5 ** (max(0.0, time.time() - since) / halfLife)
+
+    def average(self, value, sample):
+        smoothing = singletonconfig.get('COMMUNICATION', 'RENDERNODE_HEALTH_SMOOTHING', 0.2)
+        return value * (1.0 - smoothing) + sample * smoothing
+
+    def isReady(self):
+        '''
+        Returns False while the circuit is not closed: the requests must fail at once.
+        '''
+        return self.state == CIRCUIT_CLOSED
+
+    def needsProbe(self):
+        return self.state == CIRCUIT_OPEN and time.time() >= self.retryTime
+
+    def startProbe(self):
+        self.state = CIRCUIT_HALF_OPEN
+
+    def requestSucceeded(self, latency):
+        '''
+        Records a successful request, returns True if it has closed the circuit.
+        '''
+        with self.lock:
+            self.latency = latency if self.latency is None else self.average(self.latency, latency)
+            self.failureRate = self.average(self.decayed(self.failureRate, self.lastRequestTime), 0.0)
+            self.lastRequestTime = time.time()
+            self.consecutiveFailures = 0
+            if self.state == CIRCUIT_CLOSED:
+                return False
+            self.state = CIRCUIT_CLOSED
+            self.retryDelay = 0
+            return True
+
+    def requestFailed(self):
+        '''
+        Records a failed request, returns True if it has opened the circuit (a failed probe opens it again with a
+        longer delay but does not return True).
+        '''
+        with self.lock:
+            self.failureRate = self.average(self.decayed(self.failureRate, self.lastRequestTime), 1.0)
+            self.lastRequestTime = time.time()
+            self.consecutiveFailures += 1
+            if self.state == CIRCUIT_CLOSED and self.consecutiveFailures < singletonconfig.get('COMMUNICATION', 'RENDERNODE_REQUEST_MAX_RETRY_COUNT'):
+                return False
+
+            opened = self.state == CIRCUIT_CLOSED
+            firstDelay = singletonconfig.get('COMMUNICATION', 'RENDERNODE_REQUEST_DELAY_AFTER_REQUEST_FAILURE', .25)
+            maxDelay = singletonconfig.get('COMMUNICATION', 'RENDERNODE_CIRCUIT_MAX_DELAY', 60)
+            self.retryDelay = min(max(self.retryDelay * 2, firstDelay), maxDelay)
+            self.retryTime = time.time() + self.retryDelay
+            self.state = CIRCUIT_OPEN
+            return opened
+
+    def commandFinished(self, failed):
+        with self.lock:
+            self.commandErrorRate = self.average(self.decayed(self.commandErrorRate, self.lastCommandTime), 1.0 if failed else 0.0)
+            self.lastCommandTime = time.time()
+
+    def score(self):
+        '''
+        Returns 1.0 for a perfectly healthy node, lower values with request failures and command errors, 0.0 if
+        the circuit is not closed.
+        '''
+        if self.state != CIRCUIT_CLOSED:
+            return 0.0
+        return (1.0 - self.decayed(self.failureRate, self.lastRequestTime)) * (1.0 - self.decayed(self.commandErrorRate, self.lastCommandTime))
+
+    def to_json(self):
+        return {
+            'circuit': self.state,
+            'retryTime': self.retryTime if self.state != CIRCUIT_CLOSED else None,
+            'consecutiveFailures': self.consecutiveFailures,
+            'latency': self.latency,
+            'failureRate': self.decayed(self.failureRate, self.lastRequestTime),
+            'commandErrorRate': self.decayed(self.commandErrorRate, self.lastCommandTime),
+            'score': self.score(),
+        }
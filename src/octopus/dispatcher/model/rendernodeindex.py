@@ -0,0 +1,239 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Indexes and compiled queries on the render nodes of the dispatch tree.
+
+The index is kept up to date by the dispatch tree listeners (creation, destruction and change events of the render
+nodes). A query is compiled once into a plan: the constraints on indexed attributes (status, pool, host and
+caracteristics) are resolved with set operations on the index, the other constraints (name regex, speed, ram, cores)
+are compiled into predicates evaluated on the remaining candidates only. Recent plans are kept in a LRU cache.
+
+Supported constraints (each one accepts several values, see IQueryNode.filterRenderNodes):
+    constraint_status, constraint_pool, constraint_host, constraint_caracteristics ("key=value"),
+    constraint_name (regex), constraint_speed, constraint_ramsize, constraint_coresnumber ("+n", "-n" or "n")
+"""
+__author__ = "Jerome Samson"
+__copyright__ = "Copyright 2014, Mikros Image"
+
+import logging
+import re
+from collections import OrderedDict
+
+logger = logging.getLogger('main.dispatcher.webservice')
+
+# Number of compiled query plans kept in memory
+PLAN_CACHE_SIZE = 128
+
+INDEXED_FIELDS = ('status', 'pools', 'host', 'caracteristics')
+
+
+def _indexKeys(renderNode, field):
+    '''
+    Returns the set of index keys of a render node for the given field.
+    '''
+    if field == 'status':
+        return set([renderNode.status])
+    elif field == 'pools':
+        return set(pool.name for pool in renderNode.pools)
+    elif field == 'host':
+        return set([renderNode.host])
+    elif field == 'caracteristics':
+        keys = set()
+        for name, value in (renderNode.caracteristics or {}).items():
+            values = value if isinstance(value, (list, tuple)) else [value]
+            for item in values:
+                try:
+                    keys.add((name, unicode(item)))
+                except Exception:
+                    pass
+        return keys
+
+
+class RenderNodeIndex(object):
+    '''
+    Maps the values of the indexed fields to the set of render nodes having this value.
+    '''
+
+    def __init__(self):
+        self.indexes = dict((field, {}) for field in INDEXED_FIELDS)
+        self.entries = {}
+        self.plans = OrderedDict()
+
+    def rebuild(self, renderNodes):
+        self.indexes = dict((field, {}) for field in INDEXED_FIELDS)
+        self.entries = {}
+        for renderNode in renderNodes:
+            self.add(renderNode)
+
+    def add(self, renderNode):
+        self.entries[renderNode] = {}
+        for field in INDEXED_FIELDS:
+            self._indexField(renderNode, field)
+
+    def remove(self, renderNode):
+        entry = self.entries.pop(renderNode, None)
+        if entry is None:
+            return
+        for field, keys in entry.items():
+            index = self.indexes[field]
+            for key in keys:
+                self._discard(index, key, renderNode)
+
+    def update(self, renderNode, field):
+        if field in INDEXED_FIELDS and renderNode in self.entries:
+            self._indexField(renderNode, field)
+
+    def _indexField(self, renderNode, field):
+        index = self.indexes[field]
+        entry = self.entries[renderNode]
+        oldKeys = entry.get(field, set())
+        newKeys = _indexKeys(renderNode, field)
+        for key in oldKeys - newKeys:
+            self._discard(index, key, renderNode)
+        for key in newKeys - oldKeys:
+            index.setdefault(key, set()).add(renderNode)
+        entry[field] = newKeys
+
+    def _discard(self, index, key, renderNode):
+        renderNodes = index.get(key)
+        if renderNodes is not None:
+            renderNodes.discard(renderNode)
+            if not renderNodes:
+                del index[key]
+
+    def lookup(self, field, keys):
+        '''
+        Returns the set of render nodes having at least one of the given keys for field.
+        '''
+        index = self.indexes[field]
+        result = set()
+        for key in keys:
+            result |= index.get(key, set())
+        return result
+
+    def lookupMatching(self, field, matchFunc):
+        '''
+        Returns the set of render nodes with a key accepted by matchFunc, the function is called once per distinct key.
+        '''
+        index = self.indexes[field]
+        result = set()
+        for key, renderNodes in index.items():
+            if matchFunc(key):
+                result |= renderNodes
+        return result
+
+    def getCachedPlan(self, key, factory):
+        '''
+        Returns the plan stored under key in the LRU cache, or creates it with factory().
+        '''
+        try:
+            plan = self.plans.pop(key)
+        except KeyError:
+            plan = factory()
+            if len(self.plans) >= PLAN_CACHE_SIZE:
+                self.plans.popitem(last=False)
+        self.plans[key] = plan
+        return plan
+
+    def getPlan(self, pFilterArgs):
+        '''
+        Returns the compiled plan for the given query arguments.
+        '''
+        key = tuple(sorted((name, tuple(values)) for name, values in pFilterArgs.items() if name.startswith('constraint_')))
+        return self.getCachedPlan(key, lambda: RenderNodeQueryPlan(pFilterArgs))
+
+    def select(self, pFilterArgs):
+        '''
+        Returns the list of render nodes matching the given query arguments.
+        '''
+        return self.getPlan(pFilterArgs).execute(self)
+
+
+def _compileNumeric(values, attribute, cast):
+    '''
+    Returns a list of predicates for "+n" (strictly greater), "-n" (strictly lower) or "n" (equal) constraints.
+    '''
+    predicates = []
+    for value in values:
+        if value[0] == '+':
+            limit = cast(value[1:])
+            predicates.append(lambda rn, limit=limit: limit < getattr(rn, attribute))
+        elif value[0] == '-':
+            limit = cast(value[1:])
+            predicates.append(lambda rn, limit=limit: getattr(rn, attribute) < limit)
+        else:
+            limit = cast(value)
+            predicates.append(lambda rn, limit=limit: getattr(rn, attribute) == limit)
+    return predicates
+
+
+class RenderNodeQueryPlan(object):
+    '''
+    A query compiled into index lookups and predicates.
+    Lookups are a list of (field, keys): each lookup is the union of the nodes having one of the keys,
+    the lookups are intersected. Predicates are then evaluated on the resulting candidates.
+    '''
+
+    def __init__(self, pFilterArgs):
+        self.lookups = []
+        self.predicates = []
+
+        if 'constraint_status' in pFilterArgs:
+            self.lookups.append(('status', set(int(status) for status in pFilterArgs['constraint_status'])))
+        if 'constraint_pool' in pFilterArgs:
+            self.lookups.append(('pools', set(pFilterArgs['constraint_pool'])))
+        if 'constraint_host' in pFilterArgs:
+            self.lookups.append(('host', set(pFilterArgs['constraint_host'])))
+        if 'constraint_caracteristics' in pFilterArgs:
+            keys = set()
+            for caract in pFilterArgs['constraint_caracteristics']:
+                name, sep, value = caract.partition('=')
+                keys.add((name, unicode(value)))
+            self.lookups.append(('caracteristics', keys))
+
+        if 'constraint_name' in pFilterArgs:
+            nameRegex = re.compile('|'.join(pFilterArgs['constraint_name']))
+            self.predicates.append(lambda rn: nameRegex.match(rn.name))
+        if 'constraint_speed' in pFilterArgs:
+            self.predicates += _compileNumeric(pFilterArgs['constraint_speed'], 'speed', float)
+        if 'constraint_ramsize' in pFilterArgs:
+            self.predicates += _compileNumeric(pFilterArgs['constraint_ramsize'], 'ramSize', int)
+        if 'constraint_coresnumber' in pFilterArgs:
+            self.predicates += _compileNumeric(pFilterArgs['constraint_coresnumber'], 'coresNumber', int)
+
+    def match(self, renderNode):
+        '''
+        Evaluates the whole query on a single render node without using the index.
+        '''
+        for field, keys in self.lookups:
+            if not (_indexKeys(renderNode, field) & keys):
+                return False
+        for predicate in self.predicates:
+            if not predicate(renderNode):
+                return False
+        return True
+
+    def filter(self, renderNodes):
+        return [rn for rn in renderNodes if self.match(rn)]
+
+    def execute(self, index):
+        if self.lookups:
+            # intersect starting with the most selective lookup
+            matchingSets = sorted((index.lookup(field, keys) for field, keys in self.lookups), key=len)
+            candidates = matchingSets[0]
+            for matching in matchingSets[1:]:
+                candidates &= matching
+        else:
+            candidates = index.entries.keys()
+
+        result = []
+        for renderNode in candidates:
+            for predicate in self.predicates:
+                if not predicate(renderNode):
+                    break
+            else:
+                result.append(renderNode)
+        # the index sets have no order: keep the results stable between requests
+        result.sort(key=lambda rn: rn.name)
+        return result
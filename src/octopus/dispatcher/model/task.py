@@ -9,6 +9,14 @@ import datetime
 logger = logging.getLogger('main.model.task')
 
 
+def invalidateNodeReprs(task):
+    '''
+    The nodes of a task or taskgroup expose its tags in their own representations.
+    '''
+    for node in task.__dict__.get('nodes', {}).values():
+        node.invalidateRepr()
+
+
 class TaskGroup(Model):
 
     name = StringField()
@@ -56,6 +64,11 @@ class TaskGroup(Model):
         self.endTime = None
         self.timer = timer
 
+    def __setattr__(self, name, value):
+        Model.__setattr__(self, name, value)
+        if name == 'tags':
+            invalidateNodeReprs(self)
+
     def addTask(self, task):
         assert isinstance(task, Task) or isinstance(task, TaskGroup)
         task.setTimer(self.timer)
@@ -71,6 +84,13 @@ class TaskGroup(Model):
     def removeTask(self, task):
         self.tasks.remove(task)
 
+    def invalidateAssignmentPayload(self):
+        '''
+        The arguments and environment of a taskgroup are merged in the assignment payload of all its subtasks.
+        '''
+        for task in getattr(self, 'tasks', []):
+            task.invalidateAssignmentPayload()
+
     def archive(self):
         self.fireDestructionEvent(self)
 
@@ -202,11 +222,48 @@ class Task(Model):
         self.runnerPackages = runnerPackages
         self.watcherPackages = watcherPackages
 
+    def __setattr__(self, name, value):
+        Model.__setattr__(self, name, value)
+        if name == 'tags':
+            invalidateNodeReprs(self)
+
 
     def addValidationExpression(self, validationExpression):
         self.validationExpression = "&".join(self.validationExpression,
                                              validationExpression)
 
+    def getAssignmentPayload(self):
+        '''
+        Returns the task part of the assignment of its commands to a worker: runner, validation expression, log dir,
+        arguments and environment merged with the ones of the ancestors.
+        The payload is computed once and kept until the task or one of its ancestors changes (see DispatchTree.onTaskChange).
+        '''
+        payload = self.__dict__.get('_assignmentPayload')
+        if payload is None:
+            root = self
+            ancestors = [root]
+            while root.parent:
+                root = root.parent
+                ancestors.append(root)
+            arguments = {}
+            environment = {'PULI_USER': self.user}
+            for ancestor in ancestors:
+                arguments.update(ancestor.arguments)
+                environment.update(ancestor.environment)
+
+            payload = self._assignmentPayload = {
+                "runner": str(self.runner),
+                "arguments": arguments,
+                "validationExpression": self.validationExpression,
+                "taskName": self.name,
+                "relativePathToLogDir": "%d" % self.id,
+                "environment": environment,
+            }
+        return payload
+
+    def invalidateAssignmentPayload(self):
+        self._assignmentPayload = None
+
     def archive(self):
         self.fireDestructionEvent(self)
 
@@ -0,0 +1,336 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Read-only query replica.
+
+The dispatcher periodically serializes its dispatch tree (nodes, rendernodes, commands and licenses) and pushes the
+snapshot to one or several replica processes (see queryreplicad.py). A replica rebuilds a lightweight tree from the
+snapshot and serves the read-only webservices (/query, /query/job, /query/command, /query/rn, /rendernodes, /stats
+and /nodes GET) with the same handlers as the dispatcher.
+Monitoring traffic sent to a replica never reaches the scheduling process and its IOLoop thread.
+
+Configuration (section REPLICA of config.ini):
+    REPLICA_ADDRESSES: list of "host:port" replicas to feed, an empty list disables the snapshots
+    SNAPSHOT_INTERVAL: minimal delay in seconds between two snapshots
+    SNAPSHOT_TIMEOUT: timeout in seconds when sending a snapshot to a replica
+    SNAPSHOT_SOURCES: hosts allowed to push snapshots to a replica (the dispatchers)
+    SNAPSHOT_TOKEN: secret shared by the dispatcher and its replicas, sent with each snapshot
+
+A snapshot also holds the /stats figures of the dispatcher, the replica serves them as they were on the dispatcher.
+"""
+__author__ = "Jerome Samson"
+__copyright__ = "Copyright 2014, Mikros Image"
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import httplib
+import logging
+import socket
+import threading
+import time
+from Queue import Queue, Empty, Full
+
+from tornado.web import Application, HTTPError
+
+from octopus.core import singletonconfig
+from octopus.core.framework import BaseResource
+from octopus.dispatcher.model.rendernodeindex import RenderNodeIndex
+from octopus.dispatcher.webservice import commands, rendernodes, nodes, query
+from octopus.dispatcher.webservice.webservicedispatcher import computeStats
+
+logger = logging.getLogger('main.dispatcher.replica')
+
+SNAPSHOT_TOKEN_HEADER = "X-Puli-Snapshot-Token"
+
+
+#
+# Dispatcher side: build and push snapshots
+#
+def _nodeSnapshot(node):
+    data = node.to_json()
+    data['pools'] = [[poolShare.pool.name, poolShare.userDefinedMaxRN] for poolShare in node.poolShares.values()]
+    return json.dumps(data)
+
+
+def _elementSnapshot(element):
+    return json.dumps(element.to_json())
+
+
+def buildSnapshot(dispatcher):
+    '''
+    Returns the json snapshot of the dispatcher's tree. Each element is serialized only once until it changes,
+    the snapshot is assembled from the fragments cached on the model elements.
+    '''
+    tree = dispatcher.dispatchTree
+    header = {
+        'date': time.time(),
+        'licenses': repr(dispatcher.licenseManager),
+        'licensesDict': dispatcher.licenseManager.stats(),
+        'stats': computeStats(tree, dispatcher.licenseManager),
+    }
+    return '%s, "nodes": [%s], "rendernodes": [%s], "commands": [%s]}' % (
+        json.dumps(header)[:-1],
+        ', '.join(node.getCachedRepr('replica', _nodeSnapshot) for node in tree.nodes.values()),
+        ', '.join(rn.getCachedRepr('jsonString', _elementSnapshot) for rn in tree.renderNodes.values()),
+        ', '.join(command.getCachedRepr('jsonString', _elementSnapshot) for command in tree.commands.values()))
+
+
+class SnapshotPublisher(object):
+    '''
+    Called at the end of each dispatcher cycle. When the snapshot interval is elapsed, the tree is serialized in the
+    main loop (the model is not thread safe) and handed to a sender thread. Only the latest snapshot is kept: a slow
+    replica makes the dispatcher skip snapshots, it never delays a cycle.
+    '''
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.lastSnapshotTime = 0
+        self.pending = Queue(maxsize=1)
+        self.sender = None
+
+    def publish(self):
+        addresses = singletonconfig.get('REPLICA', 'REPLICA_ADDRESSES', [])
+        if not addresses:
+            return
+        now = time.time()
+        if now - self.lastSnapshotTime < singletonconfig.get('REPLICA', 'SNAPSHOT_INTERVAL', 2.0):
+            return
+        self.lastSnapshotTime = now
+
+        try:
+            snapshot = buildSnapshot(self.dispatcher)
+        except Exception:
+            logger.exception("Impossible to build snapshot for query replicas")
+            return
+
+        try:
+            self.pending.get_nowait()
+        except Empty:
+            pass
+        try:
+            self.pending.put_nowait((addresses, snapshot))
+        except Full:
+            pass
+
+        if self.sender is None or not self.sender.isAlive():
+            self.sender = threading.Thread(target=self._sendLoop, name="SnapshotSender")
+            self.sender.setDaemon(True)
+            self.sender.start()
+
+    def _sendLoop(self):
+        while True:
+            addresses, snapshot = self.pending.get()
+            timeout = singletonconfig.get('REPLICA', 'SNAPSHOT_TIMEOUT', 10)
+            headers = {"Content-Type": "application/json", SNAPSHOT_TOKEN_HEADER: singletonconfig.get('REPLICA', 'SNAPSHOT_TOKEN', "")}
+            for address in addresses:
+                host, port = address.split(':', 1)
+                try:
+                    conn = httplib.HTTPConnection(host, int(port), timeout=timeout)
+                    conn.request("PUT", "/replica/snapshot", snapshot, headers)
+                    response = conn.getresponse()
+                    response.read()
+                    conn.close()
+                    if response.status != 200:
+                        logger.warning("Replica %s refused snapshot: %d %s" % (address, response.status, response.reason))
+                except Exception, e:
+                    logger.warning("Impossible to send snapshot to replica %s: %r" % (address, e))
+
+
+#
+# Replica side: rebuild a read-only tree from a snapshot
+#
+class SnapshotElement(object):
+    '''
+    Read-only element of a snapshot. Attributes are the fields of the json representation sent by the dispatcher,
+    references to other elements are resolved by SnapshotTree.
+    '''
+
+    def __init__(self, data):
+        self.__dict__.update(data)
+        self._json = data
+        self._reprCache = {}
+
+    def to_json(self):
+        return dict(self._json)
+
+    def getCachedRepr(self, key, builder):
+        try:
+            return self._reprCache[key]
+        except KeyError:
+            value = self._reprCache[key] = builder(self)
+            return value
+
+
+class SnapshotLicenseManager(object):
+
+    def __init__(self, representation="", stats=None):
+        self.representation = representation
+        self.licensesStats = stats if stats is not None else {}
+
+    def __repr__(self):
+        return self.representation
+
+    def stats(self):
+        return self.licensesStats
+
+
+class SnapshotTree(object):
+    '''
+    Mimics the parts of the DispatchTree used by the read-only webservices.
+    '''
+
+    def __init__(self, data=None):
+        self.date = None
+        self.nodes = {}
+        self.renderNodes = {}
+        self.commands = {}
+        self.pools = {}
+        self.tasks = {}
+        self.renderNodeIndex = RenderNodeIndex()
+        if data is not None:
+            self.load(data)
+
+    def getPool(self, name):
+        if name not in self.pools:
+            self.pools[name] = SnapshotElement({'name': name})
+        return self.pools[name]
+
+    def getTask(self, id):
+        if id not in self.tasks:
+            self.tasks[id] = SnapshotElement({'id': id})
+        return self.tasks[id]
+
+    def load(self, data):
+        self.date = data['date']
+
+        for nodeData in data['nodes']:
+            node = SnapshotElement(nodeData)
+            self.nodes[node.id] = node
+        for node in self.nodes.values():
+            node.parent = self.nodes.get(node.parent)
+            if hasattr(node, 'children'):
+                node.children = [self.nodes[childId] for childId in node.children if childId in self.nodes]
+            node.tags = node.tags or {}
+            node.poolShares = dict((self.getPool(name), SnapshotElement({'userDefinedMaxRN': userDefinedMaxRN})) for name, userDefinedMaxRN in node.pools)
+
+        for rnData in data['rendernodes']:
+            renderNode = SnapshotElement(rnData)
+            renderNode.pools = [self.getPool(name) for name in renderNode.pools]
+            self.renderNodes[renderNode.name] = renderNode
+        self.renderNodeIndex.rebuild(self.renderNodes.values())
+
+        for commandData in data['commands']:
+            command = SnapshotElement(commandData)
+            command.task = self.getTask(command.task)
+            command.renderNode = self.renderNodes.get(command.renderNode)
+            self.commands[command.id] = command
+
+
+class QueryReplica(object):
+    '''
+    Application part of the replica, holds the last tree received from the dispatcher.
+    '''
+
+    def __init__(self):
+        self.dispatchTree = SnapshotTree()
+        self.licenseManager = SnapshotLicenseManager()
+        self.stats = None
+
+    def loadSnapshot(self, body):
+        start = time.time()
+        data = json.loads(body)
+        tree = SnapshotTree(data)
+        self.licenseManager = SnapshotLicenseManager(data['licenses'], data['licensesDict'])
+        self.stats = data['stats']
+        self.dispatchTree = tree
+        logger.info("Snapshot of %d nodes, %d rendernodes and %d commands loaded in %.2f ms" % (len(tree.nodes), len(tree.renderNodes), len(tree.commands), (time.time() - start) * 1000))
+
+
+def snapshotSources():
+    '''
+    Returns the addresses of the hosts allowed to push snapshots (SNAPSHOT_SOURCES), resolved at each call: the names
+    of the dispatchers may be changed in the config and reloaded.
+    '''
+    sources = set()
+    for host in singletonconfig.get('REPLICA', 'SNAPSHOT_SOURCES', ["127.0.0.1"]):
+        try:
+            sources.update(socket.gethostbyname_ex(host)[2])
+        except socket.error, e:
+            logger.warning("Impossible to resolve snapshot source %s: %r" % (host, e))
+    return sources
+
+
+class SnapshotResource(BaseResource):
+    def put(self):
+        if self.request.remote_ip not in snapshotSources():
+            logger.warning("Snapshot refused from %s: not in SNAPSHOT_SOURCES" % self.request.remote_ip)
+            raise HTTPError(403, "Snapshots are only accepted from the dispatcher")
+        if self.request.headers.get(SNAPSHOT_TOKEN_HEADER, "") != singletonconfig.get('REPLICA', 'SNAPSHOT_TOKEN', ""):
+            logger.warning("Snapshot refused from %s: invalid token" % self.request.remote_ip)
+            raise HTTPError(403, "Invalid snapshot token")
+        try:
+            self.framework.application.loadSnapshot(self.request.body)
+        except Exception, e:
+            logger.exception("Invalid snapshot received")
+            raise HTTPError(400, "Invalid snapshot: %r" % e)
+        self.writeCallback("Snapshot loaded")
+
+
+class ReplicaStatsResource(BaseResource):
+    '''
+    Serves the /stats figures computed by the dispatcher with the last snapshot.
+    '''
+    def get(self):
+        stats = self.framework.application.stats
+        if stats is None:
+            raise HTTPError(503, "No snapshot received from the dispatcher yet")
+        self.writeCallback(stats)
+
+
+def readOnly(resourceClass, methods=("GET",)):
+    '''
+    Returns a subclass of the given dispatcher resource restricted to the given methods
+    and unavailable until a first snapshot has been received.
+    '''
+    def prepare(self):
+        if self.getDispatchTree().date is None:
+            raise HTTPError(503, "No snapshot received from the dispatcher yet")
+        resourceClass.prepare(self)
+
+    return type(resourceClass.__name__, (resourceClass,), {'SUPPORTED_METHODS': methods, 'prepare': prepare})
+
+
+class ReplicaWebService(Application):
+
+    def __init__(self, framework, port):
+        super(ReplicaWebService, self).__init__([
+            (r'^/replica/snapshot/?$', SnapshotResource, dict(framework=framework)),
+
+            (r'/stats/?$', ReplicaStatsResource, dict(framework=framework)),
+            (r'/rendernodes/?$', readOnly(rendernodes.RenderNodesResource), dict(framework=framework)),
+            (r'/rendernodes/((?:\d+)|(?:[\w.-]+:\d+))/?$', readOnly(rendernodes.RenderNodeResource), dict(framework=framework)),
+            (r'^/nodes/?$', readOnly(nodes.NodesResource), dict(framework=framework)),
+            (r'^/nodes/(\d+)/?$', readOnly(nodes.NodeResource), dict(framework=framework)),
+
+            (r'^/query$', readOnly(query.QueryResource), dict(framework=framework)),
+            (r'^/query/rn$', readOnly(query.RenderNodeQueryResource), dict(framework=framework)),
+            (r'^/query/job$', readOnly(query.QueryResource, ("GET", "POST")), dict(framework=framework)),
+            (r'^/query/command$', readOnly(commands.CommandQueryResource), dict(framework=framework)),
+        ])
+        self.listen(port, "0.0.0.0")
+        self.framework = framework
+
+
+class ReplicaFramework(object):
+    '''
+    Minimal counterpart of WSAppFramework: the replica has no main loop, everything runs in the IOLoop.
+    '''
+
+    def __init__(self, port):
+        self.port = port
+        self.application = QueryReplica()
+        self.webService = ReplicaWebService(self, port)
@@ -1,5 +1,15 @@
 
 import time
+import logging
+import threading
+from functools import partial
+from Queue import Queue
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import tornado
 from octopus.core import framework
 from octopus.core.tools import Workload
 
@@ -26,6 +36,21 @@ from octopus.core import singletonconfig, singletonstats
 from octopus.core.framework import BaseResource
 
 
+_backgroundTasks = Queue()
+_backgroundThreads = []
+
+
+def _backgroundLoop():
+    while True:
+        func, callback = _backgroundTasks.get()
+        try:
+            result, error = func(), None
+        except Exception, e:
+            logging.getLogger('main.dispatcher.webservice').exception("Error in background task")
+            result, error = None, e
+        tornado.ioloop.IOLoop.instance().add_callback(partial(callback, result, error))
+
+
 class DispatcherBaseResource(BaseResource):
     """
     Simply override prepare to have a specific handler for the dispatcher (stats are not allowed for the worker)
@@ -48,4 +73,64 @@ class DispatcherBaseResource(BaseResource):
             elif self.request.method == 'DELETE':
                     singletonstats.theStats.cycleCounts['incoming_delete'] += 1
 
+    def writeItemsCallback(self, content, key, fragments):
+        """
+        Writes the json dict `content` with a list of already serialized items added under `key`.
+        Avoids encoding again the representations cached on the model elements.
+        """
+        body = json.dumps(content)[:-1]
+        if content:
+            body += ', '
+        self.writeCallback('%s%s: [%s]}' % (body, json.dumps(key), ', '.join(fragments)))
+
+    def runInTimeSlices(self, work, onFinish, onSlice=None, onError=None):
+        """
+        Consumes the generator `work` in successive IOLoop callbacks. Each callback works at most BULK_EDIT_TIME_SLICE
+        seconds then gives the hand back to other requests and to the dispatcher loop.
+        Command changes are coalesced during a slice (see DispatchTree.beginBulkUpdate).
+        `onSlice` is called at the end of each slice, including the last one.
+        `onFinish` is called once the generator is exhausted, the handler must be asynchronous.
+        `onError` is called if the generator raises, before the error 500 is sent: the work done so far is kept.
+        """
+        def step():
+            tree = self.getDispatchTree()
+            deadline = time.time() + singletonconfig.get('CORE', 'BULK_EDIT_TIME_SLICE', 0.05)
+            finished = failed = False
+            tree.beginBulkUpdate()
+            try:
+                while time.time() < deadline:
+                    work.next()
+            except StopIteration:
+                finished = True
+            except Exception:
+                logging.getLogger('main.dispatcher.webservice').exception("Error during bulk update: %s" % self.request.uri)
+                failed = True
+            finally:
+                tree.endBulkUpdate()
+
+            if onSlice is not None:
+                onSlice()
+            if finished:
+                onFinish()
+            elif failed:
+                if onError is not None:
+                    onError()
+                self.send_error(500)
+            else:
+                tornado.ioloop.IOLoop.instance().add_callback(step)
+        step()
+
+    def runInBackground(self, func, onResult):
+        """
+        Calls `func` in one of the background threads (at most BACKGROUND_THREADS, section DB) and then
+        `onResult(result, error)` in the IOLoop thread, the handler must be asynchronous.
+        `func` must not use the dispatch tree which is not thread safe: it is meant for database queries.
+        """
+        if len(_backgroundThreads) < singletonconfig.get('DB', 'BACKGROUND_THREADS', 2):
+            thread = threading.Thread(target=_backgroundLoop, name="BackgroundTask-%d" % len(_backgroundThreads))
+            thread.setDaemon(True)
+            thread.start()
+            _backgroundThreads.append(thread)
+        _backgroundTasks.put((func, tornado.stack_context.wrap(onResult)))
+
 from .webservicedispatcher import WebServiceDispatcher as WebService
@@ -0,0 +1,25 @@
+'''
+Controller for the /cancellations service: progress of the cancel operations (see octopus.dispatcher.cancellation).
+'''
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from octopus.core.communication.http import Http404
+from octopus.dispatcher.webservice import DispatcherBaseResource
+
+
+class CancellationsResource(DispatcherBaseResource):
+    def get(self):
+        operations = self.dispatcher.cancellationManager.operations.values()
+        self.writeCallback(json.dumps({'cancellations': [operation.to_json() for operation in operations]}))
+
+
+class CancellationResource(DispatcherBaseResource):
+    def get(self, operationId):
+        try:
+            operation = self.dispatcher.cancellationManager.operations[int(operationId)]
+        except KeyError:
+            raise Http404("Cancellation %s not found" % operationId)
+        self.writeCallback(json.dumps(operation.to_json()))
@@ -33,6 +33,8 @@ import logging
 import time
 from datetime import datetime
 
+import tornado
+
 from octopus.dispatcher.model import FolderNode
 from octopus.dispatcher.model.enums import NODE_STATUS
 from octopus.dispatcher.model.nodequery import IQueryNode
@@ -341,6 +343,151 @@ class EditPrioResource(DispatcherBaseResource, IQueryNode):
         self.writeCallback(json.dumps(content))
 
 
+class BulkEditResource(DispatcherBaseResource, IQueryNode):
+    """
+    Apply a single edit action on a large selection of jobs.
+    The selection is given by a list of node ids and/or query constraints (same names as the "constraint_" args of
+    the other edit webservices), for instance:
+
+    curl -X PUT -d '{"action": "status", "value": 1, "constraints": {"user": ["jsa"], "status": [4]}}' http://pulitest:8004/edit/bulk
+    curl -X PUT -d '{"action": "pause", "ids": [5028, 5029, 5030]}' http://pulitest:8004/edit/bulk
+
+    Supported actions: "status" (optional "cascade" flag, default true), "pause", "resume", "prio" and "maxrn".
+    The edition is done in time slices to keep the dispatcher responsive, the response is sent once every job
+    has been edited. It uses the same format as the other edit webservices.
+    """
+
+    ACTIONS = ('status', 'pause', 'resume', 'prio', 'maxrn')
+
+    @tornado.web.asynchronous
+    def put(self):
+        """
+        """
+        self.startTime = time.time()
+        self.editedJobs = []
+
+        data = self.getBodyAsJSON()
+        if not isinstance(data, dict):
+            raise Http400('Bad request: a json object is expected.')
+
+        action = data.get('action')
+        if action not in BulkEditResource.ACTIONS:
+            raise Http400('Bad request: invalid action %r, should be one of %s' % (action, ', '.join(BulkEditResource.ACTIONS)))
+
+        if action in ('status', 'prio', 'maxrn'):
+            try:
+                value = int(data['value'])
+            except (KeyError, TypeError, ValueError):
+                raise Http400('Bad request: an integer "value" is required for action %r' % action)
+            if action == 'status' and value not in NODE_STATUS:
+                raise Http400("Invalid status given: %d" % value)
+            if action == 'maxrn' and value < -1:
+                raise Http400('Bad request: invalid value, maxRN cannot be lower than -1')
+        else:
+            value = None
+
+        if 'ids' not in data and 'constraints' not in data:
+            raise Http400('Bad request: the selection must be given with "ids" and/or "constraints".')
+
+        tree = self.getDispatchTree()
+        self.totalNodes = len(tree.nodes[1].children)
+
+        #
+        # Selection: direct access for ids, then usual query filtering
+        #
+        if 'ids' in data:
+            nodes = []
+            for nodeId in data['ids']:
+                try:
+                    nodes.append(tree.nodes[int(nodeId)])
+                except (KeyError, ValueError):
+                    logger.warning("Node %r not found, ignoring." % nodeId)
+        else:
+            nodes = tree.nodes[1].children
+
+        constraints = data.get('constraints', {})
+        if constraints:
+            args = {}
+            for name, values in constraints.items():
+                if not isinstance(values, list):
+                    values = [values]
+                args['constraint_%s' % name] = [str(constraintValue) for constraintValue in values]
+            nodes = self.filterNodes(args, nodes)
+        self.filteredCount = len(nodes)
+
+        self.cancellation = None
+        if action == 'status' and value == NODE_CANCELED:
+            self.cancellation = self.dispatcher.cancellationManager.createOperation("bulk cancel of %d jobs" % len(nodes))
+            self.set_header('Location', '/cancellations/%d/' % self.cancellation.id)
+
+        self.runInTimeSlices(self.editGenerator(nodes, action, value, bool(data.get('cascade', True))), self.sendSummary,
+                             onSlice=self.sendKills, onError=self.completeCancellation)
+
+    def editGenerator(self, nodes, action, value, cascade):
+        """
+        Edits the nodes one by one, yields after each elementary change so that the edition can be interrupted.
+        A cancel is done command by command, the kill requests are sent to the rendernodes at the end of each time slice.
+        """
+        for node in nodes:
+            if action == 'status':
+                if node.status == value:
+                    yield node
+                    continue
+                if value == NODE_CANCELED:
+                    for command in node.cmdIterator():
+                        command.cancel(self.cancellation)
+                        yield command
+                    edited = True
+                else:
+                    if node.status in [NODE_ERROR, NODE_CANCELED, NODE_DONE] and value == NODE_READY:
+                        node.resetCompletion()
+                    edited = node.setStatus(value, cascade)
+            elif action == 'pause':
+                # same selection as PauseResource: only the nodes not paused yet
+                edited = hasattr(node, 'paused') and node.paused is False
+                if edited:
+                    node.setPaused(True)
+            elif action == 'resume':
+                node.setPaused(False)
+                edited = True
+            elif action == 'prio':
+                node.dispatchKey = value
+                edited = True
+            elif action == 'maxrn':
+                node.maxRN = value
+                edited = True
+
+            if edited:
+                self.editedJobs.append(node.id)
+            yield node
+
+    def sendKills(self):
+        if self.cancellation is not None:
+            self.dispatcher.cancellationManager.send(self.cancellation)
+
+    def completeCancellation(self):
+        if self.cancellation is not None:
+            self.dispatcher.cancellationManager.complete(self.cancellation)
+
+    def sendSummary(self):
+        self.completeCancellation()
+
+        content = {
+            'summary': {
+                'editedCount': len(self.editedJobs),
+                'filteredCount': self.filteredCount,
+                'totalInDispatcher': self.totalNodes,
+                'requestTime': time.time() - self.startTime,
+                'requestDate': time.ctime()
+            },
+            'editedJobs': self.editedJobs
+        }
+        if self.cancellation is not None:
+            content['cancellation'] = self.cancellation.id
+        self.writeCallback(json.dumps(content))
+        self.finish()
+
+
 class RenderNodeEditResource(DispatcherBaseResource, IQueryNode):
     def get(self):
         """
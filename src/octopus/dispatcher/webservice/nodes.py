@@ -3,11 +3,12 @@ Controller for the /nodes service.
 '''
 from octopus.core.enums.node import NODE_ERROR, NODE_CANCELED, NODE_DONE, NODE_READY
 from octopus.dispatcher.model.task import TaskGroup
-from octopus.core.enums.command import CMD_READY, CMD_RUNNING, CMD_CANCELED
+from octopus.core.enums.command import CMD_READY, CMD_RUNNING
 from octopus.dispatcher.webservice import DispatcherBaseResource
 
 import logging
 import time
+from functools import partial
 try:
     import simplejson as json
 except ImportError:
@@ -74,6 +75,33 @@ class NodesResource(DispatcherBaseResource):
         except KeyError:
             raise NodeNotFoundError(nodeId)
 
+    def createCancellation(self, description):
+        '''
+        Returns a new cancel operation, its progress can be polled at the url given in the "Location" header.
+        '''
+        operation = self.dispatcher.cancellationManager.createOperation(description)
+        self.set_header('Location', '/cancellations/%d/' % operation.id)
+        return operation
+
+    def runCancellation(self, work, operation):
+        '''
+        Cancels the commands in time slices, the kill requests collected during a slice are sent at its end.
+        The cancellation is completed even if it is interrupted by an error, the commands already canceled are killed.
+        '''
+        cancellationManager = self.dispatcher.cancellationManager
+        self.runInTimeSlices(work,
+                             partial(self.finishCancellation, operation),
+                             onSlice=partial(cancellationManager.send, operation),
+                             onError=partial(cancellationManager.complete, operation))
+
+    def finishCancellation(self, operation):
+        '''
+        Sends the last kill requests of the operation once its commands have been canceled, ends the asynchronous
+        request.
+        '''
+        self.dispatcher.cancellationManager.complete(operation)
+        self.finish()
+
 
 class NodeResource(NodesResource):
     ##@queue
@@ -98,50 +126,25 @@ class NodeNameResource(NodesResource):
 
 class NodeCancelResource(NodesResource):
     '''
-    A webservice dedicated to cancelling nodes.
+    A webservice dedicated to cancelling the running commands of a node.
     It handles the process in 2 steps:
-    - reset node and commands on the dispatch tree (server side)
-    - send "DELETE" request to the rendernode on which a command was assigned
-    The 2nd step is executed in a dedicated thread to avoir blocking tornado
+    - reset node and commands on the dispatch tree (server side), in time slices
+    - send "DELETE" request to the rendernode on which a command was assigned (see CancellationManager)
+    The progress of the 2nd step can be polled on the url given in the "Location" header of the response.
     '''
 
+    @tornado.web.asynchronous
     def put(self, nodeId):
-        # If user action is CANCEL, we use asynchronous webservice to avoid the timeout that
-        # might occur when sending requests to each render node.
-
         node = self._findNode(int(nodeId))
-        self.interruptedRnList = []
+        operation = self.createCancellation("cancel running commands of node %d" % node.id)
+        self.writeCallback("New status has been taken into account. Change will be effective soon")
+        self.runCancellation(self.iterOnRunningCommands(node, operation), operation)
 
+    def iterOnRunningCommands(self, node, operation):
         for cmd in node.cmdIterator():
             if cmd.status == CMD_RUNNING:
-                self.interruptedRnList.append((cmd.renderNode, cmd.id))
-                cmd.status = CMD_CANCELED
-
-        if len(self.interruptedRnList) > 0:
-            from threading import Thread
-            t = Thread(target=self.sendCancelRequests)
-            t.start()
-
-        # logger.debug("Done updating server")
-        self.writeCallback("New status has been taken into account. Change will be effective soon")
-        self.finish()
-
-    def sendCancelRequests(self):
-        '''
-        Send a specific request to each rendernodes.
-        '''
-        for rn, cmdId in self.interruptedRnList:
-            # For each RN marked as having a running command
-            try:
-                rn.request("DELETE", "/commands/" + str(cmdId) + "/")
-            except:
-                logger.warning("Problem occured interruption of %s for command %s (however command has already been reseted on the server)" % (cmdId, rn))
-
-            # Reset RN assignment to make it available for a future assignment
-            rn.clearAssignment(self)
-
-        # Clean rn list after process
-        self.interruptedRnList = []
+                cmd.cancel(operation)
+            yield cmd
 
 
 class NodeStatusResource(NodesResource):
@@ -217,10 +220,9 @@ class NodeStatusResource(NodesResource):
                 elif nodeStatus == NODE_CANCELED:
                     # If user action is CANCEL, we use asynchronous webservice to avoid the timeout that
                     # might occur when sending requests to each render node.
-                    self.gen = node.cmdIterator()
-                    tornado.ioloop.IOLoop.instance().add_callback(self.iterOnCommands)
-
+                    operation = self.createCancellation("cancel node %d" % node.id)
                     self.writeCallback("New status (CANCEL) has been taken into account. Change will be effective soon")
+                    self.runCancellation(self.iterOnCommands(node, operation), operation)
                 else:
                     if node.setStatus(nodeStatus, cascadeUpdate):
                         self.writeCallback("Status set to %r" % nodeStatus)
@@ -229,19 +231,15 @@ class NodeStatusResource(NodesResource):
                         self.writeCallback("Status was not changed.")
                         self.finish()
 
-    def iterOnCommands(self):
+    def iterOnCommands(self, node, operation):
         """
         Cancel each command in a node hierarchy (command is given by a generator on the node)
-        Each command might be blocked by network pb (or machine swapping) but asynchronous mecanism will
-        allow other request to be treated between each command cancelation.
+        The kill requests are sent at the end of each time slice, the time slices
+        allow other request to be treated between groups of command cancelations.
         """
-        try:
-            # Get next command in generator
-            cmd = self.gen.next()
-            cmd.cancel()
-            tornado.ioloop.IOLoop.instance().add_callback(self.iterOnCommands)
-        except StopIteration:
-            self.finish()
+        for cmd in node.cmdIterator():
+            cmd.cancel(operation)
+            yield cmd
 
 
 class NodePausedResource(NodesResource):
@@ -393,6 +391,7 @@ class NodeProdResource(NodesResource):
             nodeId = int(nodeId)
             node = self._findNode(nodeId)
             node.tags["prod"] = str(prod)
+            node.invalidateRepr()
             self.dispatcher.dispatchTree.toModifyElements.append(node)
 
 
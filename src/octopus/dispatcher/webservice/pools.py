@@ -53,6 +53,7 @@ class PoolResource(DispatcherBaseResource):
             for rn in self.getDispatchTree().renderNodes.values():
                 if self.getDispatchTree().pools[poolName] in rn.pools:
                     rn.pools.remove(self.getDispatchTree().pools[poolName])
+                    rn.fireChangeEvent(rn, "pools", [], rn.pools)
             # try to remove the pool from the dispatch tree
             self.getDispatchTree().pools[poolName].archive()
         except KeyError, e:
@@ -56,11 +56,13 @@ except ImportError:
 
 import logging
 import time
-import types
 import re
 
+import tornado
 from tornado.web import HTTPError
 
+from octopus.core import singletonconfig
+
 from octopus.dispatcher.model.nodequery import IQueryNode
 
 from octopus.core.communication.http import Http404, Http400, Http500, HttpConflict
@@ -93,6 +95,25 @@ class QueryResource(DispatcherBaseResource, IQueryNode):
         param: flag to indicate if user wants to retrieve subtasks (enable recursive call)
         return: a json dict
         """
+        pAttributes = tuple(pAttributes)
+        currTask = dict(pNode.getCachedRepr(('query',) + pAttributes, lambda node: self.buildTaskRepr(node, pAttributes)))
+
+        if pTree and hasattr(pNode, 'children'):
+            childTasks = []
+            for child in pNode.children:
+                childTasks.append(self.createTaskRepr(child, pAttributes, pTree))
+
+            currTask['items'] = childTasks
+        return currTask
+
+    def buildTaskRepr(self, pNode, pAttributes):
+        """
+        Create the json representation of a single node, without its children.
+        The result is cached on the node until it changes (see Model.getCachedRepr)
+        param: node to represent
+        param: attributes to retrieve
+        return: a json dict
+        """
         currTask = {}
         for currArg in pAttributes:
             #
@@ -122,17 +143,22 @@ class QueryResource(DispatcherBaseResource, IQueryNode):
                 currTask[currArg] = 'undefined'
                 logger.warning("Impossible to get attribute '%s' on object %r" % (currArg, pNode))
 
-        if pTree and hasattr(pNode, 'children'):
-            childTasks = []
-            for child in pNode.children:
-                childTasks.append(self.createTaskRepr(child, pAttributes, pTree))
-
-            currTask['items'] = childTasks
         return currTask
 
+    @tornado.web.asynchronous
     def get(self):
         """
-        Handle user query request.
+        Handle user query request. The jobs in memory are queried unless the argument "scope=archived" is given.
+        """
+        if self.request.arguments.get('scope') == ['archived']:
+            self.getArchived()
+        else:
+            self.getActive()
+            self.finish()
+
+    def getActive(self):
+        """
+        Handle user query request on the jobs of the dispatch tree.
           1. init timer and result struct
           2. check attributes to retrieve
           3. limit nodes list regarding the given query filters
@@ -197,8 +223,12 @@ class QueryResource(DispatcherBaseResource, IQueryNode):
             #
             # --- Prepare the result json object
             #
+            attributes = tuple(args['attr'])
             for currNode in filteredNodes:
-                currTask = self.createTaskRepr(currNode, args['attr'], tree)
+                if tree:
+                    currTask = json.dumps(self.createTaskRepr(currNode, attributes, tree))
+                else:
+                    currTask = currNode.getCachedRepr(('queryJson',) + attributes, lambda node: json.dumps(self.createTaskRepr(node, attributes)))
                 resultData.append(currTask)
 
             content = {
@@ -207,12 +237,11 @@ class QueryResource(DispatcherBaseResource, IQueryNode):
                     'totalInDispatcher': totalNodes,
                     'requestTime': time.time() - start_time,
                     'requestDate': time.ctime()
-                },
-                'items': resultData
+                }
             }
 
             # Create response and callback
-            self.writeCallback(json.dumps(content))
+            self.writeItemsCallback(content, 'items', resultData)
 
         except KeyError:
             raise Http404('Error unknown key')
@@ -224,7 +253,72 @@ class QueryResource(DispatcherBaseResource, IQueryNode):
             logger.warning('Impossible to retrieve result for query: %s', self.request.uri)
             raise HTTPError(500, "Internal error")
 
+    def getArchived(self):
+        """
+        Handle user query request on archived jobs. Archived jobs are not kept in memory, they are read from the
+        database in a background thread so that the query never blocks the dispatcher loop.
+        Results are paginated, most recent jobs first:
+          - offset: number of jobs to skip (default 0)
+          - limit: number of jobs to return (default ARCHIVE_QUERY_PAGE_SIZE, at most ARCHIVE_QUERY_MAX_PAGE_SIZE)
+        The constraints are the same as for the jobs in memory except constraint_name which is a SQL "LIKE" pattern
+        (e.g. "%comp%") and constraint_status which is not supported.
+        """
+        args = self.request.arguments
+        pulidb = getattr(self.framework.application, 'pulidb', None)
+        if pulidb is None:
+            raise Http400("Archived jobs are only available when the dispatcher database is enabled")
 
+        try:
+            offset = int(args.get('offset', [0])[0])
+            limit = int(args.get('limit', [singletonconfig.get('DB', 'ARCHIVE_QUERY_PAGE_SIZE', 100)])[0])
+        except ValueError:
+            raise Http400("Invalid offset or limit")
+        if offset < 0 or limit <= 0:
+            raise Http400("Invalid offset or limit")
+        limit = min(limit, singletonconfig.get('DB', 'ARCHIVE_QUERY_MAX_PAGE_SIZE', 1000))
+        attributes = args.get('attr', QueryResource.DEFAULT_FIELDS)
+        filters = dict((name, values) for name, values in args.items() if name.startswith('constraint_'))
+        start_time = time.time()
+
+        def onResult(result, error):
+            if isinstance(error, ValueError):
+                raise Http400("Invalid query on archived jobs: %s" % error)
+            elif error is not None:
+                logger.warning('Impossible to retrieve result for query: %s', self.request.uri)
+                raise HTTPError(500, "Internal error")
+
+            jobs, total = result
+            content = {
+                'summary': {
+                    'count': len(jobs),
+                    'totalInDispatcher': total,
+                    'offset': offset,
+                    'limit': limit,
+                    'requestTime': time.time() - start_time,
+                    'requestDate': time.ctime()
+                },
+                'items': [self.createArchivedJobRepr(job, attributes) for job in jobs]
+            }
+            self.writeCallback(json.dumps(content))
+            self.finish()
+
+        self.runInBackground(lambda: pulidb.queryArchivedJobs(filters, offset, limit), onResult)
+
+    def createArchivedJobRepr(self, pJob, pAttributes):
+        """
+        Create the json representation of an archived job, i.e. a dict read from the database (see PuliDB.queryArchivedJobs)
+        param: job dict
+        param: attributes to retrieve
+        return: a json dict
+        """
+        currJob = {}
+        for currArg in pAttributes:
+            if currArg.startswith("tags:"):
+                currArg = unicode(currArg[5:])
+                currJob[currArg] = unicode(pJob['tags'].get(currArg, ''))
+            else:
+                currJob[currArg] = pJob.get(currArg, 'undefined')
+        return currJob
 
     def createJobRepr(self, pNode, recursive=True):
         """
@@ -348,6 +442,10 @@ class RenderNodeQueryResource(DispatcherBaseResource, IQueryNode):
         param: attributes to retrieve on each node
         return: a json dict
         """
+        pAttributes = tuple(pAttributes)
+        return pRenderNode.getCachedRepr(('query',) + pAttributes, lambda rn: self.buildRepr(rn, pAttributes))
+
+    def buildRepr(self, pRenderNode, pAttributes):
         result = {}
         for currArg in pAttributes:
             #
@@ -404,15 +502,16 @@ class RenderNodeQueryResource(DispatcherBaseResource, IQueryNode):
                 args['attr'] = RenderNodeQueryResource.DEFAULT_FIELDS
 
             #
-            # --- filtering
+            # --- filtering (using the rendernodes indexes)
             #
-            filteredRN = self.filterRenderNodes(args, rn)
+            filteredRN = self.getDispatchTree().renderNodeIndex.select(args)
 
             #
             # --- Prepare the result json object
             #
+            attributes = tuple(args['attr'])
             for currNode in filteredRN:
-                currItem = self.createRepr(currNode, args['attr'])
+                currItem = currNode.getCachedRepr(('queryJson',) + attributes, lambda rn: json.dumps(self.createRepr(rn, attributes)))
                 resultData.append(currItem)
 
             content = {
@@ -421,14 +520,13 @@ class RenderNodeQueryResource(DispatcherBaseResource, IQueryNode):
                     'totalInDispatcher': totalNodes,
                     'requestTime': time.time() - start_time,
                     'requestDate': time.ctime()
-                },
-                'items': resultData
+                }
             }
 
             #
             # --- Create response and callback
             #
-            self.writeCallback(json.dumps(content))
+            self.writeItemsCallback(content, 'items', resultData)
 
         except Exception:
             logger.warning('Impossible to retrieve query result for rendernodes: %s', self.request.uri)
@@ -444,69 +542,45 @@ class RenderNodeQueryResource(DispatcherBaseResource, IQueryNode):
 ##################################
 ##################################
 
-class RenderNodeQuery2Resource(DispatcherBaseResource):
+class RenderNodeMatchPlan(object):
     """
+    Compiled form of a query2 request on a single field: {"fieldName": {"match": value}}
+    A string value is a regex, other values are compared for equality. Queries on indexed fields (host, status)
+    evaluate the condition once per distinct value in the index instead of once per rendernode.
+    or/and expressions are not supported yet and match nothing.
     """
-
-    def strMatch(self, field, condition):
-        return True if re.match(condition, field) else False
-
-    def intMatch(self, field, value):
-        raise NotImplementedError
-        pass
-
-    def matchField(self, field, fieldName, condition):
-        self.logger.debug("type: %s" % type(field))
-        currType = type(field)
-
-        if currType == types.StringType:
-            return self.strMatch(field, condition)
-        elif currType == types.IntType:
-            return self.intMatch(field, condition)
-
-        # return True if item.__dict__[field] == condition else False
-        # return True if item.__dict__[field] == value else False
-
-    def matchQuery(self, item):
-        """
-        Parses a given query against the item given.
-        Returns True or False
-        :param item:
-        :return:
-        """
-        self.logger.debug(item)
-        if len(self.queryDict) > 1:
-            self.logger.debug("Invalid query dict")
-            return False
-
-        if ('or' in self.queryDict) or ('and' in self.queryDict):
-            self.logger.debug("or/and")
-            # TODO
-
+    INDEXED_FIELDS = ('host', 'status')
+
+    def __init__(self, queryDict):
+        self.fieldName = None
+        if not isinstance(queryDict, dict) or len(queryDict) != 1 or 'or' in queryDict or 'and' in queryDict:
+            logger.debug("Invalid or unsupported query dict: %r" % queryDict)
+            return
+
+        fieldName, condition = queryDict.items()[0]
+        if not isinstance(condition, dict) or 'match' not in condition:
+            logger.debug("Invalid or unsupported expression: %r" % condition)
+            return
+
+        value = condition['match']
+        if isinstance(value, basestring):
+            regex = re.compile(value)
+            self.matchValue = lambda fieldValue: isinstance(fieldValue, basestring) and regex.match(fieldValue) is not None
         else:
-            self.fieldName = self.queryDict.keys()[0]
-            self.condition = self.queryDict[self.fieldName]
-            self.currObjField = getattr(item, self.fieldName)
-
-            self.logger.debug("Request on single field: %s" % self.fieldName)
-
-            if ('or' in self.condition):
-                self.logger.debug("multivalue expression OR: %s" % self.condition)
-                # TODO
+            self.matchValue = lambda fieldValue: fieldValue == value
+        self.fieldName = str(fieldName)
 
-            elif 'and' in self.condition:
-                self.logger.debug("multivalue expression AND: %s" % self.condition)
-                # TODO
+    def execute(self, index, renderNodes):
+        if self.fieldName is None:
+            return []
+        if self.fieldName in RenderNodeMatchPlan.INDEXED_FIELDS:
+            return sorted(index.lookupMatching(self.fieldName, self.matchValue), key=lambda rn: rn.name)
+        return [rn for rn in renderNodes if self.matchValue(getattr(rn, self.fieldName))]
 
-            elif 'match' in self.condition:
-                self.logger.debug("value expression: %s = %s" % (self.currObjField, self.condition))
-                res = self.matchField(self.currObjField, self.fieldName, self.condition['match'])
-                self.logger.debug('match = %s' % res)
-                return res
-            else:
-                self.logger.debug("invalid expression: %s" % self.value)
 
-        return False
+class RenderNodeQuery2Resource(DispatcherBaseResource):
+    """
+    """
 
     def post(self):
         """
@@ -533,12 +607,15 @@ class RenderNodeQuery2Resource(DispatcherBaseResource):
         try:
             # Get query in body
             try:
-                self.queryDict = json.loads(self.request.body)
+                queryDict = json.loads(self.request.body)
             except Exception as e:
                 self.logger.error(e)
+                queryDict = None
 
-            # Find corresponding rn
-            matches = filter(self.matchQuery, self.getDispatchTree().renderNodes.values())
+            # Find corresponding rn with the compiled query (plans are cached with the index's query plans)
+            index = self.getDispatchTree().renderNodeIndex
+            plan = index.getCachedPlan(('query2', json.dumps(queryDict, sort_keys=True)), lambda: RenderNodeMatchPlan(queryDict))
+            matches = plan.execute(index, self.getDispatchTree().renderNodes.values())
 
             # Prepare json result
             resultData = [n.to_json() for n in matches]
@@ -6,11 +6,14 @@ try:
 except ImportError:
     import json
 import logging
+import tornado
+from tornado.ioloop import IOLoop
 from tornado.web import HTTPError
 
 from octopus.core.communication import HttpResponse, Http400, Http404, Http403, HttpConflict, Http500
 # from octopus.core.enums.rendernode import RN_PAUSED, RN_IDLE, RN_UNKNOWN, RN_BOOTING, RN_ASSIGNED
 from octopus.core.enums.rendernode import *
+from octopus.core.enums.command import CMD_ASSIGNED
 
 from octopus.core import enums, singletonstats, singletonconfig
 from octopus.dispatcher.model import RenderNode
@@ -21,6 +24,151 @@ from octopus.dispatcher.webservice import DispatcherBaseResource
 logger = logging.getLogger("main.dispatcher")
 
 
+def _caracteristics(value):
+    if not isinstance(value, dict):
+        raise ValueError("caracteristics must be an object, not %r" % value)
+    return value
+
+
+# System infos accepted from the workers: key in the message -> (render node attribute, conversion).
+# Static facts are only sent at registration or when a full update is requested, the heartbeats carry the dynamic
+# fields which changed since the previous message. Unknown keys are ignored.
+SYSINFOS_SCHEMA = {
+    # static facts
+    'puliversion': ('puliversion', unicode),
+    'caracteristics': ('caracteristics', _caracteristics),
+    'cores': ('coresNumber', int),
+    'ram': ('ramSize', int),
+    'createDate': ('createDate', float),
+    'speed': ('speed', float),
+    'performance': ('performance', float),
+    # dynamic fields
+    'systemFreeRam': ('systemFreeRam', int),
+    'systemSwapPercentage': ('systemSwapPercentage', float),
+}
+
+
+def updateSysInfos(renderNode, dct):
+    '''
+    Applies the system infos reported by a worker (sysinfos request, heartbeat or registration) on its render node.
+    Only the keys present in dct are modified, see SYSINFOS_SCHEMA.
+    Raises ValueError or TypeError if a value has not the expected type, nothing is modified in this case.
+    '''
+    values = []
+    for key, (attribute, convert) in SYSINFOS_SCHEMA.items():
+        if key in dct:
+            values.append((attribute, convert(dct[key])))
+    if "status" in dct:
+        status = int(dct["status"])
+
+    for attribute, value in values:
+        setattr(renderNode, attribute, value)
+
+    if "status" in dct:
+        if renderNode.status == RN_UNKNOWN:
+            renderNode.status = status
+            logger.info("status reported is %d" % renderNode.status)
+
+        # if renderNode.status != int(dct["status"]):
+        #     logger.warning("The status reported by %s = %r is different from the status on dispatcher %r" % (renderNode.name, RN_STATUS_NAMES[dct["status"]],RN_STATUS_NAMES[renderNode.status]))
+
+    if "isPaused" in dct and "status" in dct:
+        logger.debug("reported for %r: remoteStatus=%r remoteIsPaused=%r" % (renderNode.name, RN_STATUS_NAMES[dct["status"]], dct['isPaused']))
+
+    renderNode.lastAliveTime = time.time()
+    renderNode.isRegistered = True
+
+
+# Keys of SYSINFOS_SCHEMA which do not change while a worker process is running
+STATIC_SYSINFOS = ('puliversion', 'caracteristics', 'cores', 'ram', 'createDate', 'speed', 'performance')
+
+
+def registerRenderNode(dispatchTree, computerName, dct):
+    """
+    Registers the worker `computerName` with the infos it sent (see Worker.registerWorker).
+    Returns a tuple (renderNode, created).
+
+    When the render node is already known and the message comes from the same worker process (same createDate and
+    puliversion, e.g. after a restart of the dispatcher), the registration is idempotent: the static facts and the
+    pools already known are kept, only the state of the node is updated.
+    Raises Http400, Http403 or HttpConflict if the registration is refused, nothing is modified in this case.
+    """
+    computerName = computerName.lower()
+    if computerName.startswith(('1', '2')):
+        raise Http403("Cannot register a RenderNode without a name")
+
+    if computerName in dispatchTree.renderNodes:
+        existingRN = dispatchTree.renderNodes[computerName]
+
+        sameProcess = 'createDate' in dct and 'puliversion' in dct \
+            and dct['createDate'] == existingRN.createDate and dct['puliversion'] == existingRN.puliversion
+        if sameProcess:
+            infos = dict((key, value) for key, value in dct.items() if key not in STATIC_SYSINFOS)
+        else:
+            # static facts are only sent at registration, the worker might have been upgraded or modified
+            infos = dct
+        try:
+            updateSysInfos(existingRN, infos)
+        except (ValueError, TypeError), e:
+            raise Http400("Invalid system infos: %s" % e)
+
+        if 'commands' not in dct:
+            # No commands in current RN, reset command that might be still assigned to this RN
+            existingRN.reset()
+        else:
+            logger.warning("Reset commands that are assigned to this RN: %r" % dct.get('commands', '-'))
+            for cmdId in dct['commands']:
+                if cmdId in dispatchTree.commands:
+                    existingRN.commands[cmdId] = dispatchTree.commands[cmdId]
+            existingRN.invalidateRepr()
+
+        if 'status' in dct:
+            existingRN.status = int(dct['status'])
+        # the worker might have been upgraded or restarted in another mode
+        existingRN.acceptsBatchAssignments = True
+        existingRN.pullMode = bool(dct.get('pullMode', False))
+        return (existingRN, False)
+
+    # Add a new worker (and set infos given in request body)
+    for key in ('name', 'port', 'status', 'cores', 'speed', 'ram', 'pools', 'caracteristics'):
+        if not key in dct:
+            raise Http400("Missing key %r" % key)
+    try:
+        status = int(dct['status'])
+        cores = int(dct['cores'])
+        speed = float(dct['speed'])
+        ram = int(dct['ram'])
+        caracteristics = _caracteristics(dct['caracteristics'])
+    except (ValueError, TypeError), e:
+        raise Http400("Invalid system infos: %s" % e)
+    if status not in (RN_UNKNOWN, RN_PAUSED, RN_IDLE, RN_BOOTING):
+        # FIXME: CONFLICT is not a good value maybe
+        raise HttpConflict("Unallowed status for RenderNode registration")
+    name, port = computerName.split(":", 1)
+
+    # check the existence of the pools
+    poolList = []
+    for poolName in dct['pools']:
+        try:
+            poolList.append(dispatchTree.pools[poolName])
+        except KeyError:
+            raise HttpConflict("Pool %s is not a registered pool" % poolName)
+
+    puliversion = dct.get('puliversion', "unknown")
+    createDate = dct.get('createDate', time.time())
+
+    renderNode = RenderNode(None, computerName, cores, speed, name, port, ram, caracteristics, puliversion=puliversion, createDate=createDate)
+    renderNode.status = status
+    renderNode.pullMode = bool(dct.get('pullMode', False))
+    # add the rendernode to the pools
+    for pool in poolList:
+        pool.addRenderNode(renderNode)
+    # add the rendernode to the list of rendernodes
+    renderNode.pools = poolList
+    dispatchTree.renderNodes[renderNode.name] = renderNode
+    return (renderNode, True)
+
+
 class RenderNodesResource(DispatcherBaseResource):
     """
     Lists the render nodes known by the dispatcher.
@@ -29,9 +177,54 @@ class RenderNodesResource(DispatcherBaseResource):
 
     def get(self):
         rendernodes = self.getDispatchTree().renderNodes.values()
-        content = {'rendernodes': list(rendernode.to_json() for rendernode in rendernodes)}
-        content = json.dumps(content)
-        self.writeCallback(content)
+        fragments = [rendernode.getCachedRepr('jsonString', lambda rn: json.dumps(rn.to_json())) for rendernode in rendernodes]
+        self.writeItemsCallback({}, 'rendernodes', fragments)
+
+    @tornado.web.asynchronous
+    def post(self):
+        """
+        | Registers several workers in a single request, for instance from a proxy or a farm management tool
+        | gathering the registrations of a large number of workers.
+        | The registrations are done in time slices of the IOLoop (see runInTimeSlices), each one as in
+        | RenderNodeResource.post.
+        |
+        | URL: POST http://server:8004/rendernodes/
+        | Body: { rendernodes: { <name:port>: { registration infos } } }
+        | Returns: { registered: [names], updated: [names], errors: { <name:port>: message } }
+        """
+        data = self.getBodyAsJSON()
+        if not isinstance(data, dict) or not isinstance(data.get('rendernodes'), dict):
+            raise Http400("Missing key 'rendernodes'")
+        self.result = {'registered': [], 'updated': [], 'errors': {}}
+        self.runInTimeSlices(self.iterOnRegistrations(data['rendernodes']), self.sendResult)
+
+    def iterOnRegistrations(self, registrations):
+        for computerName, dct in registrations.iteritems():
+            if singletonconfig.get('CORE', 'GET_STATS'):
+                singletonstats.theStats.cycleCounts['add_rns'] += 1
+            try:
+                renderNode, created = registerRenderNode(self.getDispatchTree(), computerName, dct)
+            except HTTPError, e:
+                self.result['errors'][computerName] = e.log_message
+            else:
+                self.result['registered' if created else 'updated'].append(renderNode.name)
+            yield
+
+    def sendResult(self):
+        logger.info("Bulk registration: %d registered, %d updated, %d errors" % (
+            len(self.result['registered']), len(self.result['updated']), len(self.result['errors'])))
+        self.writeCallback(json.dumps(self.result))
+        self.finish()
+
+
+class RenderNodesHealthResource(DispatcherBaseResource):
+    def get(self):
+        '''
+        Returns the health of each render node: state of its circuit breaker, request latency, decayed failure and
+        command error rates and resulting score (see RenderNodeHealth).
+        '''
+        rendernodes = self.getDispatchTree().renderNodes.values()
+        self.writeCallback(json.dumps(dict((rn.name, rn.health.to_json()) for rn in rendernodes)))
 
 
 class RenderNodeResource(DispatcherBaseResource):
@@ -57,68 +250,14 @@ class RenderNodeResource(DispatcherBaseResource):
         if singletonconfig.get('CORE', 'GET_STATS'):
             singletonstats.theStats.cycleCounts['add_rns'] += 1
 
-        computerName = computerName.lower()
-        if computerName.startswith(('1', '2')):
-            return Http403(message="Cannot register a RenderNode without a name", content="Cannot register a RenderNode without a name")
-
         dct = self.getBodyAsJSON()
-
-        if computerName in self.getDispatchTree().renderNodes:
+        renderNode, created = registerRenderNode(self.getDispatchTree(), computerName, dct)
+        if not created:
             # When the registering worker is already listed in RN list
-            logger.warning("RenderNode already registered: %s" % computerName)
-            existingRN = self.getDispatchTree().renderNodes[computerName]
-
-            if 'commands' not in dct:
-                # No commands in current RN, reset command that might be still assigned to this RN
-                existingRN.reset()
-            else:
-                logger.warning("Reset commands that are assigned to this RN: %r" % dct.get('commands', '-'))
-                for cmdId in dct['commands']:
-                    existingRN.commands[cmdId] = self.getDispatchTree().commands[cmdId]
-
-            if 'status' in dct:
-                existingRN.status = int(dct['status'])
-
+            logger.warning("RenderNode already registered: %s" % renderNode.name)
             return HttpResponse(304, "RenderNode already registered.")
 
-        else:
-            # Add a new worker (and set infos given in request body)
-            for key in ('name', 'port', 'status', 'cores', 'speed', 'ram', 'pools', 'caracteristics'):
-                if not key in dct:
-                    return Http400("Missing key %r" % key, content="Missing key %r" % key)
-            port = int(dct['port'])
-            status = int(dct['status'])
-            if status not in (RN_UNKNOWN, RN_PAUSED, RN_IDLE, RN_BOOTING):
-                # FIXME: CONFLICT is not a good value maybe
-                return HttpConflict("Unallowed status for RenderNode registration")
-            cores = int(dct['cores'])
-            speed = float(dct['speed'])
-            ram = int(dct['ram'])
-            pools = dct['pools']
-            caracteristics = dct['caracteristics']
-            name, port = computerName.split(":", 1)
-
-            puliversion = dct.get('puliversion', "unknown")
-            createDate = dct.get('createDate', time.time())
-
-            renderNode = RenderNode(None, computerName, cores, speed, name, port, ram, caracteristics, puliversion=puliversion, createDate=createDate)
-
-            renderNode.status = status
-            poolList = []
-            # check the existence of the pools
-            for poolName in pools:
-                try:
-                    pool = self.getDispatchTree().pools[poolName]
-                    poolList.append(pool)
-                except KeyError:
-                    return HttpConflict("Pool %s is not a registered pool", poolName)
-            # add the rendernode to the pools
-            for pool in poolList:
-                pool.addRenderNode(renderNode)
-            # add the rendernode to the list of rendernodes
-            renderNode.pools = poolList
-            self.getDispatchTree().renderNodes[renderNode.name] = renderNode
-            self.writeCallback(json.dumps(renderNode.to_json()))
+        self.writeCallback(json.dumps(renderNode.to_json()))
 
     #@queue
     def put(self, computerName):
@@ -182,7 +321,7 @@ class RenderNodeCommandsResource(DispatcherBaseResource):
         updateDict['renderNodeName'] = computerName
 
         try:
-            self.framework.application.updateCommandApply(updateDict)
+            self.framework.application.queueCommandUpdate(updateDict)
         except (KeyError, IndexError) as e:
             raise Http404(str(e))
         except Exception, e:
@@ -229,38 +368,51 @@ class RenderNodeSysInfosResource(DispatcherBaseResource):
             raise Http404("RenderNode not found")
 
         dct = self.getBodyAsJSON()
-        renderNode = rns[computerName]
-        if "puliversion" in dct:
-            renderNode.puliversion = dct.get('puliversion', "unknown")
-        if "caracteristics" in dct:
-            renderNode.caracteristics = eval(str(dct["caracteristics"]))
-        if "cores" in dct:
-            renderNode.cores = int(dct["cores"])
-        if "createDate" in dct:
-            renderNode.createDate = int(dct["createDate"])
-        if "ram" in dct:
-            renderNode.ram = int(dct["ram"])
-        if "systemFreeRam" in dct:
-            renderNode.systemFreeRam = int(dct["systemFreeRam"])
-        if "systemSwapPercentage" in dct:
-            renderNode.systemSwapPercentage = float(dct["systemSwapPercentage"])
-        if "speed" in dct:
-            renderNode.speed = float(dct["speed"])
-        if "performance" in dct:
-            renderNode.performance = float(dct["performance"])
-        if "status" in dct:
-            if renderNode.status == RN_UNKNOWN:
-                renderNode.status = int(dct["status"])
-                logger.info("status reported is %d" % renderNode.status)
-
-            # if renderNode.status != int(dct["status"]):
-            #     logger.warning("The status reported by %s = %r is different from the status on dispatcher %r" % (renderNode.name, RN_STATUS_NAMES[dct["status"]],RN_STATUS_NAMES[renderNode.status]))
-
-        if "isPaused" in dct and "status" in dct:
-            logger.debug("reported for %r: remoteStatus=%r remoteIsPaused=%r" % (renderNode.name, RN_STATUS_NAMES[dct["status"]], dct['isPaused']))
+        try:
+            updateSysInfos(rns[computerName], dct)
+        except (ValueError, TypeError), e:
+            raise Http400("Invalid system infos: %s" % e)
 
-        renderNode.lastAliveTime = time.time()
-        renderNode.isRegistered = True
+
+class RenderNodeHeartbeatResource(DispatcherBaseResource):
+    #@queue
+    def put(self, computerName):
+        '''
+        Consolidated heartbeat of a worker: its system infos (optional) and the updates of all its modified commands,
+        applied in one batch instead of a sysinfos request and one request per command.
+            {"sysinfos": {"status": ..., "systemFreeRam": ..., ...}, "commands": [{"id": ..., "status": ..., "completion": ...}]}
+
+        Returns "404" if the render node is unknown (the worker has to register again), else the list of the commands
+        the dispatcher does not know anymore (the worker has to forget them): {"unknownCommands": [ids]}
+        '''
+        computerName = computerName.lower()
+        rns = self.getDispatchTree().renderNodes
+
+        if not computerName in rns:
+            raise Http404("RenderNode not found")
+
+        dct = self.getBodyAsJSON()
+        commandUpdates = dct.get('commands', [])
+        if singletonconfig.get('CORE', 'GET_STATS'):
+            singletonstats.theStats.cycleCounts['update_commands'] += len(commandUpdates)
+
+        try:
+            updateSysInfos(rns[computerName], dct.get('sysinfos', {}))
+        except (ValueError, TypeError), e:
+            raise Http400("Invalid system infos: %s" % e)
+
+        unknownCommands = []
+        for updateDict in commandUpdates:
+            updateDict['renderNodeName'] = computerName
+            try:
+                self.framework.application.queueCommandUpdate(updateDict)
+            except (KeyError, IndexError) as e:
+                logger.warning("Update of command %r from %s ignored: %s" % (updateDict.get('id'), computerName, e))
+                unknownCommands.append(updateDict.get('id'))
+            except Exception, e:
+                logger.exception("Exception during update of command %r from %s" % (updateDict.get('id'), computerName))
+
+        self.writeCallback(json.dumps({'unknownCommands': unknownCommands}))
 
 
 class RenderNodesPerfResource(DispatcherBaseResource):
@@ -291,6 +443,86 @@ class RenderNodeResetResource(DispatcherBaseResource):
             renderNode.reset()
 
 
+class RenderNodeAssignmentsResource(DispatcherBaseResource):
+    '''
+    Pull mode: instead of receiving its assignments, a worker polls for them. The request is held until the next
+    dispatcher cycle assigns commands to the render node (or a kill order is given) or the timeout expires.
+        {"timeout": 30, "refused": [ids of the commands of the previous response the worker could not start]}
+
+    The response holds the assignments in the same format as a batch assignment (POST /commands/batch/ on the worker)
+    and the ids of the commands to kill: {"tasks": {...}, "commands": [...], "kill": [ids]}
+    or is empty (204) when the timeout is expired.
+    '''
+
+    @tornado.web.asynchronous
+    def post(self, computerName):
+        computerName = computerName.lower()
+        try:
+            self.renderNode = self.getDispatchTree().renderNodes[computerName]
+        except KeyError:
+            raise Http404("RenderNode not found")
+
+        dct = self.getBodyAsJSON() if self.request.body else {}
+        renderNode = self.renderNode
+        renderNode.pullMode = True
+        renderNode.lastAliveTime = time.time()
+
+        if dct.get('refused'):
+            self.dispatcher.pulledAssignmentsRefused(renderNode, dct['refused'])
+
+        if renderNode.pendingAssignments or renderNode.pendingKills:
+            self.sendAssignments()
+            return
+
+        # only one poll is held per render node, the previous one has been abandoned by the worker
+        renderNode.notifyAssignmentWaiter()
+
+        maxTimeout = singletonconfig.get('COMMUNICATION', 'PULL_MAX_TIMEOUT', 60)
+        timeout = min(float(dct.get('timeout', maxTimeout)), maxTimeout)
+        self.timeoutHandle = IOLoop.instance().add_timeout(time.time() + timeout, self.onTimeout)
+        renderNode.assignmentWaiter = self.sendAssignments
+
+    def sendAssignments(self):
+        renderNode = self.renderNode
+        self.cancelWait()
+
+        # the commands might have been canceled or reassigned since the cycle which assigned them
+        commands = [command for command in renderNode.pendingAssignments if command.renderNode is renderNode and command.status == CMD_ASSIGNED]
+        kills = renderNode.pendingKills
+        renderNode.pendingAssignments = []
+        renderNode.pendingKills = []
+
+        if not commands and not kills:
+            self.set_status(204)
+            self.finish()
+            return
+
+        content = self.dispatcher.getBatchAssignmentPayload(renderNode, commands)
+        content['kill'] = kills
+        for command in commands:
+            logging.getLogger('main.dispatcher').info("Sent assignment of command %d to worker %s", command.id, renderNode.name)
+        self.writeCallback(json.dumps(content))
+        self.finish()
+
+    def onTimeout(self):
+        self.timeoutHandle = None
+        if self.renderNode.assignmentWaiter == self.sendAssignments:
+            self.renderNode.assignmentWaiter = None
+        self.set_status(204)
+        self.finish()
+
+    def cancelWait(self):
+        if getattr(self, 'timeoutHandle', None) is not None:
+            IOLoop.instance().remove_timeout(self.timeoutHandle)
+            self.timeoutHandle = None
+        if self.renderNode.assignmentWaiter == self.sendAssignments:
+            self.renderNode.assignmentWaiter = None
+
+    def on_connection_close(self):
+        # the assignments stay pending until the next poll
+        self.cancelWait()
+
+
 class RenderNodeQuarantineResource(DispatcherBaseResource):
     def put(self):
         """
@@ -21,7 +21,7 @@ from tornado.web import Application
 from octopus.core.communication.http import Http500
 from octopus.dispatcher.webservice import commands, rendernodes, graphs, nodes,\
     tasks, poolshares, pools, licenses, \
-    query, edit
+    query, edit, cancellations
 
 from octopus.core.enums.command import *
 from octopus.dispatcher.webservice import DispatcherBaseResource
@@ -45,9 +45,12 @@ class WebServiceDispatcher(Application):
             (r'/rendernodes/?$', rendernodes.RenderNodesResource, dict(framework=framework)),
             (r'/rendernodes/performance/?$', rendernodes.RenderNodesPerfResource, dict(framework=framework)),
             (r'/rendernodes/quarantine/?$', rendernodes.RenderNodeQuarantineResource, dict(framework=framework)),
+            (r'/rendernodes/health/?$', rendernodes.RenderNodesHealthResource, dict(framework=framework)),
             (r'/rendernodes/((?:\d+)|(?:[\w.-]+:\d+))/?$', rendernodes.RenderNodeResource, dict(framework=framework)),
             (r'/rendernodes/((?:\d+)|(?:[\w.-]+:\d+))/commands/(\d+)/?$', rendernodes.RenderNodeCommandsResource, dict(framework=framework)),
             (r'/rendernodes/((?:\d+)|(?:[\w.-]+:\d+))/sysinfos/?$', rendernodes.RenderNodeSysInfosResource, dict(framework=framework)),
+            (r'/rendernodes/((?:\d+)|(?:[\w.-]+:\d+))/heartbeat/?$', rendernodes.RenderNodeHeartbeatResource, dict(framework=framework)),
+            (r'/rendernodes/((?:\d+)|(?:[\w.-]+:\d+))/assignments/?$', rendernodes.RenderNodeAssignmentsResource, dict(framework=framework)),
             (r'/rendernodes/((?:\d+)|(?:[\w.-]+:\d+))/paused/?$', rendernodes.RenderNodePausedResource, dict(framework=framework)),
             (r'/rendernodes/((?:\d+)|(?:[\w.-]+:\d+))/reset/?$', rendernodes.RenderNodeResetResource, dict(framework=framework)),
 
@@ -69,6 +72,9 @@ class WebServiceDispatcher(Application):
             (r'^/nodes/(\d+)/prod/?$', nodes.NodeProdResource, dict(framework=framework)),
             (r'^/nodes/(\d+)/maxAttempt/?$', nodes.NodeMaxAttemptResource, dict(framework=framework)),
 
+            (r'^/cancellations/?$', cancellations.CancellationsResource, dict(framework=framework)),
+            (r'^/cancellations/(\d+)/?$', cancellations.CancellationResource, dict(framework=framework)),
+
             (r'^/tasks/?$', tasks.TasksResource, dict(framework=framework)),
             (r'^/tasks/delete/?$', tasks.DeleteTasksResource, dict(framework=framework)),
             (r'^/tasks/(\d+)/?$', tasks.TaskResource, dict(framework=framework)),
@@ -97,6 +103,7 @@ class WebServiceDispatcher(Application):
             (r'^/edit/prio$', edit.EditPrioResource, dict(framework=framework)),
             (r'^/pause$', edit.PauseResource, dict(framework=framework)),
             (r'^/resume$', edit.ResumeResource, dict(framework=framework)),
+            (r'^/edit/bulk$', edit.BulkEditResource, dict(framework=framework)),
 
             (r'^/query/rn$', query.RenderNodeQueryResource, dict(framework=framework)),
 
@@ -121,60 +128,66 @@ class WebServiceDispatcher(Application):
         self.framework = framework
 
 
-class StatsResource(DispatcherBaseResource):
-    def get(self):
-        from octopus.core.enums.rendernode import RN_UNKNOWN, RN_STATUS_NAMES
-        from octopus.core.enums.node import NODE_STATUS_NAMES
-
-        tree = self.getDispatchTree()
-
-        #
-        # Get info on commands
-        #
-        commandsByStatus = {}
-        for name in CMD_STATUS_NAME:
-            commandsByStatus[name] = 0
-        for command in tree.commands.values():
-            status = CMD_STATUS_NAME[command.status]
-            commandsByStatus[status] += 1
-
-        commandsByStatus['TOTAL'] = len(tree.commands)
+def computeStats(tree, licenseManager):
+    """
+    Returns the figures served on /stats: commands, rendernodes and jobs by status and the licenses usage.
+    Also sent with the snapshots of the query replicas (see octopus.dispatcher.replica).
+    """
+    from octopus.core.enums.rendernode import RN_UNKNOWN, RN_STATUS_NAMES
+    from octopus.core.enums.node import NODE_STATUS_NAMES
+
+    #
+    # Get info on commands
+    #
+    commandsByStatus = {}
+    for name in CMD_STATUS_NAME:
+        commandsByStatus[name] = 0
+    for command in tree.commands.values():
+        status = CMD_STATUS_NAME[command.status]
+        commandsByStatus[status] += 1
+
+    commandsByStatus['TOTAL'] = len(tree.commands)
+
+    #
+    # Get info rendernodes
+    #
+    renderNodeStats = {'totalCores': 0, 'idleCores': 0, 'missingRenderNodes': 0}
+    renderNodeByStatus = dict(((status, 0) for status in RN_STATUS_NAMES))
+
+    for node in tree.renderNodes.values():
+        if node.status != RN_UNKNOWN:
+            renderNodeStats['totalCores'] += node.coresNumber
+            renderNodeStats['idleCores'] += node.freeCoresNumber
+        else:
+            renderNodeStats['missingRenderNodes'] += 1
+        renderNodeByStatus[RN_STATUS_NAMES[node.status]] += 1
+    renderNodeStats['renderNodesByStatus'] = renderNodeByStatus
+
+    #
+    # Get info on jobs (first level of hierarchy)
+    #
+    jobsByStatus = dict(((status, 0) for status in NODE_STATUS_NAMES))
+    for node in tree.nodes[1].children:
+        jobsByStatus[NODE_STATUS_NAMES[node.status]] += 1
+    jobsByStatus['TOTAL'] = len(tree.nodes[1].children)
+
+    #
+    # Final recap
+    #
+    stats = {
+        'date': time.time(),
+        'commands': commandsByStatus,
+        'rendernodes': renderNodeStats,
+        'jobs': jobsByStatus,
+        'licenses': repr(licenseManager),
+        'licensesDict': licenseManager.stats()
+    }
+    return stats
 
-        #
-        # Get info rendernodes
-        #
-        renderNodeStats = {'totalCores': 0, 'idleCores': 0, 'missingRenderNodes': 0}
-        renderNodeByStatus = dict(((status, 0) for status in RN_STATUS_NAMES))
 
-        for node in tree.renderNodes.values():
-            if node.status != RN_UNKNOWN:
-                renderNodeStats['totalCores'] += node.coresNumber
-                renderNodeStats['idleCores'] += node.freeCoresNumber
-            else:
-                renderNodeStats['missingRenderNodes'] += 1
-            renderNodeByStatus[RN_STATUS_NAMES[node.status]] += 1
-        renderNodeStats['renderNodesByStatus'] = renderNodeByStatus
-
-        #
-        # Get info on jobs (first level of hierarchy)
-        #
-        jobsByStatus = dict(((status, 0) for status in NODE_STATUS_NAMES))
-        for node in tree.nodes[1].children:
-            jobsByStatus[NODE_STATUS_NAMES[node.status]] += 1
-        jobsByStatus['TOTAL'] = len(tree.nodes[1].children)
-
-        #
-        # Final recap
-        #
-        stats = {
-            'date': time.time(),
-            'commands': commandsByStatus,
-            'rendernodes': renderNodeStats,
-            'jobs': jobsByStatus,
-            'licenses': repr(self.dispatcher.licenseManager),
-            'licensesDict': self.dispatcher.licenseManager.stats()
-        }
-        self.writeCallback(stats)
+class StatsResource(DispatcherBaseResource):
+    def get(self):
+        self.writeCallback(computeStats(self.getDispatchTree(), self.dispatcher.licenseManager))
 
 
 class MobileResource(DispatcherBaseResource):
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+'''
+Read-only query replica of the dispatcher.
+Serves the query webservices from the snapshots pushed by the dispatcher (see octopus.dispatcher.replica).
+'''
+
+import logging
+import logging.handlers
+import optparse
+import os
+import tornado
+
+#
+# Init singleton object holding reloadable config values
+# Must be done in the very first place because some import might ask for config value
+#
+from octopus.dispatcher import settings
+from octopus.core import singletonconfig
+
+singletonconfig.load(settings.CONFDIR + "/config.ini")
+
+from octopus.dispatcher.replica import ReplicaFramework
+
+
+def process_args():
+    parser = optparse.OptionParser()
+    parser.add_option("-p", "--port", action="store", type="int", dest="PORT", metavar="PORT", help="change the PORT the replica is listening on")
+    parser.add_option("-D", "--debug", action="store_true", dest="DEBUG", help="changes the default log level to DEBUG")
+    parser.add_option("-C", "--console", action="store_true", dest="CONSOLE", default=False, help="output logs to the console")
+    options, args = parser.parse_args()
+    if options.PORT is None:
+        options.PORT = singletonconfig.get('REPLICA', 'REPLICA_PORT', 8005)
+    return options
+
+
+def setup_logging(options):
+    if not os.path.exists(settings.LOGDIR):
+        os.makedirs(settings.LOGDIR, 0755)
+
+    fileHandler = logging.handlers.RotatingFileHandler(
+        os.path.join(settings.LOGDIR, "queryreplica.log"),
+        maxBytes=singletonconfig.get('CORE', 'LOG_SIZE'),
+        backupCount=singletonconfig.get('CORE', 'LOG_BACKUPS'),
+        encoding="UTF-8")
+    fileHandler.setFormatter(logging.Formatter("%(asctime)s %(name)10s %(levelname)s %(message)s"))
+
+    logLevel = logging.DEBUG if options.DEBUG else singletonconfig.get('CORE', 'LOG_LEVEL')
+    logging.getLogger().addHandler(fileHandler)
+    logging.getLogger().setLevel(logLevel)
+
+    if options.CONSOLE:
+        consoleHandler = logging.StreamHandler()
+        consoleHandler.setFormatter(logging.Formatter("%(asctime)s %(name)10s %(levelname)6s %(message)s", '%Y-%m-%d %H:%M:%S'))
+        consoleHandler.setLevel(logLevel)
+        logging.getLogger().addHandler(consoleHandler)
+
+    logging.getLogger('main.webservice').setLevel(logging.ERROR)
+
+
+def main():
+    options = process_args()
+    setup_logging(options)
+
+    logging.getLogger('main').warning("Starting PULI query replica on port:%d.", options.PORT)
+    ReplicaFramework(options.PORT)
+    try:
+        tornado.ioloop.IOLoop.instance().start()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    logging.getLogger('main').warning("Bye.")
+
+
+if __name__ == '__main__':
+    main()
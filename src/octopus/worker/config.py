@@ -16,6 +16,12 @@ __copyright__ = "Copyright 2013, Mikros Image"
 # PROCESS BEHAVIOUR
 #
 LIST_ALLOWED_PROCESSES_WHEN_PAUSING_WORKER = ['python', 'python2.6', 'python2.7', 'bash', 'sshd', 'respawnerd', 'workerd']
+WORKER_KILL_DELAY = 5                              # delay in seconds between the SIGTERM sent to the processes of a killed command and the SIGKILL to the remaining ones
+WORKER_PIN_COMMANDS = True                         # pin each command sharing the host with other commands on its reserved number of cpus
+WORKER_FORKSERVER = True                           # fork the command watchers from a server with their modules loaded instead of starting a python each time (not for rez-managed workers)
+WORKER_FORKSERVER_PRELOAD = []                     # runners imported by the fork server at startup, e.g. ["puliclient.jobs.DefaultCommandRunner"]
+WORKER_REZ_CACHE_SIZE = 32                         # number of resolved rez contexts kept by a rez-managed worker (one per list of watcher packages)
+WORKER_REZ_CACHE_TTL = 600                         # delay in seconds after which a cached rez context is resolved again (new package releases)
 
 #
 # COMUNICATION BEHAVIOUR
@@ -23,10 +29,33 @@ LIST_ALLOWED_PROCESSES_WHEN_PAUSING_WORKER = ['python', 'python2.6', 'python2.7'
 WORKER_SYSINFO_DELAY = 8                           # interval between 2 heartbeats to the server (usually few seconds)
 WORKER_MAX_SYSINFO_DELAY = 900                     # interval between 2 full update to the server (usually several minutes)
 
-WORKER_REGISTER_DELAY_AFTER_FAILURE = 15           # wait 15s before retrying to register to the server
+WORKER_REGISTER_DELAY_AFTER_FAILURE = 15           # wait 7.5 to 15s before retrying to register to the server (the delay doubles at each failure)
+WORKER_REGISTER_MAX_DELAY = 120                    # maximum delay between 2 registration attempts
+WORKER_REGISTER_JITTER = 30                        # when the server asks for a new registration, random delay (up to 30s) before the first attempt
 
-WORKER_REQUEST_MAX_RETRY_COUNT = 8                 # nb of retry for a failed request
-WORKER_REQUEST_DELAY_AFTER_REQUEST_FAILURE = .5    # wait 500ms before resending a request in case of failure (each retry will have a 2 x longer delay)
+WORKER_SAMPLING_DELAY = 2                          # interval in seconds between 2 samples of the system (cpu, memory, swap, io)
+WORKER_SAMPLES_SIZE = 150                          # number of samples kept by the worker (5 minutes)
+WORKER_ACCOUNTING_DELAY = 30                       # interval between 2 reports of the resources used by a running command (cpu time, memory, io)
+
+WORKER_KILLFILE_CHECK_DELAY = 1                    # interval between 2 checks of the killfile when its directory cannot be watched (inotify)
+
+WORKER_PULL_MODE = False                           # poll the server for assignments instead of receiving them (e.g. worker not reachable by the server)
+WORKER_PULL_TIMEOUT = 30                           # delay in seconds a poll is held by the server when there is no assignment
+
+WORKER_IPC_SOCKET = True                           # the command watchers send their updates on a local unix socket instead of the webservice
+
+WORKER_UPDATE_BATCH_SIZE = 100                     # maximum number of command updates sent in a heartbeat
+WORKER_UPDATE_SPOOL_SIZE = 1000                    # maximum number of command updates kept on disk while the server is not reachable
+WORKER_UPDATE_TIMEOUT = 10                         # timeout in seconds of a heartbeat request
+
+WORKER_REQUEST_DELAY_AFTER_REQUEST_FAILURE = .5    # wait 500ms before resending a heartbeat in case of failure (each retry will have a 1.5 x longer delay, up to WORKER_SYSINFO_DELAY)
+
+WORKER_LOG_CHUNK_SIZE = 65536                      # size of the blocks read from the logs and sent by the webservice
+WORKER_LOG_FOLLOW_TIMEOUT = 30                     # delay in seconds a follow request on a log is held when there is no new content
+WORKER_LOG_FOLLOW_INTERVAL = .5                    # interval between 2 checks of the size of a followed log
+WORKER_COMPRESS_LOGS = True                        # compress the logs of the finished commands with gzip (transparent for the webservice)
+WORKER_COMPRESS_LOGS_MIN_SIZE = 65536              # logs smaller than this size in bytes are not compressed
+WORKER_COMPRESS_LOGS_DELAY = 30                    # a log is compressed once it has not been modified for this delay in seconds
 
 #
 # Indicate the log file size in bytes and number of file backups --> 2Mo x 10
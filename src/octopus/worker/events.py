@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Wait of the worker main loop for its events.
+
+The main loop sleeps until something happens instead of polling:
+    - wake() is called by the other threads: orders of the webservice (see WSAppFramework.addAction), end of a
+      command watcher process
+    - a file is created, modified or removed in a watched directory (inotify, e.g. the directory of the killfile)
+    - data can be read on a watched file descriptor (e.g. the socket of the command watchers updates)
+    - a timer is due (heartbeats, command timeouts)
+
+The timers are named, setting a timer again replaces its previous deadline. They are kept in a heap, the replaced
+entries are discarded lazily when they reach its top.
+"""
+__author__ = "Jerome Samson"
+__copyright__ = "Copyright 2014, Mikros Image"
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import heapq
+import logging
+import os
+import select
+import struct
+import time
+
+LOGGER = logging.getLogger("worker.events")
+
+# inotify flags, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_IGNORED = 0x00008000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def loadInotify():
+    '''
+    Returns the (inotify_init, inotify_add_watch) functions of the libc, or None if inotify is not available.
+    '''
+    try:
+        # find_library runs an external command (ldconfig), only done once
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        return (libc.inotify_init, libc.inotify_add_watch)
+    except (OSError, AttributeError), e:
+        LOGGER.debug("inotify is not available: %r" % e)
+        return None
+
+INOTIFY = loadInotify()
+
+
+def setNonBlocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class EventWaiter(object):
+
+    def __init__(self):
+        self.readFd, self.writeFd = os.pipe()
+        setNonBlocking(self.readFd)
+        setNonBlocking(self.writeFd)
+        self.timers = {}
+        self.heap = []
+        self.inotifyFd = None
+        self.readers = []
+
+    def addReader(self, fd):
+        '''
+        Interrupts the waits when data can be read on `fd`, reading it is up to the caller.
+        '''
+        self.readers.append(fd)
+
+    def wake(self):
+        '''
+        Interrupts the current or next wait, can be called from any thread.
+        '''
+        try:
+            os.write(self.writeFd, 'x')
+        except OSError, e:
+            # the pipe is full: a wake up is pending anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def setTimer(self, name, when):
+        if self.timers.get(name) == when:
+            return
+        self.timers[name] = when
+        heapq.heappush(self.heap, (when, name))
+
+    def cancelTimer(self, name):
+        self.timers.pop(name, None)
+
+    def hasTimer(self, name):
+        return name in self.timers
+
+    def nextDeadline(self):
+        while self.heap:
+            when, name = self.heap[0]
+            if self.timers.get(name) == when:
+                return when
+            heapq.heappop(self.heap)
+        return None
+
+    @property
+    def watching(self):
+        return self.inotifyFd is not None
+
+    def watchDirectory(self, path):
+        '''
+        Watches the changes of the files in the directory `path`, they interrupt the waits.
+        Returns False if the directory cannot be watched (inotify not available, missing directory...).
+        '''
+        if INOTIFY is None:
+            return False
+        inotifyInit, inotifyAddWatch = INOTIFY
+        fd = inotifyInit()
+        if fd < 0:
+            return False
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        if inotifyAddWatch(fd, path, mask) < 0:
+            LOGGER.debug("Impossible to watch %s: %s" % (path, os.strerror(ctypes.get_errno())))
+            os.close(fd)
+            return False
+        setNonBlocking(fd)
+        self.inotifyFd = fd
+        return True
+
+    def readWatchEvents(self):
+        try:
+            data = os.read(self.inotifyFd, 4096)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size + length
+            if mask & IN_IGNORED:
+                # the watched directory has been removed
+                LOGGER.debug("Watched directory removed")
+                os.close(self.inotifyFd)
+                self.inotifyFd = None
+                return
+
+    def wait(self):
+        '''
+        Blocks until wake() is called, a watched file changes, a watched file descriptor is readable or the next timer
+        is due.
+        '''
+        deadline = self.nextDeadline()
+        timeout = None if deadline is None else max(0.0, deadline - time.time())
+        fds = [self.readFd] + self.readers
+        if self.inotifyFd is not None:
+            fds.append(self.inotifyFd)
+        try:
+            readable = select.select(fds, [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+
+        if self.readFd in readable:
+            try:
+                while os.read(self.readFd, 4096):
+                    pass
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+        if self.inotifyFd is not None and self.inotifyFd in readable:
+            self.readWatchEvents()
+
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            when, name = heapq.heappop(self.heap)
+            if self.timers.get(name) == when:
+                del self.timers[name]
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Local channel between the command watchers and the worker.
+
+The command watchers publish the updates of their command (completion, status, message, stats, validation) as JSON
+datagrams on a Unix socket of the worker instead of HTTP requests to its webservice. The socket is given to the
+command watchers in the PULI_WORKER_SOCKET environment variable, they fall back to HTTP when it is not available.
+The datagrams of a Unix socket are neither lost nor reordered, and each one holds a whole update.
+
+The socket is watched by the wait of the main loop (see EventWaiter), the worker reads all the pending updates in
+one pass.
+"""
+__author__ = "Jerome Samson"
+__copyright__ = "Copyright 2014, Mikros Image"
+
+import errno
+import fcntl
+import logging
+import os
+import socket
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+LOGGER = logging.getLogger("worker.ipc")
+
+# size of the receive buffer, holds the updates sent between 2 iterations of the main loop
+RECEIVE_BUFFER_SIZE = 1048576
+# maximum size of an update, larger ones are sent over HTTP by the command watchers
+MAX_DATAGRAM_SIZE = 65536
+
+
+class CommandUpdateSocket(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.socket = None
+
+    def open(self):
+        if os.path.exists(self.path):
+            # left by a previous worker on the same port
+            os.remove(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        sock.bind(self.path)
+        sock.setblocking(False)
+        # the command watchers must not inherit it
+        flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self.socket = sock
+        LOGGER.info("Listening to the command watchers on %s" % self.path)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def receive(self):
+        '''
+        Returns the updates received since the last call, in their order of sending.
+        '''
+        updates = []
+        while True:
+            try:
+                data = self.socket.recv(MAX_DATAGRAM_SIZE)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return updates
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            try:
+                updates.append(json.loads(data))
+            except ValueError:
+                LOGGER.warning("Invalid command update received: %r" % data[:200])
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
@@ -0,0 +1,246 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Access to the log files of the worker and of its commands.
+
+The logs are read by ranges, a request never loads a whole file:
+    - range: `length` bytes from `offset` (a negative offset is relative to the end of the log)
+    - tail: the offset of the last lines is found by reading the file backwards by blocks
+    - follow: the content written after a given offset, the web service waits for it (see workerwebservice)
+
+The logs of the finished commands are compressed with gzip by a background thread (LogCompressor). A compressed log
+is found transparently from the path of the uncompressed one, the offsets are the ones of the uncompressed content.
+
+Configuration (octopus.worker.config):
+    WORKER_COMPRESS_LOGS: compress the logs of the finished commands
+    WORKER_COMPRESS_LOGS_MIN_SIZE: smaller logs are not compressed
+    WORKER_COMPRESS_LOGS_DELAY: a log is compressed when it has not been modified for this delay
+    WORKER_LOG_CHUNK_SIZE: size of the blocks read from the logs
+"""
+__author__ = "Jerome Samson"
+__copyright__ = "Copyright 2014, Mikros Image"
+
+import gzip
+import logging
+import os
+import shutil
+import struct
+import threading
+import time
+from collections import deque
+from Queue import Queue
+
+from octopus.worker import config
+
+LOGGER = logging.getLogger("worker.logfiles")
+
+GZIP_SUFFIX = ".gz"
+
+
+class LogFile(object):
+    '''
+    A log, compressed or not. The offsets and sizes are the ones of the uncompressed content.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.compressed = path.endswith(GZIP_SUFFIX)
+
+    @classmethod
+    def find(cls, path):
+        '''
+        Returns the log of the given path, or of its compressed version if the log has been compressed, None if the
+        log does not exist.
+        '''
+        for candidate in (path, path + GZIP_SUFFIX):
+            if os.path.isfile(candidate):
+                return cls(candidate)
+        return None
+
+    def size(self):
+        if not self.compressed:
+            return os.path.getsize(self.path)
+        # the size of the uncompressed content (modulo 2^32) is at the end of a gzip file
+        with open(self.path, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', f.read(4))[0]
+
+    def open(self):
+        if self.compressed:
+            return gzip.open(self.path, 'rb')
+        return open(self.path, 'rb')
+
+    def openAt(self, offset):
+        '''
+        Returns the log opened at `offset`. On a compressed log, the content before the offset is decompressed: it can
+        take a while on a large log.
+        '''
+        f = self.open()
+        f.seek(offset)
+        return f
+
+    def iterRange(self, offset, length=None):
+        '''
+        Yields the content of the log from `offset` by chunks of WORKER_LOG_CHUNK_SIZE, up to `length` bytes or to the
+        end of the log.
+        '''
+        return readChunks(self.openAt(offset), length)
+
+    def read(self, offset, length):
+        return ''.join(self.iterRange(offset, length))
+
+    def tailOffset(self, lines):
+        '''
+        Returns the offset of the last `lines` lines of the log.
+        '''
+        if lines <= 0:
+            return self.size()
+        if self.compressed:
+            # a gzip stream can only be read forwards: the offsets of the last lines are kept while reading it
+            starts = deque([0], maxlen=lines + 1)
+            offset = 0
+            for data in self.iterRange(0):
+                start = 0
+                while True:
+                    index = data.find('\n', start)
+                    if index < 0:
+                        break
+                    starts.append(offset + index + 1)
+                    start = index + 1
+                offset += len(data)
+            if len(starts) > 1 and starts[-1] == offset:
+                # ignore the final end of line
+                starts.pop()
+            return starts[0] if len(starts) <= lines else starts[-lines]
+
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            if position == 0:
+                return 0
+            # the final end of line does not start a new line
+            f.seek(-1, os.SEEK_END)
+            count = -1 if f.read(1) == '\n' else 0
+            while position > 0:
+                size = min(position, config.WORKER_LOG_CHUNK_SIZE)
+                position -= size
+                f.seek(position)
+                data = f.read(size)
+                index = len(data)
+                while True:
+                    index = data.rfind('\n', 0, index)
+                    if index < 0:
+                        break
+                    count += 1
+                    if count == lines:
+                        return position + index + 1
+            return 0
+
+
+def readChunks(f, length=None):
+    '''
+    Yields the content of the opened file `f` by chunks of WORKER_LOG_CHUNK_SIZE, up to `length` bytes or to its end.
+    The file is closed at the end or when the generator is closed.
+    '''
+    try:
+        while length is None or length > 0:
+            size = config.WORKER_LOG_CHUNK_SIZE if length is None else min(length, config.WORKER_LOG_CHUNK_SIZE)
+            data = f.read(size)
+            if not data:
+                return
+            if length is not None:
+                length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def compressLog(path):
+    '''
+    Replaces the log by its gzip compressed version, keeping its modification time and permissions.
+    '''
+    replaceLog(path, writeCompressedLog(path))
+
+
+def writeCompressedLog(path):
+    '''
+    Writes the gzip compressed version of the log in a temporary file and returns its path.
+    '''
+    tmpPath = path + GZIP_SUFFIX + ".tmp"
+    stat = os.stat(path)
+    with open(path, 'rb') as src:
+        dst = gzip.open(tmpPath, 'wb')
+        try:
+            shutil.copyfileobj(src, dst, config.WORKER_LOG_CHUNK_SIZE)
+        finally:
+            dst.close()
+    os.chmod(tmpPath, stat.st_mode & 0777)
+    os.utime(tmpPath, (stat.st_atime, stat.st_mtime))
+    return tmpPath
+
+
+def replaceLog(path, tmpPath):
+    os.rename(tmpPath, path + GZIP_SUFFIX)
+    os.remove(path)
+
+
+class LogCompressor(object):
+    '''
+    Compresses the logs of the finished commands in a background thread, one log at a time. The command watcher may
+    still be writing its last lines: a log is only compressed once it has not been modified for
+    WORKER_COMPRESS_LOGS_DELAY seconds.
+    A command retried on the worker writes its log again at the same path: the worker reclaims the log before opening
+    it, a reclaimed log is left untouched until the command is finished again.
+    '''
+
+    def __init__(self):
+        self.queue = Queue()
+        self.thread = None
+        # logs written by a running command, protects the replacement of a log by its compressed version
+        self.lock = threading.Lock()
+        self.reclaimed = set()
+
+    def reclaim(self, path):
+        '''
+        Called before a command opens its log: a pending compression of the log is cancelled. Waits for the end of the
+        replacement of the log if it is in progress.
+        '''
+        with self.lock:
+            self.reclaimed.add(path)
+
+    def compress(self, path):
+        with self.lock:
+            self.reclaimed.discard(path)
+        if not config.WORKER_COMPRESS_LOGS:
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="LogCompressor")
+            self.thread.setDaemon(True)
+            self.thread.start()
+        self.queue.put(path)
+
+    def run(self):
+        while True:
+            path = self.queue.get()
+            try:
+                while True:
+                    if path in self.reclaimed or not os.path.isfile(path):
+                        # written again by a new run of the command, or already compressed
+                        break
+                    idle = time.time() - os.path.getmtime(path)
+                    if idle >= config.WORKER_COMPRESS_LOGS_DELAY:
+                        if os.path.getsize(path) >= config.WORKER_COMPRESS_LOGS_MIN_SIZE:
+                            self.compressLog(path)
+                        break
+                    time.sleep(config.WORKER_COMPRESS_LOGS_DELAY - idle)
+            except (IOError, OSError), e:
+                LOGGER.warning("Impossible to compress log %s: %r" % (path, e))
+
+    def compressLog(self, path):
+        tmpPath = writeCompressedLog(path)
+        with self.lock:
+            if path not in self.reclaimed:
+                replaceLog(path, tmpPath)
+                return
+        os.remove(tmpPath)
@@ -5,22 +5,60 @@ Used by Worker to spawn a new process.
 __author__ = "Olivier Derpierre"
 __copyright__ = "Copyright 2009, Mikros Image"
 
+import ctypes
+import ctypes.util
+import errno
 import logging
 import os
+import pkgutil
+import signal
 import sys
 import subprocess
 import resource
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from Queue import Queue, Empty
+try:
+    import simplejson as json
+except ImportError:
+    import json
 from octopus.worker import settings
+from octopus.worker import config
 
 LOGGER = logging.getLogger("main.process")
 CLOSE_FDS = (os.name != 'nt')
+FORK_SERVER_TIMEOUT = 30
+# environment read by the python interpreter at startup (module search path, site...) or by the loader of the
+# extension modules: a command watcher forked from the server keeps the values of the server
+INTERPRETER_ENVIRONMENT = ('PYTHONPATH', 'PYTHONHOME', 'PYTHONUSERBASE', 'PYTHONNOUSERSITE', 'PYTHONOPTIMIZE',
+                           'PYTHONIOENCODING', 'PYTHONHASHSEED', 'PYTHONSTARTUP', 'LD_LIBRARY_PATH', 'LD_PRELOAD')
 
 
-def setlimits():
+def loadLibc():
+    # find_library runs an external command (ldconfig): resolved once, never in a child before exec
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+
+LIBC = loadLibc()
+
+
+def setlimits(cpus=None):
     # the use of os.setsid is necessary to create a processgroup properly for the commandwatcher
     # it creates a new session in which the cmdwatcher is the leader of the new process group
     os.setsid()
 
+    # the command watcher and the command inherit the cpus reserved for the command
+    if cpus:
+        try:
+            setCpuAffinity(0, cpus)
+        except OSError, e:
+            # no logging in the child before exec, its stderr is the log of the command watcher
+            sys.stderr.write("Impossible to set the cpu affinity %r: %s\n" % (cpus, e))
+
     # set the limit of open files for ddd
     soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
     try:
@@ -31,7 +69,82 @@ def setlimits():
         raise e
 
 
-def spawnRezManagedCommandWatcher(pidfile, logfile, args, watcherPackages, env):
+def setCpuAffinity(pid, cpus):
+    """
+    | Restricts a process to the given cpus (linux only), the processes it starts afterwards inherit the affinity.
+
+    :param pid: the process id, 0 for the calling process
+    :param cpus: a list of cpu indexes
+    :raise OSError: if the affinity could not be set
+    """
+    if LIBC is None or not hasattr(LIBC, 'sched_setaffinity'):
+        raise OSError(errno.ENOSYS, "sched_setaffinity is not available")
+    mask = (ctypes.c_uint64 * (max(cpus) // 64 + 1))()
+    for cpu in cpus:
+        mask[cpu // 64] |= 1 << (cpu % 64)
+    if LIBC.sched_setaffinity(pid, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+
+
+class RezContextCache(object):
+    """
+    | Resolved rez contexts of the command watchers, indexed by their list of packages.
+    | Consecutive commands usually request the same packages, the resolve is only done for the first one. The least
+    | recently used contexts are dropped above WORKER_REZ_CACHE_SIZE entries, and a context is resolved again after
+    | WORKER_REZ_CACHE_TTL seconds to take the newly released packages into account.
+    """
+
+    def __init__(self):
+        self.contexts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, packages):
+        """
+        :param packages: the list of package requests
+        :return: the resolved context of the packages, from the cache if possible
+        """
+        from rez.resources import clear_caches
+        from rez.resolved_context import ResolvedContext
+        from rez.resolver import ResolverStatus
+
+        key = tuple(packages)
+        now = time.time()
+        with self.lock:
+            entry = self.contexts.pop(key, None)
+            if entry is not None and now - entry[0] < config.WORKER_REZ_CACHE_TTL:
+                # most recently used at the end
+                self.contexts[key] = entry
+                LOGGER.debug("Rez context of %r found in cache" % (packages,))
+                return entry[1]
+
+        clear_caches()
+        context = ResolvedContext(list(packages))
+        if context.status != ResolverStatus.solved:
+            context.print_info(buf=sys.stderr)
+            raise Exception("Impossible to resolve the rez packages %r" % (packages,))
+
+        with self.lock:
+            self.contexts[key] = (now, context)
+            while len(self.contexts) > config.WORKER_REZ_CACHE_SIZE:
+                self.contexts.popitem(last=False)
+        return context
+
+    def invalidate(self, packages=None):
+        """
+        Drops the context of the given packages, or all the contexts.
+        """
+        with self.lock:
+            if packages is None:
+                self.contexts.clear()
+            else:
+                self.contexts.pop(tuple(packages), None)
+
+
+REZ_CONTEXTS = RezContextCache()
+
+
+def spawnRezManagedCommandWatcher(pidfile, logfile, args, watcherPackages, env, cpus=None):
     """
     | Uses rez module to start a process with a proper rez env.
 
@@ -43,13 +156,10 @@ def spawnRezManagedCommandWatcher(pidfile, logfile, args, watcherPackages, env):
 
     :return: a CommandWatcherProcess object holding command watcher process handle
     """
-    try:
-        from rez.resources import clear_caches
-        from rez.resolved_context import ResolvedContext
-        from rez.resolver import ResolverStatus
-    except ImportError as e:
+    # rez is imported when a context is resolved (see RezContextCache), only its availability is checked here
+    if pkgutil.find_loader('rez') is None:
         LOGGER.error("Unable to load rez package in a rez managed environment.")
-        raise e
+        raise ImportError("No module named rez")
 
     try:
         if watcherPackages is None:
@@ -60,12 +170,7 @@ def spawnRezManagedCommandWatcher(pidfile, logfile, args, watcherPackages, env):
         else:
             watcherPackagesList = watcherPackages
 
-        clear_caches()
-        context = ResolvedContext(watcherPackagesList)
-        success = (context.status == ResolverStatus.solved)
-        if not success:
-            context.print_info(buf=sys.stderr)
-            raise
+        context = REZ_CONTEXTS.get(watcherPackagesList)
 
         # normalize environment
         envN = os.environ.copy()
@@ -79,19 +184,23 @@ def spawnRezManagedCommandWatcher(pidfile, logfile, args, watcherPackages, env):
             stdout=logfile,
             stderr=subprocess.STDOUT,
             block=False,
-            parent_environ=envN
+            parent_environ=envN,
+            # own session and process group, like the other command watchers
+            preexec_fn=partial(setlimits, cpus)
         )
 
         LOGGER.info("Starting subprocess, log: %r, args: %r" % (logfile.name, args))
     except Exception as e:
         LOGGER.error("Impossible to start process: %s" % e)
+        # the context might be the cause, it will be resolved again by the next command
+        REZ_CONTEXTS.invalidate(watcherPackagesList)
         raise e
 
     file(pidfile, "w").write(str(proc.pid))
     return CommandWatcherProcess(proc, pidfile, proc.pid)
 
 
-def spawnCommandWatcher(pidfile, logfile, args, env):
+def spawnCommandWatcher(pidfile, logfile, args, env, cpus=None):
     """
     | Create a subprocess with "CommandWatcher" script. It will receive the commands arguments and everything
     | needed to execute the command process (logfile, runner name...)
@@ -101,6 +210,7 @@ def spawnCommandWatcher(pidfile, logfile, args, env):
     :param logfile: a file handler to wich log will be redirected
     :param args: arguments passed to the CommandWatcher script
     :param env: a dict holding key/value pairs that will be merged into the current env and used in subprocess
+    :param cpus: the cpus the process is restricted to (all by default)
 
     :return: A CommandWatcherProcess class holding relevants infos of the new process
     """
@@ -120,7 +230,7 @@ def spawnCommandWatcher(pidfile, logfile, args, env):
         process = subprocess.Popen(
             args, bufsize=-1, stdin=devnull, stdout=logfile,
             stderr=logfile, close_fds=CLOSE_FDS,
-            preexec_fn=setlimits, env=envN)
+            preexec_fn=partial(setlimits, cpus), env=envN)
 
     except Exception, e:
         LOGGER.error("Impossible to start subprocess: %r" % e)
@@ -130,75 +240,171 @@ def spawnCommandWatcher(pidfile, logfile, args, env):
     return CommandWatcherProcess(process, pidfile, process.pid)
 
 
+def mergeEnvironment(env):
+    """
+    Returns the current environment merged with the given env dict, as given to a command watcher.
+    """
+    envN = os.environ.copy()
+    for key in env:
+        envN[str(key)] = str(env[key])
+    return envN
+
+
+def getInterpreterEnvironment(env):
+    return dict((key, env[key]) for key in INTERPRETER_ENVIRONMENT if key in env)
+
+
+class CommandWatcherForkServer(object):
+    """
+    | Client of the fork server of the command watchers (see octopus.commandwatcher.forkserver).
+    | The server is a child process of the worker with the command watcher modules already imported, a command watcher
+    | is forked from it instead of starting a new python interpreter.
+    | The end of the command watchers started by the server are notified to the `onExit` callback with their pid.
+    | A command whose environment changes the setup of the interpreter (INTERPRETER_ENVIRONMENT, e.g. a PYTHONPATH
+    | giving another version of its runner) can not be forked from the server, see canSpawn.
+    """
+
+    def __init__(self, onExit, preloadedRunners=()):
+        self.onExit = onExit
+        self.preloadedRunners = list(preloadedRunners)
+        self.process = None
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.lastRequestId = 0
+        # interpreter setup of the server (and of the runners it has imported)
+        self.interpreterEnvironment = None
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process is not None else None
+
+    def isAlive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        from octopus.commandwatcher import forkserver
+        scriptFile = forkserver.__file__[:-1] if forkserver.__file__.endswith(".pyc") else forkserver.__file__
+        self.interpreterEnvironment = getInterpreterEnvironment(os.environ)
+        self.process = subprocess.Popen([sys.executable, scriptFile] + self.preloadedRunners,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=CLOSE_FDS)
+        readerThread = threading.Thread(target=self.readReplies, args=(self.process,), name="ForkServerReader")
+        readerThread.setDaemon(True)
+        readerThread.start()
+        LOGGER.info("Command watcher fork server started (pid=%d)" % self.process.pid)
+
+    def readReplies(self, process):
+        for line in iter(process.stdout.readline, ''):
+            try:
+                message = json.loads(line)
+            except ValueError:
+                LOGGER.warning("Invalid message from the fork server: %r" % line)
+                continue
+            if 'exited' in message:
+                self.onExit(message['exited'])
+            else:
+                queue = self.pending.pop(message['id'], None)
+                if queue is not None:
+                    queue.put(message)
+        # the server has stopped: the requests still waiting for a reply fail
+        for queue in self.pending.values():
+            queue.put({'error': "fork server stopped"})
+        LOGGER.warning("Command watcher fork server has stopped (pid=%d)" % process.pid)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process = None
+
+    def canSpawn(self, env):
+        """
+        | Returns False when the command must be started by a new interpreter (see spawnCommandWatcher): its environment
+        | changes the module search path or another setting of the interpreter compared to the server. The modules
+        | imported by the server, and the runners it has cached, are only valid for its own setup.
+
+        :param env: the environment of the command, merged into the current env
+        """
+        serverEnvironment = self.interpreterEnvironment
+        if serverEnvironment is None:
+            serverEnvironment = getInterpreterEnvironment(os.environ)
+        return getInterpreterEnvironment(mergeEnvironment(env)) == serverEnvironment
+
+    def spawn(self, pidfile, logfile, args, env, cpus=None):
+        """
+        | Forks a new command watcher from the server, the server is (re)started if needed.
+        | The caller must check the environment of the command with canSpawn.
+
+        :param pidfile: full path to the comand pid file (usally /var/run/puli/cw<command_id>.pid)
+        :param logfile: path of the file to wich the log will be redirected
+        :param args: arguments passed to the CommandWatcher script (without the python interpreter and script)
+        :param env: a dict holding key/value pairs that will be merged into the current env and used in the process
+        :param cpus: the cpus the process is restricted to (all by default)
+
+        :return: A CommandWatcherProcess class holding relevants infos of the new process
+        """
+        envN = mergeEnvironment(env)
+
+        with self.lock:
+            if not self.isAlive():
+                self.start()
+            self.lastRequestId += 1
+            queue = Queue()
+            self.pending[self.lastRequestId] = queue
+            request = {'id': self.lastRequestId,
+                       'argv': args,
+                       'env': envN,
+                       'log': logfile,
+                       'maxOpenFiles': settings.LIMIT_OPEN_FILES,
+                       'cpus': cpus or []}
+            try:
+                self.process.stdin.write(json.dumps(request) + '\n')
+                self.process.stdin.flush()
+            except (IOError, OSError), e:
+                self.pending.pop(self.lastRequestId, None)
+                LOGGER.error("Impossible to send a request to the fork server: %r" % e)
+                raise e
+            try:
+                reply = queue.get(True, FORK_SERVER_TIMEOUT)
+            except Empty:
+                self.pending.pop(self.lastRequestId, None)
+                reply = {'error': "no reply"}
+
+        if 'error' in reply:
+            raise OSError("fork server: %s" % reply['error'])
+        LOGGER.info("Forked command watcher, log: %r, args: %r" % (logfile, args))
+        file(pidfile, "w").write(str(reply['pid']))
+        return CommandWatcherProcess(None, pidfile, reply['pid'])
+
+
 class CommandWatcherProcess(object):
     def __init__(self, process, pidfile, pid):
         self.process = process
         self.pidfile = pidfile
         self.pid = pid
 
-    def kill(self):
-        """Kill the process."""
-        if os.name != 'nt':
-
-            # WARNING: SEVERAL PROBLEMS HERE
-            # the kill is not properly done, SIGTERM might not be sufficient, killpg is done on pid instead of pgid
-            # this code never works ! It gives the impression to work because there is "ensureNoMoreRender" in worker
-
-            # try:
-            #     LOGGER.warning("Killing process %s (pid=%s)" % (self.process, self.pid))
-            #     self.process.kill()
-            # except Exception as err:
-            #     LOGGER.warning("Error when killing process" % err)
-            #
-            # import time
-            # time.sleep(2.0)
-            # LOGGER.warning("After kill...")
-            # return
-
-            from signal import SIGTERM
-            from signal import SIGKILL
-            from errno import ESRCH
-
-            # PHASE 1 ===> THIS IS STUPID: kills the whole group including the worker !
-            # try:
-            #     # do not kill the process, kill the whole process group!
-            #     LOGGER.info("Phase 1: Trying to kill process group %s" % str(self.pid))
-            #     os.killpg(os.getpgid(self.pid), SIGTERM)
-            #     return
-            # except OSError, e:
-            #     LOGGER.warning("A problem occured: %s" % e)
-            #     # If the process is dead already, let it rest in peace.
-            #     # Else, we have a problem, so reraise.
-            #     if e.args[0] != ESRCH:
-            #         LOGGER.error("Phase 1: process error (%s)" % e)
-            #         raise
-
-            # PHASE 2
-            try:
-                # the commandwatcher did not have time to setpgid yet, let's just kill the process
-                # FIXME there still is room for a race condition there
-                LOGGER.info("Try to nicely terminate the process %s" % str(self.pid))
-                os.kill(self.pid, SIGTERM)
-            except OSError, e:
-                # If the process is dead already, let it rest in peace.
-                # Else, we have a problem, so reraise.
-                if e.args[0] != ESRCH:
-                    LOGGER.error("Phase 2: process error (%s)" % e)
-                    raise
-
-            # PHASE 3 ==> SAME AS PHASE 1
-            # try:
-            #     # attempt to fix a race condition:
-            #     # if we kill the watcher but the watcher had the time to
-            #     # create processgroup and start another process in between
-            #     # phases 1 and 2, then attempt to kill the processgroup.
-            #     LOGGER.info("Phase 3: Try to fix race condition by killing the process group again %s" % str(self.pid))
-            #     os.killpg(self.pid, SIGTERM)
-            # except OSError, e:
-            #     # If the process is dead already, let it rest in peace.
-            #     # Else, we have a problem, so reraise.
-            #     if e.args[0] != ESRCH:
-            #         LOGGER.error("Phase 3: process error (%s)" % e)
-            #         raise
-        else:
+    def kill(self, sig=signal.SIGTERM):
+        """
+        | Sends the signal to the process group of the command watcher, i.e. to the command watcher and to the processes
+        | started by the runner. The command watcher is the leader of its own session and process group (see setlimits),
+        | if it is not (yet) the signal is only sent to its process.
+
+        :return: False if the process has vanished
+        """
+        if os.name == 'nt':
             os.popen("taskkill /PID  %d" % self.pid)
+            return True
+
+        try:
+            if os.getpgid(self.pid) == self.pid:
+                LOGGER.info("Sending signal %d to the process group %d" % (sig, self.pid))
+                os.killpg(self.pid, sig)
+            else:
+                LOGGER.info("Sending signal %d to the process %d" % (sig, self.pid))
+                os.kill(self.pid, sig)
+        except OSError, e:
+            # If the process is dead already, let it rest in peace.
+            # Else, we have a problem, so reraise.
+            if e.errno != errno.ESRCH:
+                LOGGER.error("Impossible to kill process %d (%s)" % (self.pid, e))
+                raise
+            return False
+        return True
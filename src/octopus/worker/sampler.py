@@ -0,0 +1,378 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+In-process sampling of the system of the worker.
+
+The values are read directly from /proc, no process is started to collect them:
+    - the static facts of the host (cores, total memory, cpu, distribution, OpenGL version) are collected once and
+      cached until refresh() is called (registration with a full update of the sys infos)
+    - the dynamic values (cpu usage, free memory, swap usage and I/O rates) are sampled by a thread every
+      WORKER_SAMPLING_DELAY seconds and kept in a ring buffer of WORKER_SAMPLES_SIZE samples, the heartbeats and the
+      webservice read the last ones without touching the system
+
+The sampling thread also measures the resources used by the process trees of the commands (see
+ProcessTreeAccounting): a single scan of /proc per sample is shared by all the tracked trees.
+
+Configuration (octopus.worker.config):
+    WORKER_SAMPLING_DELAY: interval in seconds between 2 samples
+    WORKER_SAMPLES_SIZE: number of samples kept
+"""
+__author__ = "Jerome Samson"
+__copyright__ = "Copyright 2014, Mikros Image"
+
+import logging
+import multiprocessing
+import os
+import platform
+import re
+import subprocess
+import threading
+import time
+from collections import deque
+
+from octopus.worker import config
+
+LOGGER = logging.getLogger("worker.sampler")
+
+PROC = "/proc"
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def readMemInfo():
+    '''
+    Returns the values of /proc/meminfo in kilobytes, indexed by name (MemTotal, MemFree, Cached...).
+    '''
+    values = {}
+    with open(os.path.join(PROC, "meminfo")) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2:
+                values[fields[0].rstrip(':')] = int(fields[1])
+    return values
+
+
+def readCpuTimes():
+    '''
+    Returns the cumulated (busy, total) cpu times of the host in jiffies, from the first line of /proc/stat.
+    '''
+    with open(os.path.join(PROC, "stat")) as f:
+        times = [int(value) for value in f.readline().split()[1:]]
+    # idle and iowait are the 4th and 5th fields
+    idle = sum(times[3:5])
+    total = sum(times)
+    return (total - idle, total)
+
+
+def readPagingCounters():
+    '''
+    Returns the cumulated (read, written) kilobytes paged in and out from the block devices, from /proc/vmstat.
+    '''
+    values = {}
+    with open(os.path.join(PROC, "vmstat")) as f:
+        for line in f:
+            name, value = line.split()
+            if name in ('pgpgin', 'pgpgout'):
+                values[name] = int(value)
+    return (values.get('pgpgin', 0), values.get('pgpgout', 0))
+
+
+def readProcessStats():
+    '''
+    Returns the (pid, parent pid, session id, start time, cpu time in seconds, resident memory in bytes) of the running
+    processes, from /proc/<pid>/stat.
+    '''
+    stats = []
+    for name in os.listdir(PROC):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join(PROC, name, "stat")) as f:
+                data = f.read()
+        except IOError:
+            # the process has vanished
+            continue
+        # the command name is between parenthesis and may contain spaces, the fields after it are numbered from 3
+        fields = data[data.rfind(')') + 2:].split()
+        try:
+            stats.append((int(name),
+                          int(fields[1]),
+                          int(fields[3]),
+                          int(fields[19]),
+                          float(int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+                          int(fields[21]) * PAGE_SIZE))
+        except (IndexError, ValueError):
+            continue
+    return stats
+
+
+def readProcessIo(pid):
+    '''
+    Returns the (read, written) bytes of the process from the storage, (0, 0) if /proc/<pid>/io cannot be read.
+    '''
+    values = {}
+    try:
+        with open(os.path.join(PROC, str(pid), "io")) as f:
+            for line in f:
+                name, value = line.split(':')
+                values[name] = int(value)
+    except (IOError, ValueError):
+        pass
+    return (values.get('read_bytes', 0), values.get('write_bytes', 0))
+
+
+class ProcessTreeAccounting(object):
+    '''
+    Resources used by the processes of a command: the command watcher and its descendants, as well as the processes
+    of its session when it is a session leader (the orphans of the command are reparented to init but stay in the
+    session).
+    The cpu time and the I/O of a process are kept when it exits, the processes are identified by their pid and start
+    time. The memory is the sum of the resident memory of the processes, its peak is the highest sampled value.
+    '''
+
+    def __init__(self, rootPid):
+        self.rootPid = rootPid
+        self.processes = {}
+        self.rss = 0
+        self.peakRss = 0
+        self.maxProcesses = 0
+        self.lock = threading.Lock()
+
+    def update(self, processStats):
+        '''
+        :param processStats: the stats of the running processes returned by readProcessStats()
+        '''
+        children = {}
+        for stats in processStats:
+            children.setdefault(stats[1], []).append(stats)
+        tree = [stats for stats in processStats if stats[0] == self.rootPid or stats[2] == self.rootPid]
+        pids = set(stats[0] for stats in tree)
+        index = 0
+        while index < len(tree):
+            for stats in children.get(tree[index][0], []):
+                if stats[0] not in pids:
+                    pids.add(stats[0])
+                    tree.append(stats)
+            index += 1
+
+        with self.lock:
+            rss = 0
+            for pid, parentPid, sessionId, startTime, cpuTime, processRss in tree:
+                self.processes[(pid, startTime)] = (cpuTime,) + readProcessIo(pid)
+                rss += processRss
+            count = len(tree)
+            self.rss = rss
+            self.peakRss = max(self.peakRss, rss)
+            self.maxProcesses = max(self.maxProcesses, count)
+
+    def to_json(self):
+        with self.lock:
+            return {'cpuTime': round(sum(values[0] for values in self.processes.values()), 2),
+                    'rss': self.rss / 1048576,
+                    'peakRss': self.peakRss / 1048576,
+                    'readBytes': sum(values[1] for values in self.processes.values()),
+                    'writeBytes': sum(values[2] for values in self.processes.values()),
+                    'processes': len(self.processes),
+                    'maxProcesses': self.maxProcesses}
+
+
+class SystemSampler(object):
+
+    def __init__(self):
+        self.samples = deque(maxlen=config.WORKER_SAMPLES_SIZE)
+        self.facts = None
+        self.previousCpuTimes = None
+        self.previousPaging = None
+        self.previousTime = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.accountings = {}
+
+    def start(self):
+        '''
+        Starts the sampling thread, a first sample is taken at once.
+        '''
+        self.sample()
+        self.thread = threading.Thread(target=self.run, name="SystemSampler")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(config.WORKER_SAMPLING_DELAY)
+            try:
+                self.sample()
+                self.sampleProcessTrees()
+            except Exception, e:
+                LOGGER.warning("Error when sampling the system: %r" % e)
+
+    def trackProcessTree(self, rootPid):
+        '''
+        Starts the accounting of the resources used by a process and its descendants, returns its ProcessTreeAccounting.
+        '''
+        accounting = ProcessTreeAccounting(rootPid)
+        self.accountings[rootPid] = accounting
+        return accounting
+
+    def untrackProcessTree(self, rootPid):
+        self.accountings.pop(rootPid, None)
+
+    def sampleProcessTrees(self, accountings=None):
+        '''
+        Updates the given accountings, or all the tracked ones, from a single scan of the processes.
+        '''
+        if accountings is None:
+            accountings = self.accountings.values()
+        if not accountings:
+            return
+        processStats = readProcessStats()
+        for accounting in accountings:
+            accounting.update(processStats)
+
+    def sample(self):
+        '''
+        Reads the dynamic values of the system and appends them to the samples.
+        The cpu usage (in percent) and the I/O rates (in kilobytes per second) are computed since the previous sample.
+        '''
+        with self.lock:
+            now = time.time()
+            sample = {'time': now,
+                      'cpuUsage': 0.0,
+                      'totalRam': -1,
+                      'freeRam': -1,
+                      'swapPercentage': 0.0,
+                      'ioRead': 0.0,
+                      'ioWrite': 0.0}
+            try:
+                memInfo = readMemInfo()
+                cpuTimes = readCpuTimes()
+                paging = readPagingCounters()
+            except (IOError, OSError, ValueError), e:
+                LOGGER.debug("Impossible to read the system infos in %s: %r" % (PROC, e))
+                self.samples.append(sample)
+                return sample
+
+            sample['totalRam'] = memInfo.get('MemTotal', 0) / 1024
+            # memory used by the buffers and the page cache is considered as free
+            sample['freeRam'] = (memInfo.get('MemFree', 0) + memInfo.get('Buffers', 0) + memInfo.get('Cached', 0)) / 1024
+            swapTotal = memInfo.get('SwapTotal', 0)
+            if swapTotal:
+                sample['swapPercentage'] = round(100.0 * (swapTotal - memInfo.get('SwapFree', 0)) / swapTotal, 1)
+
+            if self.previousTime is not None:
+                busy = cpuTimes[0] - self.previousCpuTimes[0]
+                total = cpuTimes[1] - self.previousCpuTimes[1]
+                if total > 0:
+                    sample['cpuUsage'] = round(100.0 * busy / total, 1)
+                elapsed = now - self.previousTime
+                if elapsed > 0:
+                    sample['ioRead'] = round((paging[0] - self.previousPaging[0]) / elapsed, 1)
+                    sample['ioWrite'] = round((paging[1] - self.previousPaging[1]) / elapsed, 1)
+            self.previousCpuTimes = cpuTimes
+            self.previousPaging = paging
+            self.previousTime = now
+
+            self.samples.append(sample)
+            return sample
+
+    def latest(self):
+        '''
+        Returns the last sample, a sample is taken if the sampling thread is not started yet.
+        '''
+        try:
+            return self.samples[-1]
+        except IndexError:
+            return self.sample()
+
+    def getFacts(self):
+        if self.facts is None:
+            self.refresh()
+        return self.facts
+
+    def refresh(self):
+        '''
+        Collects the static facts of the host again.
+        '''
+        facts = {'cores': multiprocessing.cpu_count(),
+                 'ram': 1024,
+                 'os': platform.system().lower(),
+                 'cpuname': "undefined",
+                 'speed': 1.0,
+                 'distribname': "unknown",
+                 'mikdistrib': "unknown",
+                 'openglversion': ""}
+        try:
+            facts['ram'] = readMemInfo()['MemTotal'] / 1024
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        facts.update(self.readCpuInfo())
+        facts.update(self.readDistribName())
+        facts['openglversion'] = self.readOpenglVersion()
+        self.facts = facts
+
+    def readCpuInfo(self):
+        facts = {}
+        try:
+            with open(os.path.join(PROC, "cpuinfo")) as f:
+                for line in f:
+                    if 'model name' in line:
+                        facts['cpuname'] = line.split(':')[1].strip()
+                        speedStr = line.split('@')[1].strip()
+                        facts['speed'] = float(speedStr.split('GHz')[0].strip())
+                        break
+        except (IOError, IndexError, ValueError):
+            pass
+        return facts
+
+    def readDistribName(self):
+        '''
+        | Retrieves indicators of mik release and os release.
+        | Handles several cases reflecting the history of Mikros distrib info declaration
+        '''
+        facts = {}
+        for path, versionKeys, distribName in (('/etc/mik-release', ('MIK-VERSION', 'MIK-RELEASE'), 'openSUSE'),
+                                               ('/etc/mikrelease', ('mikrelease',), 'Fedora')):
+            if not os.path.isfile(path):
+                continue
+            facts['mikdistrib'] = facts['distribname'] = "undefined"
+            try:
+                with open(path, 'r') as f:
+                    for line in f:
+                        if any(key in line for key in versionKeys):
+                            facts['mikdistrib'] = line.split()[1]
+                        elif distribName in line:
+                            if '=' in line:
+                                facts['distribname'] = line.split('=')[1].strip()
+                            else:
+                                facts['distribname'] = line
+                            break
+            except (IOError, IndexError):
+                pass
+            break
+        return facts
+
+    def readOpenglVersion(self):
+        '''
+        The OpenGL version is only known by glxinfo, it is started once per collection of the static facts.
+        '''
+        try:
+            output = subprocess.Popen("glxinfo", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0]
+        except OSError, e:
+            LOGGER.debug("Impossible to run glxinfo: %r" % e)
+            return ""
+        for line in output.split("\n"):
+            if "OpenGL version string" in line:
+                LOGGER.info("found : %s" % line)
+                res = re.search("(\d.\d.\d)", line)
+                if res:
+                    return res.group()
+                break
+        return ""
+
+    def to_json(self):
+        facts = self.getFacts()
+        with self.lock:
+            samples = list(self.samples)
+        return {'facts': facts,
+                'samples': samples}
@@ -0,0 +1,257 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Sender of the heartbeats of the worker.
+
+The main loop only queues the updates of its commands, they are sent to the dispatcher by a dedicated thread: a slow
+or unreachable dispatcher never blocks the main loop (reaping of the command watchers, timeouts, killfile...).
+    - the updates are coalesced per command: a new update of a command not sent yet is merged over the pending one
+    - a heartbeat carries at most WORKER_UPDATE_BATCH_SIZE command updates, the others are sent right after
+    - when a heartbeat fails, the pending updates are written to a spool file and loaded again by the next worker
+      started on the same port. The spool holds at most WORKER_UPDATE_SPOOL_SIZE commands, the oldest updates are
+      dropped first.
+    - the dynamic sys infos which changed since the last acknowledged heartbeat are added every WORKER_SYSINFO_DELAY,
+      all of them every WORKER_MAX_SYSINFO_DELAY
+
+The results of a heartbeat are given back to the worker with callbacks called from the sender thread.
+"""
+__author__ = "Jerome Samson"
+__copyright__ = "Copyright 2014, Mikros Image"
+
+import httplib
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from octopus.worker import settings
+from octopus.worker import config
+
+LOGGER = logging.getLogger("worker.sender")
+
+
+class HeartbeatSender(object):
+
+    def __init__(self, worker, spoolFile):
+        '''
+        :param worker: the worker, provides the sys infos and the callbacks of the heartbeats:
+            - fetchSysInfos() and fetchDynamicSysInfos()
+            - forgetCommands(commandIds): the dispatcher does not know these commands anymore
+            - unknownWorker(): the dispatcher does not know the worker, it has to register again
+        :param spoolFile: path of the spool of the updates not sent yet
+        '''
+        self.worker = worker
+        self.spoolFile = spoolFile
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.failures = 0
+        self.spooled = False
+        # last dynamic sys infos acknowledged by the dispatcher, heartbeats only carry the values which changed
+        self.sentSysInfos = {}
+        self.lastSysInfosMessageTime = 0
+        self.lastFullSysInfoUpdate = 0
+
+    def start(self):
+        self.loadSpool()
+        self.thread = threading.Thread(target=self.run, name="HeartbeatSender")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def queueCommandUpdate(self, updateDict):
+        '''
+        Queues the update of a command, merged over its pending update if any. The stats are only replaced by new
+        stats: None means they have not changed.
+        '''
+        with self.condition:
+            previous = self.pending.pop(updateDict['id'], None)
+            if previous is not None:
+                if updateDict.get('stats') is None and previous.get('stats') is not None:
+                    updateDict['stats'] = previous['stats']
+                previous.update(updateDict)
+                updateDict = previous
+            self.pending[updateDict['id']] = updateDict
+            self.condition.notify()
+
+    def resetSysInfos(self):
+        '''
+        The next heartbeat sends the whole set of dynamic sys infos (e.g. after a registration).
+        '''
+        with self.condition:
+            self.sentSysInfos = {}
+            self.lastSysInfosMessageTime = 0
+            self.condition.notify()
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify()
+
+    def run(self):
+        # an unexpected error must not stop the heartbeats of the worker
+        while True:
+            try:
+                self.sendPendingUpdates()
+            except Exception:
+                LOGGER.exception("Unhandled exception in the heartbeat sender")
+                time.sleep(config.WORKER_SYSINFO_DELAY)
+
+    def sendPendingUpdates(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.time()
+                    timeout = self.lastSysInfosMessageTime + config.WORKER_SYSINFO_DELAY - now
+                    if self.pending or timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+                commandIds = self.pending.keys()[:config.WORKER_UPDATE_BATCH_SIZE]
+                updates = [self.pending.pop(commandId) for commandId in commandIds]
+                withSysInfos = (now - self.lastSysInfosMessageTime) > config.WORKER_SYSINFO_DELAY
+
+            try:
+                success = self.sendHeartbeat(updates, withSysInfos)
+            except Exception:
+                LOGGER.exception("Unhandled exception when sending a heartbeat")
+                success = False
+
+            if success:
+                self.failures = 0
+                if self.spooled:
+                    with self.condition:
+                        self.writeSpool()
+                continue
+
+            with self.condition:
+                # the failed updates go back to the front of the queue, the newer updates are merged over them
+                pending = OrderedDict((updateDict['id'], updateDict) for updateDict in updates)
+                for commandId, newer in self.pending.items():
+                    updateDict = pending.get(commandId)
+                    if updateDict is not None:
+                        if newer.get('stats') is None and updateDict.get('stats') is not None:
+                            newer['stats'] = updateDict['stats']
+                        updateDict.update(newer)
+                    else:
+                        pending[commandId] = newer
+                self.pending = pending
+                self.writeSpool()
+
+            self.failures += 1
+            delay = min(config.WORKER_REQUEST_DELAY_AFTER_REQUEST_FAILURE * 1.5 ** (self.failures - 1), config.WORKER_SYSINFO_DELAY)
+            LOGGER.warning('Heartbeat failed (%d consecutive failures), next attempt in %.2f s', self.failures, delay)
+            time.sleep(delay)
+
+    def sendHeartbeat(self, updates, withSysInfos):
+        """
+        | Send a single message to the dispatcher holding the given command updates.
+        | When withSysInfos is set, the dynamic sys infos (status, free memory and swap usage) which changed since the
+        | last acknowledged heartbeat are added, as well as the static facts when a full update has been requested.
+        | req: PUT /rendernodes/<currentRN>/heartbeat
+
+        :return: False if the heartbeat has to be sent again
+        """
+        now = time.time()
+        if (now - self.lastFullSysInfoUpdate) > config.WORKER_MAX_SYSINFO_DELAY:
+            # Every WORKER_MAX_SYSINFO_DELAY the whole set of dynamic sys infos is sent to ensure the data on the server is complete
+            self.sentSysInfos = {}
+            self.lastFullSysInfoUpdate = now
+
+        message = {'commands': updates}
+        updateSys = False
+        if withSysInfos:
+            infos = {}
+            updateSys = self.worker.updateSys
+            if updateSys:
+                # If necessary (i.e. specified by user via WS)
+                infos = self.worker.fetchSysInfos()
+            dynamicInfos = self.worker.fetchDynamicSysInfos()
+            for key, value in dynamicInfos.items():
+                if self.sentSysInfos.get(key) != value:
+                    infos[key] = value
+            if infos:
+                message['sysinfos'] = infos
+
+        url = "/rendernodes/%s/heartbeat/" % self.worker.computerName
+        body = json.dumps(message)
+        headers = {'Content-Length': len(body)}
+
+        response = None
+        conn = httplib.HTTPConnection(settings.DISPATCHER_ADDRESS, settings.DISPATCHER_PORT, timeout=config.WORKER_UPDATE_TIMEOUT)
+        try:
+            conn.request('PUT', url, body, headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, socket.error), e:
+            LOGGER.error('"PUT %s" failed (error:%r)', url, e)
+        finally:
+            conn.close()
+
+        if response is not None and response.status == 200:
+            if withSysInfos:
+                self.lastSysInfosMessageTime = time.time()
+                self.sentSysInfos = dynamicInfos
+            unknownCommands = json.loads(data).get('unknownCommands', [])
+            if unknownCommands:
+                self.worker.forgetCommands(unknownCommands)
+            LOGGER.debug('Heartbeat transmitted to the server: %r' % body)
+            return True
+
+        if withSysInfos and updateSys:
+            self.worker.updateSys = True
+
+        if response is not None and response.status == 404:
+            # the dispatcher doesn't know the worker
+            # it may have been launched before the dispatcher itself
+            # and not be mentioned in the tree.description file
+            self.worker.unknownWorker()
+            # the updates are sent again to the new render node
+            return False
+
+        if response is not None:
+            LOGGER.warning("unexpected status %d: %s %s" % (response.status, response.reason, data))
+        return False
+
+    def writeSpool(self):
+        '''
+        Writes the pending updates in the spool file, it is removed when there is nothing pending.
+        Called with the condition acquired.
+        '''
+        while len(self.pending) > config.WORKER_UPDATE_SPOOL_SIZE:
+            commandId, updateDict = self.pending.popitem(last=False)
+            LOGGER.warning("Update spool full, update of command %r dropped" % commandId)
+        try:
+            if not self.pending:
+                if os.path.isfile(self.spoolFile):
+                    os.remove(self.spoolFile)
+                self.spooled = False
+                return
+            tmpFile = self.spoolFile + ".tmp"
+            with open(tmpFile, 'w') as f:
+                json.dump(self.pending.values(), f)
+            os.rename(tmpFile, self.spoolFile)
+            self.spooled = True
+        except (IOError, OSError), e:
+            LOGGER.error("Impossible to write the update spool %s: %r" % (self.spoolFile, e))
+
+    def loadSpool(self):
+        '''
+        Queues the updates spooled by the previous worker.
+        '''
+        if not os.path.isfile(self.spoolFile):
+            return
+        try:
+            with open(self.spoolFile) as f:
+                updates = json.load(f)
+        except (IOError, ValueError), e:
+            LOGGER.error("Impossible to read the update spool %s: %r" % (self.spoolFile, e))
+            return
+        LOGGER.info("Loaded %d spooled command updates" % len(updates))
+        self.spooled = True
+        for updateDict in updates:
+            self.queueCommandUpdate(updateDict)
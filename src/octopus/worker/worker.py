@@ -5,21 +5,15 @@ import signal
 import sys
 import time
 import datetime
-import platform
+import random
+import threading
+from collections import deque
 try:
     import simplejson as json
 except ImportError:
     import json
 import httplib
 
-import subprocess
-from subprocess import PIPE
-
-try:
-    import psutil
-except ImportError:
-    print("WARNING: impossible to import psutil")
-
 from octopus.core.framework.mainloopapplication import MainLoopApplication
 from octopus.core.communication.requestmanager import RequestManager
 from octopus.core.enums import command as COMMAND
@@ -32,14 +26,17 @@ from octopus.worker import config
 from octopus.worker.model.command import Command
 from octopus.worker.process import spawnCommandWatcher
 from octopus.worker.process import spawnRezManagedCommandWatcher
+from octopus.worker.process import CommandWatcherForkServer
+from octopus.worker.process import REZ_CONTEXTS
+from octopus.worker.sampler import SystemSampler, readProcessStats
+from octopus.worker.events import EventWaiter
+from octopus.worker.sender import HeartbeatSender
+from octopus.worker.logfiles import LogCompressor
+from octopus.worker.ipc import CommandUpdateSocket
 
 LOGGER = logging.getLogger("worker")
 COMPUTER_NAME_TEMPLATE = "%s:%d"
 
-KILOBYTES = 0
-MEGABYTES = 1
-GIGABYTES = 2
-
 
 class WorkerInternalException(Exception):
     """
@@ -70,6 +67,14 @@ class Worker(MainLoopApplication):
             self.command = None
             self.modified = True
             self.finished = False
+            # cpus dedicated to the command when it shares the host with other commands
+            self.cpus = []
+            # resources used by the processes of the command, see reportCommandStats
+            self.accounting = None
+            self.runningTime = None
+            self.endTime = None
+            self.runnerStats = {}
+            self.lastStatsReport = 0
 
         def __repr__(self):
             return str(
@@ -115,11 +120,13 @@ class Worker(MainLoopApplication):
                                                       settings.PORT)
 
         self.createDate = time.time()
-        self.lastSysInfosMessageTime = 0
-        self.lastFullSysInfoUpdate = 0
+        # pull mode: commands of the last polled assignments which could not be started, shared by the main loop and
+        # the pull thread
+        self.refusedAssignments = []
+        self.refusedAssignmentsLock = threading.Lock()
+        self.pullThread = None
         self.registerDate = 0
 
-        self.httpconn = httplib.HTTPConnection(settings.DISPATCHER_ADDRESS, settings.DISPATCHER_PORT)
         self.PID_DIR = os.path.dirname(settings.PIDFILE)
         if not os.path.isdir(self.PID_DIR):
             LOGGER.warning("Worker pid directory %s does not exist, creating..." % self.PID_DIR)
@@ -136,188 +143,102 @@ class Worker(MainLoopApplication):
         self.updateSys = False
         self.isPaused = False
         self.toberestarted = False
-        self.speed = 1.0
-        self.cpuName = "undefined"
-        self.distrib = "undefined"
-        self.mikdistrib = "undefined"
-        self.openglversion = ""
+        self.sampler = SystemSampler()
+        self.logCompressor = LogCompressor()
+        # heartbeats are sent by a dedicated thread, see HeartbeatSender
+        self.sender = HeartbeatSender(self, os.path.join(self.PID_DIR, "updates%d.spool" % settings.PORT))
+        self.events = EventWaiter()
+        # pids of the command watcher processes which have exited, filled by their waiting threads
+        self.exitedProcesses = deque()
+        # cpus not dedicated to a command, see reserveCpus
+        self.freeCpus = None
+        # updates of the command watchers, see readCommandUpdates
+        self.commandUpdateSocket = None
+        # command watchers killed recently: {pid: (deadline of the SIGKILL, accounting)}, see killCommand
+        self.killedCommands = {}
+        # command watchers are forked from this server when it is enabled (not available for rez-managed workers)
+        self.forkServer = None
 
     def prepare(self):
         LOGGER.info("Before registering: prepare worker.")
         for name in (name for name in dir(settings) if name.isupper()):
             LOGGER.info("settings.%s = %r", name, getattr(settings, name))
-        self.registerWorker()
-
-    def getNbCores(self):
-        import multiprocessing
-        return multiprocessing.cpu_count()
-
-    def getTotalMemory(self):
-        memTotal = 1024
-        if os.path.isfile('/proc/meminfo'):
+        self.sampler.start()
+        self.events.watchDirectory(os.path.dirname(settings.KILLFILE))
+        if config.WORKER_IPC_SOCKET:
+            commandUpdateSocket = CommandUpdateSocket(os.path.join(self.PID_DIR, "worker%d.sock" % settings.PORT))
             try:
-                # get total memory
-                f = open('/proc/meminfo', 'r')
-                for line in f.readlines():
-                    if line.split()[0] == 'MemTotal:':
-                        memTotal = line.split()[1]
-                        f.close()
-                        break
-            except:
-                pass
-        return int(memTotal) / 1024
-
-    def getFreeMem(self, pUnit=MEGABYTES):
-        """
-        | Starts a shell process to retrieve amount of free memory on the worker's system.
-        | The amount of memory is transmitted in MEGABYTES, but can be specified to another unit
-        | To estimate this, we retrieve specific values in /proc/meminfo:
-        | Result = MemFree + Buffers + Cached
-
-        :param pUnit: An integer representing the unit to which the value is converted (DEFAULT is MEGABYTES).
-        :return: An integer representing the amount of FREE memory on the system
-        :raise: OSError if subprocess fails. Returns "-1" if no correct value can be retrieved.
-        """
-
-        try:
-            freeMemStr = subprocess.Popen(["awk",
-                                           "/MemFree|Buffers|^Cached/ {free+=$2} END {print  free}",
-                                           "/proc/meminfo"], stdout=PIPE).communicate()[0]
-        except OSError, e:
-            LOGGER.warning("Error when retrievieng free memory: %r", e)
-
-        if freeMemStr == '':
-            return -1
-
-        freeMem = int(freeMemStr)
-
-        if pUnit is MEGABYTES:
-            freeMem = int(freeMem / 1024)
-        elif pUnit is GIGABYTES:
-            freeMem = int(freeMem / (1024 * 1024))
-
-        return freeMem
-
-    def getSwapUsage(self):
-        """
-        | Uses psutil module to retrieve usage swap percentage. The value is transmitted as a float in range [0-1]
-        :return: A float indicating the amount of swap currently used on the system
-        """
-        swapUsage = 0.0
-        try:
+                commandUpdateSocket.open()
+            except (socket.error, OSError), e:
+                LOGGER.error("Impossible to open the socket of the command watchers, they will use the webservice (%r)" % e)
+            else:
+                self.commandUpdateSocket = commandUpdateSocket
+                self.events.addReader(commandUpdateSocket.fileno())
+        if config.WORKER_FORKSERVER and 'REZ_USED_RESOLVE' not in os.environ:
+            self.forkServer = CommandWatcherForkServer(self.commandWatcherExited, config.WORKER_FORKSERVER_PRELOAD)
             try:
-                swapUsage = psutil.swap_memory().percent
-            except psutil.Error:
-                LOGGER.warning("An error occured when retrieving swap percentage.")
-        except NameError, e:
-            LOGGER.debug("Impossible to use psutil module on this host: %r" % e)
-        except Exception, e:
-            LOGGER.warning("An unexpected error occured: %r" % e)
+                self.forkServer.start()
+            except Exception, e:
+                LOGGER.error("Impossible to start the command watcher fork server, command watchers will be started directly (%r)" % e)
+                self.forkServer = None
+        self.registerWorker()
+        self.sender.start()
 
-        return swapUsage
+        if config.WORKER_PULL_MODE:
+            self.pullThread = threading.Thread(target=self.pullAssignments, name="PullAssignments")
+            self.pullThread.setDaemon(True)
+            self.pullThread.start()
 
-    def getCpuInfo(self):
-        if os.path.isfile('/proc/cpuinfo'):
-            try:
-                # get cpu speed
-                f = open('/proc/cpuinfo', 'r')
-                for line in f.readlines():
-                    if 'model name' in line:
-                        self.cpuName = line.split(':')[1].strip()
-                        speedStr = line.split('@')[1].strip()
-                        self.speed = speedStr.split('GHz')[0].strip()
-                        break
-                f.close()
-            except:
-                pass
-
-    def getDistribName(self):
-        '''
-        | Retrieves indicators of mik release and os release.
-        | Handles several cases reflecting the history of Mikros distrib info declaration
-        | This method values to:
-        |   - self.mikdistrib
-        |   - self.distrib
-        '''
-        if os.path.isfile('/etc/mik-release'):
-            try:
-                f = open('/etc/mik-release', 'r')
-                for line in f.readlines():
-                    if 'MIK-VERSION' in line or 'MIK-RELEASE' in line:
-                        self.mikdistrib = line.split()[1]
-                    elif 'openSUSE' in line:
-                        if '=' in line:
-                            self.distrib = line.split('=')[1].strip()
-                        else:
-                            self.distrib = line
-                        break
-                f.close()
-            except:
-                pass
-        elif os.path.isfile('/etc/mikrelease'):
-            try:
-                f = open('/etc/mikrelease', 'r')
-                for line in f.readlines():
-                    if 'mikrelease' in line:
-                        self.mikdistrib = line.split()[1]
-                    elif 'Fedora' in line:
-                        if '=' in line:
-                            self.distrib = line.split('=')[1].strip()
-                        else:
-                            self.distrib = line
-                        break
-                f.close()
-            except:
-                pass
-        else:
-            self.mikdistrib = "unknown"
-            self.distrib = "unknown"
-
-    def getOpenglVersion(self):
-        import subprocess
-        import re
-        p = subprocess.Popen("glxinfo", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, errors = p.communicate()
-        outputList = output.split("\n")
-        for line in outputList:
-            if "OpenGL version string" in line:
-                LOGGER.info("found : %s" % line)
-                oglpattern = re.compile("(\d.\d.\d)")
-                res = oglpattern.search(line)
-                self.openglversion = res.group()
-                break
+    def wakeUp(self):
+        self.events.wake()
 
     def updateSysInfos(self, ticket):
+        self.sampler.refresh()
         self.updateSys = True
 
     def fetchSysInfos(self):
+        '''
+        Returns the sys infos sent at registration. The static facts of the host (cores, ram, cpu, distribution...)
+        are only sent when updateSys is set, i.e. at registration or when requested via the webservice. They are
+        cached by the sampler.
+        '''
         infos = {}
+        facts = self.sampler.getFacts()
         if self.updateSys:
-            self.getCpuInfo()
-            self.getDistribName()
-            self.getOpenglVersion()
-            infos['cores'] = self.getNbCores()
-            infos['ram'] = self.getTotalMemory()
-            infos['systemFreeRam'] = self.getFreeMem()
-            infos['systemSwapPercentage'] = self.getSwapUsage()
+            sample = self.sampler.latest()
+            infos['cores'] = facts['cores']
+            infos['ram'] = facts['ram']
+            infos['systemFreeRam'] = sample['freeRam']
+            infos['systemSwapPercentage'] = sample['swapPercentage']
             infos["puliversion"] = settings.VERSION
             infos["createDate"] = self.createDate
 
             self.updateSys = False
             # system info values:
-            infos['caracteristics'] = {"os": platform.system().lower(),
+            infos['caracteristics'] = {"os": facts['os'],
                                        "softs": [],
-                                       "cpuname": self.cpuName,
-                                       "distribname": self.distrib,
-                                       "mikdistrib": self.mikdistrib,
-                                       "openglversion": self.openglversion}
+                                       "cpuname": facts['cpuname'],
+                                       "distribname": facts['distribname'],
+                                       "mikdistrib": facts['mikdistrib'],
+                                       "openglversion": facts['openglversion']}
         infos['name'] = self.computerName
         infos['port'] = self.port
         infos['status'] = self.status
         infos['pools'] = []
-        infos['speed'] = float(self.speed)
+        infos['speed'] = float(facts['speed'])
+        # the dispatcher must not send requests to a worker in pull mode, it might not be reachable
+        infos['pullMode'] = config.WORKER_PULL_MODE
         return infos
 
+    def fetchDynamicSysInfos(self):
+        '''
+        Returns the sys infos which vary during the life of the worker, from the last sample of the system.
+        '''
+        sample = self.sampler.latest()
+        return {'status': self.status,
+                'systemFreeRam': sample['freeRam'],
+                'systemSwapPercentage': sample['swapPercentage']}
+
     # def setPerformanceIndex(self, ticket, performance):
     #     """
     #     NOTE: never called ???
@@ -346,8 +267,17 @@ class Worker(MainLoopApplication):
     #     except httplib.BadStatusLine:
     #         LOGGER.exception('Sending sys infos has failed with a BadStatusLine error')
 
-    def registerWorker(self):
-        '''Register the worker in the dispatcher.'''
+    def registerWorker(self, jitter=False):
+        '''
+        | Register the worker in the dispatcher.
+        | The attempts are retried with an exponential backoff, each delay is randomized so that the workers of a large
+        | farm do not retry all at once after a dispatcher failure. With jitter (registration asked again by the
+        | dispatcher, usually after its restart), the first attempt is also delayed by up to WORKER_REGISTER_JITTER.
+        | The dispatcher keeps the known facts when the same worker process registers again.
+        '''
+        if jitter:
+            time.sleep(random.uniform(0, config.WORKER_REGISTER_JITTER))
+
         self.updateSys = True
         self.registerDate = time.time()
 
@@ -364,13 +294,14 @@ class Worker(MainLoopApplication):
         headers = {}
         headers['content-length'] = len(dct)
 
+        failures = 0
         while True:
             try:
                 LOGGER.info("Boot process... registering worker")
                 url = "/rendernodes/%s/" % self.computerName
                 resp = self.requestManager.post(url, dct, headers)
             except RequestManager.RequestError, e:
-                if e.status != 409:
+                if e.status not in (304, 409):
                     msg = "Dispatcher (%s:%s) is not reachable. We'll retry..."
                     msg %= (settings.DISPATCHER_ADDRESS, settings.DISPATCHER_PORT)
                     LOGGER.exception(msg)
@@ -383,8 +314,9 @@ class Worker(MainLoopApplication):
                 else:
                     LOGGER.info("Boot process... worker registered")
                     break
-            # try to register to dispatcher every 10 seconds
-            time.sleep(config.WORKER_REGISTER_DELAY_AFTER_FAILURE)
+            failures += 1
+            delay = min(config.WORKER_REGISTER_DELAY_AFTER_FAILURE * 2 ** (failures - 1), config.WORKER_REGISTER_MAX_DELAY)
+            time.sleep(random.uniform(delay / 2.0, delay))
 
         # once the worker is registered, ensure the RN status is correct according to the killfile presence
         if os.path.isfile(settings.KILLFILE):
@@ -392,7 +324,8 @@ class Worker(MainLoopApplication):
         else:
             self.pauseWorker(False, False)
 
-        self.sendSysInfosMessage()
+        # the next heartbeat sends the whole set of dynamic sys infos
+        self.sender.resetSysInfos()
 
     def buildUpdateDict(self, command):
         dct = {}
@@ -411,60 +344,25 @@ class Worker(MainLoopApplication):
         dct['id'] = command.id
         return dct
 
-    def updateCommandWatcher(self, commandWatcher):
+    def forgetCommands(self, commandIds):
         """
-        | Send info to the dispatcher about currently running command watcher.
-        | Called from the mainloop every time a command has been tagged "modified"
-        | req: PUT /rendernodes/<currentRN>/commands/<commandId>/
-
-        :param commandWatcher: the commandWatcher object we will send an update about
+        Called by the heartbeat sender: the dispatcher does not know these commands anymore.
         """
+        self.framework.addOrder(self.forgetCommandsApply, commandIds=commandIds)
 
-        maxRetry = max(1, config.WORKER_REQUEST_MAX_RETRY_COUNT)
-        delayRetry = config.WORKER_REQUEST_DELAY_AFTER_REQUEST_FAILURE
-        i = 0
-
-        while i < maxRetry:
-            url = "/rendernodes/%s/commands/%d/" % (self.computerName, commandWatcher.commandId)
-            body = json.dumps(self.buildUpdateDict(commandWatcher.command))
-            headers = {'Content-Length': len(body)}
-
-            try:
-                self.httpconn.request('PUT', url, body, headers)
-                response = self.httpconn.getresponse()
-            except httplib.HTTPException, e:
-                LOGGER.error('"PUT %s" failed (error:%r)', url, e)
-            except socket.error, e:
-                LOGGER.error('"PUT %s" failed (error:%r)', url, e)
-            except Exception, e:
-                LOGGER.info('"PUT %s" failed (unhandled exception: %r', url, e)
-            else:
-                if response.status == 200:
-                    response = response.read()
-                    commandWatcher.modified = False
-                    break
-                elif response.status == 404:
-                    LOGGER.warning('removing stale command %d', commandWatcher.commandId)
-                    response = response.read()
-                    self.removeCommandWatcher(commandWatcher)
-                    break
-                else:
-                    data = response.read()
-                    LOGGER.warning("unexpected status %d: %s %s" % (response.status, response.reason, data))
-            finally:
-                self.httpconn.close()
-
-            LOGGER.warning('Update of command %d failed (attempt %d of %d)', commandWatcher.commandId, i, maxRetry)
-            LOGGER.warning('Next retry will occur in %.2f s' % delayRetry)
-            time.sleep(delayRetry)
-            i += 1
-            delayRetry *= 1.5
+    def forgetCommandsApply(self, ticket, commandIds):
+        for commandId in commandIds:
+            commandWatcher = self.commandWatchers.get(commandId)
+            if commandWatcher is not None:
+                LOGGER.warning('removing stale command %d', commandId)
+                self.removeCommandWatcher(commandWatcher)
 
-        # Request error encountered "maxRetry" times, removing the command watcher to avoid
-        # recalling this update in next main loop iter
-        # if i == maxRetry:
-        #     LOGGER.exception('Update of command %d failed repeatedly, removing watcher.', commandWatcher.commandId )
-        #     self.removeCommandWatcher(commandWatcher)
+    def unknownWorker(self):
+        """
+        Called by the heartbeat sender when the dispatcher doesn't know the worker: it may have been launched before
+        the dispatcher itself and not be mentioned in the tree.description file.
+        """
+        self.registerWorker(jitter=True)
 
     def pauseWorker(self, paused, killproc):
         """
@@ -482,9 +380,11 @@ class Worker(MainLoopApplication):
             dct['killproc'] = killproc
             body = json.dumps(dct)
             headers = {'Content-Length': len(body)}
+            # own connection: also called from the heartbeat sender thread when the worker registers again
+            conn = self.connect()
             try:
-                self.httpconn.request('PUT', url, body, headers)
-                response = self.httpconn.getresponse()
+                conn.request('PUT', url, body, headers)
+                response = conn.getresponse()
             except httplib.HTTPException:
                 LOGGER.exception('"PUT %s" failed', url)
             except socket.error:
@@ -501,46 +401,49 @@ class Worker(MainLoopApplication):
                         LOGGER.info("Worker awakes from paused mode")
                 return
             finally:
-                self.httpconn.close()
+                conn.close()
 
     def killCommandWatchers(self):
         for commandWatcher in self.commandWatchers.values():
             LOGGER.warning("Aborting command %d", commandWatcher.commandId)
-            commandWatcher.processObj.kill()
+            self.killCommand(commandWatcher)
             commandWatcher.finished = True
-        self.ensureNoMoreRender()
 
-    def ensureNoMoreRender(self):
+    def killCommand(self, commandWatcher):
         """
-        Force kill of all process attached to the current EUID. this ensures that all command processes have been killed.
-        :return: a boolean indicating success
+        | Kills the processes of a command. Each command watcher is the leader of its own session and process group:
+        | SIGTERM is sent to the group at once, WORKER_KILL_DELAY seconds later SIGKILL is sent to the group and to the
+        | processes of the command which are still alive (see sweepKilledCommands).
         """
-
         try:
-            # Ensure we don't have anymore rendering process
-            keepPID = [os.getpid(), os.getppid()]
-            effectiveUID = os.geteuid()
-            LOGGER.debug("PID to keep: %r" % keepPID)
-
-            # Get pids of current user (usually 'render')
-            renderProcessList = subprocess.check_output(["ps", "-u", str(effectiveUID), "-o", "pid", "h"]).split()
-
-            # Filter the list to preserve the current process and parent process
-            killPID = [pid for pid in renderProcessList if int(pid) not in keepPID]
-            # LOGGER.debug("PID to kill: %r" % killPID)
+            commandWatcher.processObj.kill()
+        except OSError, e:
+            LOGGER.error("Impossible to terminate command %d (%r)" % (commandWatcher.commandId, e))
+        self.killedCommands[commandWatcher.processId] = (time.time() + config.WORKER_KILL_DELAY, commandWatcher.accounting)
 
-            # Send SIGKILL to everyone else
-            for pid in killPID:
+    def sweepKilledCommands(self, now):
+        """
+        | Verifies the cleanup of the commands killed WORKER_KILL_DELAY seconds ago, with a single scan of /proc.
+        | The remaining processes of a command are the ones of the session of its command watcher and the ones seen by
+        | the accounting of the command (they may have left the session), they are killed with SIGKILL.
+        """
+        due = [pid for pid, (deadline, accounting) in self.killedCommands.items() if deadline <= now]
+        if not due:
+            return
+        processStats = readProcessStats()
+        for rootPid in due:
+            deadline, accounting = self.killedCommands.pop(rootPid)
+            tracked = set(accounting.processes.keys()) if accounting is not None else set()
+            survivors = [pid for pid, parentPid, sessionId, startTime, cpuTime, rss in processStats
+                         if sessionId == rootPid or (pid, startTime) in tracked]
+            if not survivors:
+                continue
+            LOGGER.warning("Processes %r of command watcher %d still alive after SIGTERM, sending SIGKILL" % (survivors, rootPid))
+            for pid in survivors:
                 try:
-                    os.kill(int(pid), signal.SIGKILL)
-                    LOGGER.debug("SIGKILL sent to %s" % pid)
+                    os.kill(pid, signal.SIGKILL)
                 except OSError:
                     LOGGER.debug("Impossible to send SIGKILL to %s, the process has vanished." % pid)
-                    continue
-        except Exception as err:
-            LOGGER.error("Error when killing render processes. Some processes of a closed command might still run (%s)" % err)
-            return False
-        return True
 
     def getKillfileInfo(self):
         """
@@ -601,10 +504,11 @@ class Worker(MainLoopApplication):
         """
         | Worker main loop:
         | - check kill file and set new status (paused, toberestartted...)
-        | - update every modified command watcher for this RN
+        | - queue the updates of every modified command watcher for the heartbeat sender
         | - remove finished commandWatchers for this RN
         | - clean "dead" commandWatchers ("dead" means a timeout val is set on the command and RUNNING time is more thant timeout val)
-        | - check ping delay and resync with server if enough time elapsed
+        | - wait for the next event: order from the webservice, end of a command watcher process, change of the
+        |   killfile or timer (command timeout), see EventWaiter
         """
         # try:
         now = time.time()
@@ -680,38 +584,61 @@ class Worker(MainLoopApplication):
             self.framework.stop()
 
         #
-        # Waits for any child process, non-blocking (this is necessary to clean up finished process properly)
+        # Apply the updates published by the command watchers on the local socket
         #
+        if self.commandUpdateSocket is not None:
+            self.readCommandUpdates()
+
+        #
+        # Handles the command watcher processes which have exited (reaped by their waiting thread) and waits for any
+        # other child process, non-blocking (this is necessary to clean up finished process properly)
+        #
+        # a pid is handled once even if it is reported by several sources
+        exitedPids = []
+        while self.exitedProcesses:
+            pid = self.exitedProcesses.popleft()
+            if pid not in exitedPids:
+                exitedPids.append(pid)
         try:
-            pid, stat = os.waitpid(-1, os.WNOHANG)
-            if pid:
-                LOGGER.info("Cleaned process %s" % str(pid))
+            while True:
+                pid, stat = os.waitpid(-1, os.WNOHANG)
+                if not pid:
+                    break
+                if pid not in exitedPids:
+                    exitedPids.append(pid)
+        except OSError:
+            pass
 
-                # Check if pid is still in command watchers
-                # In this case, clean the cmdwatcher and put cmd in error
-                for commandWatcher in self.commandWatchers.values():
-                    if pid == commandWatcher.processId:
+        for pid in exitedPids:
+            LOGGER.info("Cleaned process %s" % str(pid))
 
-                        if commandWatcher.command.status == COMMAND.CMD_RUNNING:
-                            LOGGER.warning("Command was considered RUNNING: set to ERROR")
-                            newStatus = COMMAND.CMD_ERROR
-                        else:
-                            LOGGER.warning("Keep current status: %r", commandWatcher.command.status)
-                            newStatus = commandWatcher.command.status
+            # Check if pid is still in command watchers
+            # In this case, clean the cmdwatcher and put cmd in error
+            for commandWatcher in self.commandWatchers.values():
+                if pid == commandWatcher.processId:
 
-                        LOGGER.warning("CommandWatcher killed but still referenced: %s", commandWatcher)
-                        commandWatcher.finished = True
+                    if commandWatcher.command.status == COMMAND.CMD_RUNNING:
+                        LOGGER.warning("Command was considered RUNNING: set to ERROR")
+                        newStatus = COMMAND.CMD_ERROR
+                    else:
+                        LOGGER.warning("Keep current status: %r", commandWatcher.command.status)
+                        newStatus = commandWatcher.command.status
 
-                        self.updateCompletionAndStatus(commandWatcher.commandId, commandWatcher.command.completion, newStatus, "Command termination not properly tracked.")
+                    LOGGER.warning("CommandWatcher killed but still referenced: %s", commandWatcher)
+                    commandWatcher.finished = True
 
-        except OSError:
-            pass
+                    self.updateCompletionAndStatus(commandWatcher.commandId, commandWatcher.command.completion, newStatus, "Command termination not properly tracked.")
 
         #
-        # Send updates for every modified command watcher.
+        # Queue the updates of the modified command watchers, they are sent with the next heartbeat by the sender
+        # thread (see HeartbeatSender), which also sends the sys infos every WORKER_SYSINFO_DELAY.
         #
-        for commandWatcher in self.modifiedCommandWatchers:
-            self.updateCommandWatcher(commandWatcher)
+        now = time.time()
+        for commandWatcher in list(self.modifiedCommandWatchers):
+            self.sender.queueCommandUpdate(self.buildUpdateDict(commandWatcher.command))
+            commandWatcher.modified = False
+            # the stats are only sent again when they change
+            commandWatcher.command.stats = None
 
         #
         # Attempt to remove finished command watchers
@@ -731,71 +658,81 @@ class Worker(MainLoopApplication):
                 if not responding:
                     # time out has been reached
                     LOGGER.warning("Timeout on command %d", commandWatcher.commandId)
-                    commandWatcher.processObj.kill()
+                    self.killCommand(commandWatcher)
                     commandWatcher.finished = True
                     self.updateCompletionAndStatus(commandWatcher.commandId, None, COMMAND.CMD_CANCELED, None)
 
-        # time resync
-        now = time.time()
-
-        if (now - self.lastFullSysInfoUpdate) > config.WORKER_MAX_SYSINFO_DELAY:
-            # Every WORKER_MAX_SYSINFO_DELAY a request is sent to ensure a complete set of data is present on the server
-            # - WORKER_MAX_SYSINFO_DELAY should be higher that WORKER_SYSINFO_DELAY
-            # - WORKER_MAX_SYSINFO_DELAY could be several minutes to avoid flooding the network
-            self.updateSysInfos(0)
-            self.lastFullSysInfoUpdate = now
-
-        if (now - self.lastSysInfosMessageTime) > config.WORKER_SYSINFO_DELAY:
-            # Every WORKER_SYSINFO_DELAY, sends a minimal set of data to the server
-            self.sendSysInfosMessage()
-            self.lastSysInfosMessageTime = now
-
-        self.httpconn.close()
+        #
+        # Kill the processes of the killed commands still alive after WORKER_KILL_DELAY
+        #
+        self.sweepKilledCommands(time.time())
 
-        # let's be CPU friendly
-        time.sleep(0.05)
+        if not self.framework.stopFlag:
+            self.scheduleTimers()
+            self.events.wait()
         # except:
         #     LOGGER.error("A problem occured : " + repr(sys.exc_info()))
 
-    def sendSysInfosMessage(self):
+    def readCommandUpdates(self):
         """
-        | Send sys infos to the dispatcher, the request content holds the RN status and free memory only, it has to be kept
-        | very small to avoid nerwork flood.
-        | req: PUT /rendernodes/<currentRN>/sysinfos
-
-        :raise : Exception
+        Applies all the updates received from the command watchers on the local socket since the last iteration,
+        see octopus.worker.ipc. They are the same as the updates sent to the webservice (see CommandResource).
         """
+        try:
+            updates = self.commandUpdateSocket.receive()
+        except socket.error, e:
+            LOGGER.error("Impossible to read the updates of the command watchers: %r" % e)
+            return
+        for update in updates:
+            try:
+                commandId = int(update['id'])
+            except (KeyError, TypeError, ValueError):
+                LOGGER.warning("Command update without id ignored: %r" % update)
+                continue
+            if 'status' in update or 'completion' in update or 'message' in update or 'stats' in update:
+                self.updateCompletionAndStatus(commandId,
+                                               update.get('completion'),
+                                               update.get('status'),
+                                               update.get('message'),
+                                               update.get('stats'))
+            elif 'validatorMessage' in update or 'errorInfos' in update:
+                self.updateCommandValidation(commandId, update.get('validatorMessage'), update.get('errorInfos'))
+
+    def scheduleTimers(self):
+        """
+        Sets the timers waking the main loop when no other event happens: command timeouts, verification of the
+        killed commands and, if the directory of the killfile cannot be watched, next check of the killfile. The
+        heartbeats are timed by the sender thread.
+        """
+        now = time.time()
+        if self.killedCommands:
+            self.events.setTimer('kill', min(deadline for deadline, accounting in self.killedCommands.values()))
+        for commandWatcher in self.commandWatchers.values():
+            if commandWatcher.timeOut and commandWatcher.command.status == COMMAND.CMD_RUNNING:
+                self.events.setTimer('timeout-%d' % commandWatcher.commandId, commandWatcher.startTime + commandWatcher.timeOut + 0.01)
 
-        # we don't need to send the whole dict of sysinfos
-        infos = {}
-
-        if self.updateSys:
-            # If necessary (i.e. specified by user via WS)
-            infos = self.fetchSysInfos()
-            self.updateSys = False
-
-        infos['status'] = self.status
-        infos['systemFreeRam'] = self.getFreeMem()
-        infos['systemSwapPercentage'] = self.getSwapUsage()
-
-        dct = json.dumps(infos)
-        headers = {}
-        headers['content-length'] = len(dct)
+        # the watch is only retried when the 'killfile' timer fires, not at each wake up
+        if not self.events.watching and not self.events.hasTimer('killfile'):
+            if not self.events.watchDirectory(os.path.dirname(settings.KILLFILE)):
+                self.events.setTimer('killfile', now + config.WORKER_KILLFILE_CHECK_DELAY)
 
+    def waitCommandWatcherExit(self, pid):
+        """
+        Waiting thread of a command watcher process: the main loop is woken up as soon as it exits.
+        """
         try:
-            self.requestManager.put("/rendernodes/%s/sysinfos" % self.computerName, dct, headers)
-        except RequestManager.RequestError, err:
-            if err.status == 404:
-                # the dispatcher doesn't know the worker
-                # it may have been launched before the dispatcher itself
-                # and not be mentioned in the tree.description file
-                self.registerWorker()
-            else:
-                raise
-        except httplib.BadStatusLine:
-            LOGGER.exception('Sending sys infos has failed with a BadStatusLine error')
+            os.waitpid(pid, 0)
+        except OSError:
+            # already reaped (and reported) by the waitpid(-1) of the main loop
+            return
+        self.commandWatcherExited(pid)
 
-        LOGGER.debug('Sys infos transmitted to the server: %r' % dct)
+    def commandWatcherExited(self, pid):
+        """
+        Called from the waiting threads and the fork server reader, the pid is cleaned by the main loop.
+        """
+        self.exitedProcesses.append(pid)
+        self.events.wake()
 
     def connect(self):
         return httplib.HTTPConnection(settings.DISPATCHER_ADDRESS, settings.DISPATCHER_PORT)
@@ -805,10 +742,13 @@ class Worker(MainLoopApplication):
 
         del self.commandWatchers[commandWatcher.commandId]
         del self.commands[commandWatcher.commandId]
+        self.sampler.untrackProcessTree(commandWatcher.processId)
+        self.logCompressor.compress(commandWatcher.command.environment["PULI_LOG"])
+        self.freeCpus.update(commandWatcher.cpus)
         try:
             os.remove(commandWatcher.processObj.pidfile)
-            if self.status is not rendernode.RN_PAUSED:
-                # Only set status to IDLE if RN was not marked as pause (via mylawn or pulback)
+            if self.status is not rendernode.RN_PAUSED and not self.commandWatchers:
+                # Only set status to IDLE if RN was not marked as pause (via mylawn or pulback) and runs no other command
                 self.status = rendernode.RN_IDLE
 
         except OSError, e:
@@ -833,13 +773,49 @@ class Worker(MainLoopApplication):
                 commandWatcher.command.message = message
             if status is not None:
                 commandWatcher.command.status = status
+                if status == COMMAND.CMD_RUNNING and commandWatcher.runningTime is None:
+                    commandWatcher.runningTime = time.time()
                 if COMMAND.isFinalStatus(status):
                     commandWatcher.finished = True
+                    if commandWatcher.endTime is None:
+                        commandWatcher.endTime = time.time()
 
             # Add a stats dict that will allow runner to send back useful data on the server.
             # Data can be large, need to avoid to send it every command update.
             # The stats value is None when no update need to be updated on the server.
-            commandWatcher.command.stats = stats
+            if stats is not None:
+                commandWatcher.runnerStats = stats
+            now = time.time()
+            if stats is not None or commandWatcher.finished or now - commandWatcher.lastStatsReport >= config.WORKER_ACCOUNTING_DELAY:
+                self.reportCommandStats(commandWatcher, now)
+
+    def reportCommandStats(self, commandWatcher, now):
+        """
+        | Sets the stats of the command sent with the next heartbeat: the stats of the runner and, under the
+        | "resources" key, the resources used by the processes of the command and the durations of its phases:
+        |   - cpuTime: cpu time in seconds (user + system) of all the processes, including the exited ones
+        |   - rss, peakRss: resident memory in megabytes, current and highest sampled value
+        |   - readBytes, writeBytes: bytes read from and written to the storage
+        |   - processes, maxProcesses: number of processes started, highest number of simultaneous processes
+        |   - startup: seconds between the start of the command watcher and the start of the command
+        |   - running: seconds the command has been running
+        |   - wallTime: seconds since the start of the command watcher
+        """
+        resources = {}
+        if commandWatcher.accounting is not None:
+            if not commandWatcher.finished:
+                self.sampler.sampleProcessTrees([commandWatcher.accounting])
+            resources = commandWatcher.accounting.to_json()
+        end = commandWatcher.endTime or now
+        if commandWatcher.runningTime is not None:
+            resources['startup'] = round(commandWatcher.runningTime - commandWatcher.startTime, 2)
+            resources['running'] = round(end - commandWatcher.runningTime, 2)
+        resources['wallTime'] = round(end - commandWatcher.startTime, 2)
+
+        stats = dict(commandWatcher.runnerStats)
+        stats['resources'] = resources
+        commandWatcher.command.stats = stats
+        commandWatcher.lastStatsReport = now
 
     def addCommandApply(self, ticket, commandId, runner, arguments, validationExpression, taskName, relativePathToLogDir, environment, runnerPackages=None, watcherPackages=None):
         if not self.isPaused:
@@ -854,6 +830,95 @@ class Worker(MainLoopApplication):
         else:
             raise WorkerInternalException("Worker flag 'isPaused' is on.")
 
+    def addCommandsBatchApply(self, tasks, commandDicts):
+        '''
+        Adds several commands sent by the dispatcher in a single message (batch assignment or pull mode).
+        The arguments of a command are merged over the arguments of its task, the environment of the task over the
+        command's one. Returns the lists of the accepted and refused command ids.
+        '''
+        accepted = []
+        refused = []
+        for commandDict in commandDicts:
+            commandId = int(commandDict['id'])
+            try:
+                task = tasks[commandDict['task']]
+                arguments = dict(task['arguments'])
+                arguments.update(commandDict['arguments'])
+                environment = dict(commandDict['environment'])
+                environment.update(task['environment'])
+
+                self.addCommandApply(None,
+                                     commandId,
+                                     task['runner'],
+                                     arguments,
+                                     task['validationExpression'],
+                                     task['taskName'],
+                                     task['relativePathToLogDir'],
+                                     environment,
+                                     commandDict.get('runnerPackages', ''),
+                                     commandDict.get('watcherPackages', ''),
+                                     )
+            except WorkerInternalException, e:
+                LOGGER.error("Impossible to add command %r, the RN status is 'paused' (%r)" % (commandId, e))
+                refused.append(commandId)
+            except Exception, e:
+                LOGGER.error("Impossible to add command %r (%r)" % (commandId, e))
+                refused.append(commandId)
+            else:
+                accepted.append(commandId)
+        return (accepted, refused)
+
+    def pulledAssignmentsApply(self, ticket, data):
+        '''
+        Pull mode: applies a response of the dispatcher to a poll, the refused commands are reported with the next poll.
+        '''
+        for commandId in data.get('kill', []):
+            self.stopCommandApply(ticket, commandId)
+        accepted, refused = self.addCommandsBatchApply(data.get('tasks', {}), data.get('commands', []))
+        with self.refusedAssignmentsLock:
+            self.refusedAssignments.extend(refused)
+
+    def pullAssignments(self):
+        '''
+        | Pull mode (config.WORKER_PULL_MODE): loop of the thread polling the dispatcher for assignments.
+        | The dispatcher holds each request until it assigns commands to this worker or until WORKER_PULL_TIMEOUT.
+        | The received assignments are applied by the main loop.
+        | req: POST /rendernodes/<currentRN>/assignments
+        '''
+        url = "/rendernodes/%s/assignments/" % self.computerName
+        delayRetry = config.WORKER_REQUEST_DELAY_AFTER_REQUEST_FAILURE
+        while True:
+            with self.refusedAssignmentsLock:
+                refused, self.refusedAssignments = self.refusedAssignments, []
+            body = json.dumps({'timeout': config.WORKER_PULL_TIMEOUT, 'refused': refused})
+            headers = {'Content-Length': len(body)}
+
+            conn = httplib.HTTPConnection(settings.DISPATCHER_ADDRESS, settings.DISPATCHER_PORT, timeout=config.WORKER_PULL_TIMEOUT + 10)
+            response = None
+            try:
+                conn.request('POST', url, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                LOGGER.error('"POST %s" failed (error:%r)', url, e)
+            finally:
+                conn.close()
+
+            if response is not None and response.status in (200, 204):
+                delayRetry = config.WORKER_REQUEST_DELAY_AFTER_REQUEST_FAILURE
+                if response.status == 200:
+                    self.framework.addOrder(self.pulledAssignmentsApply, data=json.loads(data))
+                continue
+
+            if response is not None:
+                # 404: the worker is not registered yet, the main loop registers it again
+                LOGGER.warning("Poll for assignments failed with status %d: %s" % (response.status, response.reason))
+            # the refused commands are reported again with the next poll
+            with self.refusedAssignmentsLock:
+                self.refusedAssignments.extend(refused)
+            time.sleep(delayRetry)
+            delayRetry = min(delayRetry * 1.5, config.WORKER_SYSINFO_DELAY)
+
     ##
     #
     # @param id the integer value identifying the command
@@ -867,9 +932,8 @@ class Worker(MainLoopApplication):
         except KeyError:
             LOGGER.warning("Attempt to stop an unregistered command %d", commandId)
         else:
-            commandWatcher.processObj.kill()
+            self.killCommand(commandWatcher)
             self.updateCompletionAndStatus(commandId, 0, COMMAND.CMD_CANCELED, "killed")
-            self.ensureNoMoreRender()
             LOGGER.info("Stopped command %r", commandId)
 
     def updateCommandApply(self, ticket, commandId, status, completion, message, stats):
@@ -877,15 +941,41 @@ class Worker(MainLoopApplication):
         # LOGGER.info("Updated command id=%r status=%r completion=%r message=%r stats=%r" % (commandId, status, completion, message, stats))
 
     def updateCommandValidationApply(self, ticket, commandId, validatorMessage, errorInfos):
+        if not self.updateCommandValidation(commandId, validatorMessage, errorInfos):
+            ticket.status = ticket.ERROR
+            ticket.message = "No such command watcher."
+
+    def updateCommandValidation(self, commandId, validatorMessage, errorInfos):
         try:
             commandWatcher = self.commandWatchers[commandId]
         except KeyError:
-            ticket.status = ticket.ERROR
-            ticket.message = "No such command watcher."
-        else:
-            commandWatcher.command.validatorMessage = validatorMessage
-            commandWatcher.command.errorInfos = errorInfos
-            LOGGER.info("Updated validation info id=%r validatorMessage=%r errorInfos=%r" % (commandId, validatorMessage, errorInfos))
+            LOGGER.warning("attempt to update validation info of unregistered command %d", commandId)
+            return False
+        commandWatcher.command.validatorMessage = validatorMessage
+        commandWatcher.command.errorInfos = errorInfos
+        LOGGER.info("Updated validation info id=%r validatorMessage=%r errorInfos=%r" % (commandId, validatorMessage, errorInfos))
+        return True
+
+    def reserveCpus(self, command):
+        """
+        | Returns the cpus dedicated to a command sharing the host with other commands.
+        | The dispatcher reserves a number of cores for each command (PULI_ALLOCATED_CORES), the command watcher and
+        | its children are pinned on as many free cpus. A command using all the cores is not pinned.
+        """
+        cores = self.sampler.getFacts()['cores']
+        if self.freeCpus is None:
+            self.freeCpus = set(range(cores))
+        if not config.WORKER_PIN_COMMANDS:
+            return []
+        try:
+            allocatedCores = int(command.environment.get("PULI_ALLOCATED_CORES", 0))
+        except ValueError:
+            return []
+        if allocatedCores <= 0 or allocatedCores >= cores or allocatedCores > len(self.freeCpus):
+            return []
+        cpus = sorted(self.freeCpus)[:allocatedCores]
+        self.freeCpus.difference_update(cpus)
+        return cpus
 
     def addCommandWatcher(self, command):
         newCommandWatcher = self.CommandWatcher()
@@ -916,6 +1006,8 @@ class Worker(MainLoopApplication):
                 err = e.args[0]
                 if err != errno.EEXIST:
                     raise
+        # the log of a previous run of the command might be waiting for its compression
+        self.logCompressor.reclaim(outputFile)
         logFile = file(outputFile, "w")
 
         d = os.path.dirname(pidFile)
@@ -934,6 +1026,12 @@ class Worker(MainLoopApplication):
         command.environment["PULI_TASK_NAME"] = command.taskName
         command.environment["PULI_TASK_ID"] = command.relativePathToLogDir
         command.environment["PULI_LOG"] = outputFile
+        if self.commandUpdateSocket is not None:
+            command.environment["PULI_WORKER_SOCKET"] = self.commandUpdateSocket.path
+
+        cpus = self.reserveCpus(command)
+        if cpus:
+            command.environment["PULI_CPUS"] = ",".join(str(cpu) for cpu in cpus)
 
         # LOGGER.debug("command.runnerPackages = %s" % command.runnerPackages)
         # LOGGER.debug("command.watcherPackages = %s" % command.watcherPackages)
@@ -961,27 +1059,47 @@ class Worker(MainLoopApplication):
         try:
             # Starts a new process (via CommandWatcher script) with current command info and environment.
             # The command environment is derived from the current os.env
+            watcherProcess = None
             if 'REZ_USED_RESOLVE' in os.environ:
                 LOGGER.warning("Current worker managed with rez, command watcher packages are: %s" % command.watcherPackages)
-                watcherProcess = spawnRezManagedCommandWatcher(pidFile, logFile, args, command.watcherPackages, command.environment)
+                watcherProcess = spawnRezManagedCommandWatcher(pidFile, logFile, args, command.watcherPackages, command.environment, cpus)
             else:
                 LOGGER.warning("Current worker is not rez-managed (undefined REZ_USED_RESOLVE in env)")
-                watcherProcess = spawnCommandWatcher(pidFile, logFile, args, command.environment)
+                if self.forkServer is not None and self.forkServer.canSpawn(command.environment):
+                    try:
+                        watcherProcess = self.forkServer.spawn(pidFile, outputFile, args[3:], command.environment, cpus)
+                        logFile.close()
+                    except Exception, e:
+                        LOGGER.warning("Fork server failed, starting the command watcher directly (%r)" % e)
+                if watcherProcess is None:
+                    watcherProcess = spawnCommandWatcher(pidFile, logFile, args, command.environment, cpus)
+
+            # the affinity is set in the child before the command watcher starts
+            newCommandWatcher.cpus = cpus
 
             newCommandWatcher.processObj = watcherProcess
             newCommandWatcher.startTime = time.time()
             newCommandWatcher.timeOut = None
             newCommandWatcher.command = command
             newCommandWatcher.processId = watcherProcess.pid
+            newCommandWatcher.accounting = self.sampler.trackProcessTree(watcherProcess.pid)
 
             self.commandWatchers[command.id] = newCommandWatcher
             self.status = rendernode.RN_WORKING
 
+            # the end of the forked command watchers is notified by the fork server
+            if watcherProcess.process is not None:
+                waitingThread = threading.Thread(target=self.waitCommandWatcherExit, args=(watcherProcess.pid,), name="Watcher-%d" % command.id)
+                waitingThread.setDaemon(True)
+                waitingThread.start()
+
             LOGGER.info("Started command %d", command.id)
         except Exception, e:
             LOGGER.error("Error spawning command watcher %r", e)
+            self.freeCpus.update(cpus)
             raise e
 
     def reloadConfig(self):
         reload(config)
-        pass
+        # the cached rez contexts are resolved again with the new config
+        REZ_CONTEXTS.invalidate()
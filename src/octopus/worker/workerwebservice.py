@@ -1,26 +1,33 @@
 import os
+import threading
+import time
 from Queue import Queue
 try:
     import simplejson as json
 except ImportError:
     import json
 import logging
-import subprocess
 
 from octopus.core.communication.http import Http400, Http404
 from octopus.worker import settings
+from octopus.worker import config
+from octopus.worker.logfiles import LogFile, readChunks
 
 from octopus.worker.worker import WorkerInternalException
 
-from tornado.web import Application, RequestHandler
+from tornado.ioloop import IOLoop
+from tornado.web import Application, RequestHandler, asynchronous
 
 # /commands/ [GET] { commands: [ { id, status, completion } ] }
 # /commands/ [POST] { id, jobtype, arguments }
+# /commands/batch/ [POST] { tasks: { taskId: { runner, arguments, environment, ... } }, commands: [ { id, task, arguments, environment, ... } ] }
 # /commands/{id}/ [GET] { id, status, completion, jobtype, arguments }
 # /commands/{id}/ [DELETE] stops the job
 # /online/ [GET] { online }
 # /online/ [SET] { online }
 # /status/ [GET] { status, ncommands, globalcompletion }
+# /sysinfos/ [GET] { facts: {...}, samples: [ { time, cpuUsage, totalRam, freeRam, swapPercentage, ioRead, ioWrite } ] }
+# /log/ and /log/command/{path} [GET] ?offset=&length=&tail=&follow= (see LogResource)
 
 LOGGER = logging.getLogger("workerws")
 
@@ -29,17 +36,20 @@ class WorkerWebService(Application):
     '''A tornado application that will communicate with the dispatcher via webservices
     Services are:
     /commands
+    /commands/batch
     /commands/<id command>
     /log
     /log/command/<path>
     /updatesysinfos
     /pause
     /ramInUse
+    /sysinfos
     /reconfig
     '''
     def __init__(self, framework, port):
         super(WorkerWebService, self).__init__([
             (r'/commands/?$', CommandsResource, dict(framework=framework)),
+            (r'/commands/batch/?$', CommandsBatchResource, dict(framework=framework)),
             (r'/commands/(?P<id>\d+)/?$', CommandResource, dict(framework=framework)),
             (r'/commands/(?P<id>\d+)/done?$', CommandDoneResource, dict(framework=framework)),
             (r'/debug/?$', DebugResource, dict(framework=framework)),
@@ -48,6 +58,7 @@ class WorkerWebService(Application):
             (r'/updatesysinfos/?$', UpdateSysResource, dict(framework=framework)),
             (r'/pause/?$', PauseResource, dict(framework=framework)),
             (r'/ramInUse/?$', RamInUseResource, dict(framework=framework)),
+            (r'/sysinfos/?$', SysInfosResource, dict(framework=framework)),
             (r'/reconfig/?$', WorkerReconfig, dict(framework=framework))
         ])
         logging.getLogger('').info("start WS")
@@ -108,21 +119,22 @@ class PauseResource(BaseResource):
 
 class RamInUseResource(BaseResource):
     """
-    TO FIX: the method for retrieving mem used is not really correct.
-    We should use "free -m" or directly /proc/meminfo -> use = memtotal - (memfree + membuffer + memcache)
+    Returns the memory used on the host in megabytes, from the last sample of the system:
+    memtotal - (memfree + membuffer + memcache)
+    """
+    def get(self):
+        sample = self.framework.application.sampler.latest()
+        self.write(str(sample['totalRam'] - sample['freeRam']))
 
-    Par ex, pour calculer la memoire libre (en prenant en compte les buffers et le swap):
-    awk '/MemFree|Buffers|^Cached/ {free+=$2} END {print  free}' /proc/meminfo
 
-    Pour avoir la memoire utilisee, soit memtotal-memlibre:
-    awk '/MemTotal/ {tot=$2} /MemFree|Buffers|^Cached/ {free+=$2} END {print tot-free}' /proc/meminfo
-    """
+class SysInfosResource(BaseResource):
     def get(self):
-        process = subprocess.Popen("ps -e -o rss | awk '{sum+=$1} END {print sum/1024}'",
-                                   shell=True,
-                                   stdout=subprocess.PIPE)
-        stdout_list = process.communicate()[0].split('\n')
-        self.write(stdout_list[0])
+        """
+        | Returns the static facts of the host and the last samples of its cpu, memory, swap and I/O usage.
+        |
+        | URL: GET http://host:port/sysinfos/
+        """
+        self.write(self.framework.application.sampler.to_json())
 
 
 class CommandsResource(BaseResource):
@@ -177,6 +189,22 @@ class CommandsResource(BaseResource):
             self.set_status(202)
 
 
+class CommandsBatchResource(BaseResource):
+    def post(self):
+        """
+        | Adds several commands sent by the dispatcher in a single request.
+        | The task part of the commands (runner, arguments, environment...) is sent once per task, the arguments of a
+        | command are merged over the arguments of its task, the environment of the task over the command's one.
+        |
+        | URL: POST http://host:port/commands/batch/
+        | Returns the ids of the accepted and refused commands: { accepted: [ids], refused: [ids] }
+        """
+        self.setRnId(self.request)
+        data = self.getBodyAsJSON()
+        accepted, refused = self.framework.application.addCommandsBatchApply(data['tasks'], data['commands'])
+        self.write({'accepted': accepted, 'refused': refused})
+
+
 class CommandDoneResource(BaseResource):
     def post(self, id):
         """
@@ -204,6 +232,7 @@ class CommandResource(BaseResource):
         """
         | Usually called from a commandwatcher to set new values relative to a command.
         | Only called when a value has changed or and long delay has been reached (see commandwatcher).
+        | The command watchers use the local socket of the worker instead when it is available (see octopus.worker.ipc).
         |
         | URL: PUT http://host:port/commands/<id>
         |
@@ -269,33 +298,159 @@ class DebugResource(BaseResource):
         self.write(content)
 
 
-class WorkerLogResource(RequestHandler):
-    def get(self):
+class LogResource(RequestHandler):
+    """
+    | Serves a log by ranges, the log is never loaded as a whole (see octopus.worker.logfiles). Query arguments:
+    |   - offset, length: `length` bytes from `offset`, a negative offset is relative to the end of the log
+    |   - tail: the last `tail` lines
+    |   - follow: with offset, waits up to WORKER_LOG_FOLLOW_TIMEOUT seconds for content after `offset` if there is none
+    | The Range header ("bytes=first-last" or "bytes=-suffix") is also supported, the answer is "206 Partial Content".
+    | Without range, the whole log is sent by chunks. A compressed log (finished command) is sent as is to the clients
+    | accepting gzip, else it is decompressed on the fly.
+    | The X-Log-Offset header of the answer is the offset following the content sent (the offset of the next follow
+    | request), X-Log-Size is the size of the log.
+    """
+    chunks = None
 
-        logFileName = "worker%d.log" % settings.PORT
-        logFilePath = os.path.join(settings.LOGDIR, logFileName)
-
-        if os.path.isfile(logFilePath):
-            logFile = open(logFilePath, 'r')
-            logFileContent = logFile.read()
-            logFile.close()
-            self.set_header('Content-Type', 'text/plain')
-            self.write(logFileContent)
-        else:
+    def serveLog(self, path):
+        log = LogFile.find(path)
+        if log is None:
             raise Http404('no log file')
+        size = log.size()
+        self.set_header('Content-Type', 'text/plain')
+
+        try:
+            offset = self.get_argument('offset', None)
+            offset = int(offset) if offset is not None else None
+            length = self.get_argument('length', None)
+            length = int(length) if length is not None else None
+            tail = self.get_argument('tail', None)
+            tail = int(tail) if tail is not None else None
+        except ValueError:
+            raise Http400("offset, length and tail must be integers")
+        follow = self.get_argument('follow', '0') not in ('0', 'false', 'False')
+
+        rangeHeader = self.request.headers.get('Range')
+        if rangeHeader is not None:
+            try:
+                unit, bounds = rangeHeader.split('=', 1)
+                first, last = bounds.split(',')[0].strip().split('-')
+                if first == '':
+                    offset = -int(last)
+                else:
+                    offset = int(first)
+                    length = int(last) - offset + 1 if last != '' else None
+                if unit.strip() != 'bytes' or (length is not None and length < 0):
+                    raise ValueError
+            except ValueError:
+                raise Http400("Invalid range: %s" % rangeHeader)
+            if offset >= size:
+                self.set_status(416)
+                self.set_header('Content-Range', 'bytes */%d' % size)
+                self.finish()
+                return
+
+        if offset is None and length is None and tail is None:
+            if log.compressed and 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+                self.set_header('Content-Encoding', 'gzip')
+                self.set_header('X-Log-Size', size)
+                self.set_header('X-Log-Offset', size)
+                self.sendChunks(readChunks(open(log.path, 'rb')))
+                return
+            offset = 0
+
+        if offset is not None and offset < 0:
+            offset = max(0, size + offset)
+
+        if follow and tail is None and offset >= size:
+            self.waitForContent(path, offset, length, time.time() + config.WORKER_LOG_FOLLOW_TIMEOUT)
+            return
+        self.sendRange(log, size, offset, length, tail, rangeHeader is not None)
+
+    def sendRange(self, log, size, offset, length, tail, partial):
+        def locate():
+            start = log.tailOffset(tail) if tail is not None else min(offset, size)
+            return start, log.openAt(start)
+
+        def send(located):
+            start, f = located
+            end = size if length is None else min(size, start + length)
+            if partial:
+                self.set_status(206)
+                self.set_header('Content-Range', 'bytes %d-%d/%d' % (start, max(start, end - 1), size))
+            self.set_header('X-Log-Size', size)
+            self.set_header('X-Log-Offset', end)
+            self.sendChunks(readChunks(f, end - start))
+
+        if log.compressed:
+            # the decompression up to the offset runs in a thread, the web service keeps answering
+            def run():
+                try:
+                    result = locate()
+                except Exception, e:
+                    LOGGER.error("Impossible to read log %s: %r" % (log.path, e))
+                    IOLoop.instance().add_callback(lambda: self.send_error(500))
+                else:
+                    IOLoop.instance().add_callback(lambda: send(result))
+            thread = threading.Thread(target=run, name="LogReader")
+            thread.setDaemon(True)
+            thread.start()
+        else:
+            send(locate())
+
+    def waitForContent(self, path, offset, length, deadline):
+        if self.request.connection.stream.closed():
+            return
+        log = LogFile.find(path)
+        if log is None:
+            # called from the IOLoop, outside of the handling of the request
+            self.send_error(404)
+            return
+        size = log.size()
+        if size > offset or time.time() >= deadline:
+            self.sendRange(log, size, offset, length, None, False)
+        else:
+            IOLoop.instance().add_timeout(time.time() + config.WORKER_LOG_FOLLOW_INTERVAL,
+                                          lambda: self.waitForContent(path, offset, length, deadline))
+
+    def sendChunks(self, chunks):
+        '''
+        Sends the chunks one by one, the next one is read when the previous one has been sent.
+        '''
+        self.chunks = chunks
+        try:
+            data = next(chunks)
+        except StopIteration:
+            self.finish()
+            return
+        except (IOError, OSError), e:
+            LOGGER.error("Impossible to read log: %r" % e)
+            self.finish()
+            return
+        self.write(data)
+        self.flush(callback=lambda: self.sendChunks(chunks))
+
+    def on_connection_close(self):
+        if self.chunks is not None:
+            # closes the log
+            self.chunks.close()
+
+
+class WorkerLogResource(LogResource):
+    @asynchronous
+    def get(self):
+        logFileName = "worker%d.log" % settings.PORT
+        self.serveLog(os.path.join(settings.LOGDIR, logFileName))
 
 
-class CommandLogResource(RequestHandler):
+class CommandLogResource(LogResource):
+    @asynchronous
     def get(self, path):
-        logFilePath = os.path.join(settings.LOGDIR, path)
-        if os.path.isfile(logFilePath):
-            logFile = open(logFilePath, 'r')
-            logFileContent = logFile.read()
-            logFile.close()
-            self.set_header('Content-Type', 'text/plain')
-            self.write(logFileContent)
-        else:
+        logDir = os.path.abspath(settings.LOGDIR)
+        logFilePath = os.path.abspath(os.path.join(logDir, path))
+        if not logFilePath.startswith(logDir + os.sep):
             raise Http404('no log file')
+        self.serveLog(logFilePath)
 
 
 class UpdateSysResource(BaseResource):
@@ -13,11 +13,14 @@ try:
     import simplejson as json
 except ImportError:
     import json
+import requests
 
 from puliclient.model.jsonModel import JsonModel
 from puliclient.server.server import Server, RequestError, RequestTimeoutError
 from puliclient.server.server import request
 
+LOG_REQUEST_TIMEOUT = 60
+
 
 # class RenderNode(object, JsonModel):
 class RenderNode(object):
@@ -117,6 +120,32 @@ class RenderNode(object):
             return False
         return True
 
+    def _getLog(self, url, **params):
+        '''
+        | Requests a log to the worker, see octopus.worker.workerwebservice.LogResource for the parameters.
+        | The compressed logs are decompressed by requests.
+
+        :return: the content of the log and the offset following it
+        '''
+        url = "http://%s:%d%s" % (self.host, self.port, url)
+        try:
+            # a follow request is held by the worker when the log has no new content
+            r = requests.get(url, params=params, timeout=LOG_REQUEST_TIMEOUT)
+        except requests.exceptions.Timeout as e:
+            errMsg = "Timeout: %s" % e
+            logging.error(errMsg)
+            raise RequestTimeoutError(errMsg)
+        except requests.exceptions.RequestException as e:
+            errMsg = "Impossible to get log %s: %s" % (url, e)
+            logging.error(errMsg)
+            raise RequestError(errMsg)
+
+        if r.status_code not in [requests.codes.ok, requests.codes.partial_content]:
+            errMsg = "Error return code: %s, response message: '%s'" % (r.status_code, r.text)
+            logging.error(errMsg)
+            raise RequestError(errMsg)
+        return r.content, int(r.headers.get('X-Log-Offset', len(r.content)))
+
     #
     # User actions
     #
@@ -155,7 +184,7 @@ class RenderNode(object):
         '''
         Return a string containing the worker log.
         '''
-        raise NotImplementedError
+        return self._getLog("/log/")[0]
 
     def tailLog(self, length=100):
         '''
@@ -163,7 +192,35 @@ class RenderNode(object):
 
         :param length: int indicating the number of lines to retrieve
         '''
-        raise NotImplementedError
+        return self._getLog("/log/", tail=length)[0]
+
+    def getCommandLog(self, path, tail=None):
+        '''
+        Return a string containing the log of a command, or only its last lines.
+
+        :param path: path of the log relative to the log directory of the worker (<task log dir>/<command id>.log)
+        :param tail: int indicating the number of lines to retrieve, None for the whole log
+        '''
+        if tail is None:
+            return self._getLog("/log/command/%s" % path)[0]
+        return self._getLog("/log/command/%s" % path, tail=tail)[0]
+
+    def followLog(self, offset=0, path=None):
+        '''
+        | Return the content written in the worker log (or in the log of a command) after `offset`. If there is none
+        | yet, the worker waits for it a few seconds before answering.
+        | Usage:
+        |     offset = 0
+        |     while True:
+        |         content, offset = rn.followLog(offset)
+        |         sys.stdout.write(content)
+
+        :param offset: offset returned by the previous call, a negative offset is relative to the end of the log
+        :param path: path of a command log relative to the log directory of the worker, None for the worker log
+        :return: the new content and the offset of the next call
+        '''
+        url = "/log/" if path is None else "/log/command/%s" % path
+        return self._getLog(url, offset=offset, follow=1)
 
     def setPerformanceIndex(self):
         raise NotImplementedError